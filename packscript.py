@@ -13,9 +13,15 @@ __license__ = 'MIT'
 modified_by = ''
 # # # # # # # # # # # # # # # # # # # # # #
 
-import argparse, json, re, sys, shutil, tempfile, textwrap
-from os import chdir
+import os, re, sys
+from contextlib import contextmanager, nullcontext
 from pathlib import Path
+from types import CodeType
+
+if __name__ == '__main__':
+    # the packscript_*.py modules (see MODULES) import this one, they should get this copy instead of importing the
+    # file a second time
+    sys.modules.setdefault('packscript', sys.modules[__name__])
 
 
 def ver(base_version, start, end, *, pf):
@@ -23,6 +29,8 @@ def ver(base_version, start, end, *, pf):
 
 
 PF = int | tuple[int, int]
+# the contents of a generated file, dicts and lists are written as JSON
+Content = str | bytes | dict | list
 pack_formats: dict[str, PF] = {
     'future': (9001, 0),
     '26.1.2': (101, 1), '26.1.1': (101, 1), '26.1': (101, 1),
@@ -51,6 +59,7 @@ latest_mc_version = list(pack_formats)[1]
 
 DATA_EXT = 'dps'
 FUNC_EXT = 'fps'
+CACHE_DIR = '.packscript_cache'
 
 if __v_type__ not in ('release', 'dev'):
     raise AssertionError(f'Version type {__v_type__!r} is invalid')
@@ -61,16 +70,20 @@ def ns(resource: str, /, *, default: str = 'minecraft'):
 
 
 namespace_re = re.compile(r'[a-z0-9-_.]+')
-func_re = re.compile(r'(?<!-)\bfunction\b(?!-)')
+# the greedy .* backtracks from the end of the line, so this finds the last "function"
+right_most_function_re = re.compile(r'.*(?<!-)\bfunction\b(?!-)')
+# braces get doubled for the f-string, ${expr} and $name become replacement fields
+command_token_re = re.compile(r'[{}]|\$\{([^}]*)}|\$([a-zA-Z_]\w*)')
+create_statement_re = re.compile(r'([\t ]*)create\b[ \t]*([\w/]+)\b[ \t]*([a-z\d:/_.-]*)[ \t]*->(.*)')
+func_def_re = re.compile(r'^([a-z\d:/_-]*)[ \t]*(?:\[([a-z\d:/_, -]*)](.*))?$')
 
 PLURAL_CUTOFF_PF: int = 45
 DECIMATED_PF: int = 82
 
 
 def right_most_function(contents: str) -> int | None:
-    # Use finditer to get match objects, which include the start and end positions of each match
-    matches = list(func_re.finditer(contents))
-    return matches[-1].end() if matches else None
+    match = right_most_function_re.match(contents)
+    return match and match.end()
 
 
 def version_or_pf(s: str, default: PF | None=None) -> PF:
@@ -116,10 +129,98 @@ def with_minor(pack_format: PF) -> tuple[int, int]:
         return pack_format
 
 
+class ResourceTable(dict):
+    """ The resources of one type by namespaced name, which also keeps their names by namespace for queries """
+    def __init__(self, *args, **kwargs):
+        super().__init__()
+        self.namespaces: dict[str, dict[str, None]] = {}
+        self.update(*args, **kwargs)
+
+    def __reduce__(self):
+        return ResourceTable, (dict(self),)
+
+    def __setitem__(self, name: str, content: object) -> None:
+        if name not in self:
+            self.namespaces.setdefault(name.partition(':')[0], {})[name] = None
+        super().__setitem__(name, content)
+
+    def __delitem__(self, name: str) -> None:
+        super().__delitem__(name)
+        del self.namespaces[name.partition(':')[0]][name]
+
+    def pop(self, name: str, *default):
+        if name in self:
+            del self.namespaces[name.partition(':')[0]][name]
+        return super().pop(name, *default)
+
+    def popitem(self) -> tuple[str, object]:
+        name, content = super().popitem()
+        del self.namespaces[name.partition(':')[0]][name]
+        return name, content
+
+    def setdefault(self, name: str, default=None):
+        if name not in self:
+            self[name] = default
+        return self[name]
+
+    def update(self, *args, **kwargs) -> None:
+        for name, content in dict(*args, **kwargs).items():
+            self[name] = content
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def clear(self) -> None:
+        super().clear()
+        self.namespaces.clear()
+
+    def copy(self) -> 'ResourceTable':
+        return ResourceTable(self)
+
+
+class ResourceStore(dict):
+    """ Generated resources by type ('tags/block') and then by namespaced name, what the dp object reads and writes """
+    def table(self, type: str) -> dict[str, object]:
+        if (table := dict.get(self, type)) is None:
+            table = ResourceTable()
+        return self.setdefault(type, table)
+
+    def query(self, type: str, pattern: str | None = None) -> dict[str, object]:
+        """ The resources of a type whose names match a glob pattern like 'example:*', or all of them. A pattern with a
+        plain namespace only looks through the names in that namespace """
+        table = self.get(type, {})
+        if pattern is None:
+            return dict(table)
+        wildcard = re.search(r'[*?\[]', pattern)
+        if wildcard is None:
+            return {pattern: table[pattern]} if pattern in table else {}
+        import fnmatch
+        names = table
+        namespace, colon, _ = pattern.partition(':')
+        if colon and len(namespace) < wildcard.start() and isinstance(table, ResourceTable):
+            names = table.namespaces.get(namespace, {})
+        match = re.compile(fnmatch.translate(pattern)).match
+        return {name: table[name] for name in names if match(name)}
+
+    def set_all(self, type: str, resources: dict[str, object]) -> None:
+        self.table(type).update(resources)
+
+    def update_all(self, type: str, pattern: str | None, update) -> int:
+        """ Call update with every matching resource, replacing it with what update returns unless that is None """
+        table = self.table(type)
+        matches = self.query(type, pattern)
+        for name, content in matches.items():
+            if (result := update(content)) is not None:
+                table[name] = result
+        return len(matches)
+
+
 def build_globals(func_stack: list, capturer_stack: list, func_files: dict,
-                  other: dict, namespace='minecraft', function_tags=None) -> dict:
+                  other: ResourceStore, namespace='minecraft', function_tags=None,
+                  spool: 'FunctionSpool | None' = None) -> dict:
     def __other__(s: str) -> dict:
-        return other.setdefault(s, {})
+        return other.table(s)
 
     def __line__(ln: str) -> None:
         if capturer_stack:
@@ -127,7 +228,11 @@ def build_globals(func_stack: list, capturer_stack: list, func_files: dict,
         else:
             func_files[func_stack[-1]].append(ln)
 
-    func_def_re = re.compile(r'^([a-z\d:/_-]*)[ \t]*(?:\[([a-z\d:/_, -]*)](.*))?$')
+    def __lines__(lns: tuple[str, ...]) -> None:
+        if capturer_stack:
+            capturer_stack[-1].extend(lns)
+        else:
+            func_files[func_stack[-1]].extend(lns)
 
     def __function_name__(func_def: str) -> tuple[str, str]:
         func_def_match = func_def_re.fullmatch(func_def)
@@ -151,18 +256,35 @@ def build_globals(func_stack: list, capturer_stack: list, func_files: dict,
         func_files[func_name] = []
         return func_name, (extra or '')
 
+    def flush(func_name: str) -> None:
+        """ Hand a function whose scope closed to the spool, unless it is still open further down the stack """
+        if spool is None or func_name in func_stack:
+            return
+        if func_name == '':
+            # top level lines are never written anywhere
+            func_files[''] = []
+        elif isinstance(content := func_files[func_name], list) and content:
+            func_files[func_name] = spool.put(content)
+
+    def reopen(func_name: str) -> None:
+        if isinstance(content := func_files.get(func_name), Path):
+            func_files[func_name] = spool.read(content)
+
     class FuncContext:
         def __init__(self, func_name: str):
             self.func_name = func_name
 
         def __enter__(self):
+            reopen(self.func_name)
             func_stack.append(self.func_name)
 
         def __exit__(self, *_):
-            func_stack.pop()
+            flush(func_stack.pop())
 
         def replace(self):
-            func_stack[-1] = self.func_name
+            reopen(self.func_name)
+            replaced, func_stack[-1] = func_stack[-1], self.func_name
+            flush(replaced)
 
     def __function__(func_name: str) -> FuncContext:
         return FuncContext(func_name)
@@ -182,38 +304,61 @@ def build_globals(func_stack: list, capturer_stack: list, func_files: dict,
     def n(s: str) -> str:
         return ns(s.removesuffix('.json'), default=namespace)
 
+    def n_pattern(pattern: str | None) -> str | None:
+        return pattern if pattern is None else n(pattern)
+
     class Dp:
         def __init__(self, type: tuple[str, ...]=()):
-            self._type = type
+            object.__setattr__(self, '_type', type)
+            object.__setattr__(self, '_key', '/'.join(type))
+            # dp.tags.block is the same object every time, instead of a new one per access
+            object.__setattr__(self, '_children', {})
         def __getattr__(self, attr: str):
-            if '/'.join(self._type) in other:
-                return other['/'.join(self._type)][n(attr)]
-            return Dp((*self._type, attr))
+            if self._key in other:
+                return other[self._key][n(attr)]
+            child = self._children.get(attr)
+            if child is None:
+                child = self._children[attr] = Dp((*self._type, attr))
+            return child
         def __setattr__(self, attr: str, value: dict | list | str | bytes):
-            if attr == '_type':
-                object.__setattr__(self, attr, value)
-                return
-            other.setdefault('/'.join(self._type), {})[n(attr)] = value
+            other.table(self._key)[n(attr)] = value
         def __delattr__(self, item):
-            other['/'.join(self._type)].pop(n(item))
+            other[self._key].pop(n(item))
         def __getitem__(self, item: tuple[str, str] | str):
             if self._type:
                 item: str
-                return other['/'.join(self._type)][n(item)]
+                return other[self._key][n(item)]
             type, resource = item
             return other[type][n(resource)]
         def __setitem__(self, item: tuple[str, str] | str, value: dict | list | str | bytes):
             if self._type:
                 item: str
-                other.setdefault('/'.join(self._type), {})[n(item)] = value
+                other.table(self._key)[n(item)] = value
                 return
             type, resource = item
-            other.setdefault(type, {})[n(resource)] = value
+            other.table(type)[n(resource)] = value
         def __delitem__(self, key):
-            other['/'.join(self._type)].pop(n(key))
-
-    dp = Dp()
-    funcs = [__other__, __line__, __function_name__, __function__, capture_lines]
+            other[self._key].pop(n(key))
+        def __iter__(self):
+            return iter(other.get(self._key, {}))
+        def __len__(self):
+            return len(other.get(self._key, {}))
+        def __contains__(self, item: str):
+            return n(item) in other.get(self._key, {})
+        def __bool__(self):
+            # an empty type is still there to add to, not a false value
+            return True
+
+    class RootDp(Dp):
+        def query(self, type: str, pattern: str | None = None) -> dict[str, object]:
+            return other.query(type, n_pattern(pattern))
+        def set_all(self, type: str, resources: dict[str, object]) -> None:
+            other.set_all(type, {n(name): content for name, content in resources.items()})
+        def update_all(self, type: str, pattern: str | None, update) -> int:
+            return other.update_all(type, n_pattern(pattern), update)
+
+    dp = RootDp()
+    funcs = [__other__, __line__, __lines__, __function_name__, __function__, capture_lines]
     return {func.__name__: func for func in funcs} | {'ns': namespace, 'dp': dp}
 
 
@@ -226,6 +371,7 @@ def get_folder(path: str, pf: PF) -> str:
 
 
 def read_pack_meta(input: Path) -> dict:
+    import json
     if not (input / 'pack.mcmeta').is_file():
         raise FileNotFoundError('No pack.mcmeta found')
     try:
@@ -237,15 +383,55 @@ def read_pack_meta(input: Path) -> dict:
     return pack_meta
 
 
-def comp_file(output_folder: Path, parent: Path, filename: Path, globals: dict[str, object], verbose=False):
-    command_re = re.compile(r'([\t ]*)/(.*)')
-    interpolation_re = re.compile(r'\$\{\{(.*?)}}|(?<!^)\$([a-zA-Z_]\w*)')
-    create_statement_re = re.compile(r'([\t ]*)create\b[ \t]*([\w/]+)\b[ \t]*([a-z\d:/_.-]*)[ \t]*->(.*)')
+def command_token(match: re.Match) -> str:
+    token, expression, name = match.group(0, 1, 2)
+    if expression is not None:
+        return f'{{{expression.replace("{", "{{")}}}'
+    if name is not None:
+        # a $ at the very start of a command is a macro line
+        return token if match.start() == 0 else f'{{{name}}}'
+    return token + token
+
+
+def escape_command(contents: str) -> str:
+    """ Turn the contents of a command line into the body of an f-string, replacing $ interpolations """
+    if '$' not in contents:
+        return contents.replace('{', '{{').replace('}', '}}')
+    return command_token_re.sub(command_token, contents)
+
+
+def static_command(contents: str) -> bool:
+    """ Whether a command line has no $ interpolation, so its text can be emitted as a constant """
+    if '"""' in contents:
+        return False
+    return '$' not in contents or all(match.group(1) is None and (match.group(2) is None or match.start() == 0)
+                                      for match in command_token_re.finditer(contents))
+
+
+def transpile(text: str, namespace: str) -> list[str]:
+    """ Rewrite PackScript source into lines of Python code """
     code = []
     concat_line = None
-    curr_file = parent / filename
-    print(filename.relative_to(output_folder))
-    for line in curr_file.read_text().splitlines():
+    # static command lines in a row at the same indent, emitted as one constant tuple
+    run: list[tuple[bool, str]] = []
+    run_indent = ''
+    gap: list[tuple[bool, str]] = []
+
+    def flush_run():
+        if len(run) == 1:
+            code.append(f'{run_indent}__line__({run[0][1]})')
+        else:
+            # one source line per tuple element, so the line numbers in errors still match
+            for i, (is_command, ln) in enumerate(run):
+                if is_command:
+                    prefix = f'{run_indent}__lines__((' if i == 0 else f'{run_indent}    '
+                    ln = f'{prefix}{ln}{"))" if i == len(run) - 1 else ","}'
+                code.append(ln)
+        code.extend(ln for _, ln in gap)
+        run.clear()
+        gap.clear()
+
+    for line in text.splitlines():
         line = line.rstrip()
         if concat_line is not None:
             line = f'{concat_line}{line.lstrip()}'
@@ -254,18 +440,28 @@ def comp_file(output_folder: Path, parent: Path, filename: Path, globals: dict[s
             concat_line = line[:-1]
             continue
 
-        command_match = command_re.match(line)
-        if command_match:
-            indent, contents = command_match.groups()
-            # replace { and } with other sequences, so they don't interfere with f string
-            contents = contents.replace('{', '{{').replace('}', '}}')
-            # replace interpolation with value \1\2 is a hack lmao
-            # It's basically grabbing from either the first or second group, since they're mutually exclusive
-            contents = interpolation_re.sub(r'{\1\2}', contents)
+        contents = line.lstrip(' \t')
+        if contents[:1] == '/' and contents[-1:] not in (':', ';') and static_command(contents[1:]):
+            indent = line[:len(line) - len(contents)]
+            if run and indent != run_indent:
+                flush_run()
+            run_indent = indent
+            run.extend(gap)
+            gap.clear()
+            run.append((True, repr(contents[1:])))
+            continue
+        if run and (not contents or contents[:1] == '#'):
+            # blank lines and comments can sit inside the tuple if the run carries on after them
+            gap.append((False, line))
+            continue
+        if run:
+            flush_run()
+        if contents[:1] == '/':
+            indent = line[:len(line) - len(contents)]
+            contents = escape_command(contents[1:])
             extra_line = None
             if (end_chr := contents[-1:]) in (':', ';'):
                 func_def_start = right_most_function(contents)
-                # print('func: ', line)
                 if func_def_start is None:
                     raise ValueError(f'Command {contents!r} ends with colon/semicolon but does not contain function')
                 func_def = contents[func_def_start:-1].strip()
@@ -277,15 +473,107 @@ def comp_file(output_folder: Path, parent: Path, filename: Path, globals: dict[s
             code.append(f'{indent}__line__(rf""" {contents} """[1:-1])')
             if extra_line:
                 code.append(extra_line)
+        elif 'create' in line and (create_match := create_statement_re.fullmatch(line)):
+            indent, file_type, name, data = create_match.groups()
+            name = ns(name, default=namespace)
+            code.append(f'{indent}__other__("{file_type}")["{name}"] ={data}')
         else:
-            create_match = create_statement_re.fullmatch(line)
-            if create_match:
-                indent, file_type, name, data = create_match.groups()
-                name = ns(name, default=str(globals['ns']))
-                code.append(f'{indent}__other__("{file_type}")["{name}"] ={data}')
-            else:
-                code.append(line)
-    pyth = '\n'.join(code)
+            code.append(line)
+    if run:
+        flush_run()
+    return code
+
+
+class TranspileCache:
+    """ On-disk cache of transpiled and byte-compiled PackScript, similar to __pycache__ """
+    def __init__(self, path: Path):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(text: str, namespace: str) -> str:
+        import hashlib
+        # bytecode is only valid for the interpreter that made it, and the transpiler changes between versions
+        tag = f'{__version__}-{__v_type__}\0{sys.implementation.cache_tag}\0{namespace}\0'
+        return hashlib.sha256((tag + text).encode('utf-8', 'surrogatepass')).hexdigest()
+
+    def load(self, key: str) -> tuple[list[str], CodeType] | None:
+        import marshal
+        try:
+            code, code_obj = marshal.loads((self.path / f'{key}.psc').read_bytes())
+            if not isinstance(code, list) or not isinstance(code_obj, CodeType):
+                raise ValueError('Malformed cache entry')
+        except (OSError, EOFError, ValueError, TypeError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return code, code_obj
+
+    def store(self, key: str, code: list[str], code_obj: CodeType) -> None:
+        import marshal
+        self.path.mkdir(parents=True, exist_ok=True)
+        entry = self.path / f'{key}.psc'
+        # write then rename, so an interrupted build never leaves a truncated entry behind
+        temp = entry.with_suffix(f'.{os.getpid()}.tmp')
+        try:
+            temp.write_bytes(marshal.dumps((code, code_obj)))
+            os.replace(temp, entry)
+        except OSError:
+            temp.unlink(missing_ok=True)
+
+    def clear(self) -> None:
+        """ Remove the cache entries, and the folder if nothing else is in it, --cache-dir can point anywhere """
+        for entry in [*self.path.glob('*.psc'), self.path / 'deps.json']:
+            entry.unlink(missing_ok=True)
+        try:
+            self.path.rmdir()
+        except OSError:
+            pass
+
+    def stats(self) -> str:
+        return (f'Transpile cache: {self.hits} hit{"s" * (self.hits != 1)}, '
+                f'{self.misses} miss{"es" * (self.misses != 1)}')
+
+
+# wall time spent in each phase of the last compile(), in seconds, see test/bench.py
+phase_times: dict[str, float] = {}
+
+
+@contextmanager
+def timed(phase: str):
+    """ Add the time spent in the block to phase_times """
+    import time
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        phase_times[phase] = phase_times.get(phase, 0.0) + seconds
+        if profiler is not None:
+            profiler.phase(phase, start, seconds)
+
+
+# the profiler of the running compile(), if it was started with --profile
+profiler: 'Profiler | None' = None
+
+
+def profiled(kind: str, name: str, func_files: dict | None = None, other: dict | None = None):
+    """ Profile the block as a span, if a profiler is running """
+    return profiler.span(kind, name, func_files, other) if profiler is not None else nullcontext()
+
+
+def comp_file(output_folder: Path, parent: Path, filename: Path, globals: dict[str, object], verbose=False,
+              cache: TranspileCache | None = None):
+    from builtins import compile as py_compile
+    curr_file = parent / filename
+    print(filename.relative_to(output_folder))
+    with timed('transpile'):
+        text = curr_file.read_text()
+        namespace = str(globals['ns'])
+        key = cache and cache.key(text, namespace)
+        cached = cache and cache.load(key)
+        code, code_obj = cached or (transpile(text, namespace), None)
 
     def print_code(file=sys.stdout):
         max_len = len(str(len(code)))
@@ -297,7 +585,14 @@ def comp_file(output_folder: Path, parent: Path, filename: Path, globals: dict[s
     old_path = sys.path[:]
     sys.path.insert(0, str(curr_file.parent))
     try:
-        exec(pyth, globals)
+        if code_obj is None:
+            with timed('transpile'):
+                code_obj = py_compile('\n'.join(code), '<string>', 'exec')
+                if cache:
+                    cache.store(key, code, code_obj)
+        with timed('exec'):
+            exec(code_obj, globals)
+        return code_obj
     except Exception as e:
         print('Error in:', filename, file=sys.stderr)
         print_code(sys.stderr)
@@ -306,59 +601,194 @@ def comp_file(output_folder: Path, parent: Path, filename: Path, globals: dict[s
         sys.path = old_path
 
 
-def comp_pack(output_folder: Path, pack_format: int, source: bool, verbose: bool, overlay=False):
-    function_tags: dict[str, list[str]] = {}
-    other: dict[str, dict[str, object]] = {}
-    for namespace in sorted((output_folder / 'data').iterdir()):
-        namespace: Path
-        func_files: dict[str, list[str]] = {'': []}
-        func_stack: list[str] = ['']
-        capturer_stack: list[str] = []
-
-        globals = build_globals(func_stack, capturer_stack, func_files, other, namespace.name, function_tags)
-        working_folder = (namespace / get_folder("source", pack_format))
-        if (not get_folder('source', pack_format).endswith('s') and
-                (namespace / 'sources').exists()):
-            raise ValueError('Legacy "sources" folder detected! Rename your folders to be singular!')
-
+class PackResult:
+    """ Functions, function tags, and other resources generated by PackScript files """
+    def __init__(self, func_files: dict[str, list[str]] | None = None, other: ResourceStore | None = None,
+                 function_tags: dict[str, list[str]] | None = None):
+        self.func_files = {} if func_files is None else func_files
+        self.other = ResourceStore() if other is None else other
+        self.function_tags = {} if function_tags is None else function_tags
+
+    def merge(self, result: 'PackResult') -> None:
+        """ Add a result that was generated independently, in the same order a serial build would have. Like in a serial
+        build, a function or resource generated again replaces the earlier one """
+        self.func_files.update(result.func_files)
+        for file_type, stuff in result.other.items():
+            self.other.table(file_type).update(stuff)
+        for tag, func_names in result.function_tags.items():
+            self.function_tags.setdefault(tag, []).extend(func_names)
+
+    def add_function_tags(self, pack_format: PF) -> None:
+        self.other.table(f'tags/{get_folder("function", pack_format)}').update(
+            {tag: {'values': func_names} for tag, func_names in self.function_tags.items()})
+
+
+def source_folder(namespace: Path, pack_format: PF) -> Path:
+    """ The folder with the PackScript sources of a namespace """
+    if (not get_folder('source', pack_format).endswith('s') and
+            (namespace / 'sources').exists()):
+        raise ValueError('Legacy "sources" folder detected! Rename your folders to be singular!')
+    return namespace / get_folder('source', pack_format)
+
+
+def comp_namespace(pack_folder: Path, namespace: Path, pack_format: PF, verbose: bool, overlay=False,
+                   cache: TranspileCache | None = None, other: ResourceStore | None = None,
+                   function_tags: dict | None = None, spool: 'FunctionSpool | None' = None) -> PackResult:
+    """ Run the sources of one namespace, sharing other and function_tags if given """
+    func_files: dict[str, list[str]] = {'': []}
+    func_stack: list[str] = ['']
+    capturer_stack: list[str] = []
+    result = PackResult(func_files, other, function_tags)
+
+    globals = build_globals(func_stack, capturer_stack, func_files, result.other, namespace.name, result.function_tags,
+                            spool)
+    working_folder = source_folder(namespace, pack_format)
+    base = pack_folder.parent if overlay else pack_folder
+    with profiled('namespace', namespace.relative_to(base).as_posix(), func_files, result.other):
         for filename in sorted(working_folder.rglob(f'*.{DATA_EXT}')):
-            base = output_folder.parent if overlay else output_folder
-            comp_file(base, working_folder, filename, globals, verbose=verbose)
-
-        if not source:
-            shutil.rmtree(namespace / get_folder('source', pack_format), ignore_errors=True)
-        func_files.pop('')
-        # Iterate through generated functions
-        for name, content in func_files.items():
-            func_dir = get_folder('function', pack_format)
-            mcfunction_path = output_folder / 'data' / f'{name.replace(":", f"/{func_dir}/")}.mcfunction'
+            with profiled('file', filename.relative_to(base).as_posix(), func_files, result.other):
+                comp_file(base, working_folder, filename, globals, verbose=verbose, cache=cache)
+    func_files.pop('')
+    return result
+
+
+def render_pack(pack_format: PF, result: PackResult) -> dict[str, Content | Path]:
+    """ Turn generated functions and resources into file contents, keyed by their path in the pack """
+    files: dict[str, Content | Path] = {}
+    # Iterate through generated functions
+    func_dir = get_folder('function', pack_format)
+    with timed('functions'):
+        for name, content in result.func_files.items():
             if not content:
                 continue
-            mcfunction_path.parent.mkdir(parents=True, exist_ok=True)
-            mcfunction_path.write_text(get_header() + '\n'.join(content) + '\n')
-
-        other.setdefault(f'tags/{get_folder("function", pack_format)}', {}).update(
-            {tag: {'values': func_names} for tag, func_names in function_tags.items()})
+            path = f'data/{name.replace(":", f"/{func_dir}/")}.mcfunction'
+            # functions streamed by --stream are already written, to the spool file their entry points to
+            files[path] = content if isinstance(content, Path) else get_header() + '\n'.join(content) + '\n'
 
-        # Write stuff in other
-        for file_type, stuff in other.items():
+    # Write stuff in other
+    with timed('other'):
+        for file_type, stuff in result.other.items():
             for name, content in stuff.items():
                 name = name.replace(':', f'/{file_type}/')
                 if '.' not in name:
                     name += '.json'
-                other_path = output_folder / 'data' / name
-                other_path.parent.mkdir(parents=True, exist_ok=True)
-                if isinstance(content, (dict, list)):
-                    content = json.dumps(content, indent=2, ensure_ascii=False, sort_keys=True)
-                if not isinstance(content, (str, bytes)):
+                # dicts and lists are turned into JSON when they are written, see to_bytes
+                if not isinstance(content, (str, bytes, dict, list)):
                     raise ValueError(f'Error: invalid content: {content!r}')
-                if isinstance(content, bytes):
-                    other_path.write_bytes(content)
-                else:
-                    other_path.write_text(content)
+                files[f'data/{name}'] = content
+    return files
 
 
-def compile(*, input: str, output: str, verbose: bool, source: bool, **_):
+LINT_RULES = {
+    'unbounded-selector': '@e without type, limit or distance checks every entity in loaded chunks',
+    'nested-as-e': 'execute as @e inside another execute as @e runs once per pair of entities',
+    'large-fill': 'fill of {volume} blocks',
+}
+INSTRUMENT_OBJECTIVE = 'packscript.calls'
+
+
+def comp_pack(pack_folder: Path, pack_format: int, verbose: bool, overlay=False, cache: TranspileCache | None = None,
+              state: 'BuildState | None' = None, executor=None,
+              spool: 'FunctionSpool | None' = None) -> dict[str, Content | Path]:
+    result = PackResult()
+    namespaces = sorted((pack_folder / 'data').iterdir())
+    if state is None and executor is not None:
+        from packscript_jobs import comp_namespace_tracked, job_result, saw_earlier, submit_job
+        # every namespace gets its own worker, the results are merged in the same order a serial build uses
+        jobs = [(namespace, submit_job(executor, comp_namespace_tracked, cache, spool, pack_folder, namespace,
+                                       pack_format, verbose, overlay, retry=True))
+                for namespace in namespaces]
+        for namespace, job in jobs:
+            tracked, output = job_result(job, cache)
+            ns_result, looked_at = tracked or (None, set())
+            if ns_result is None or saw_earlier(looked_at, result.other):
+                # it looked at resources (or function tags) of an earlier namespace, which its worker didn't have, so
+                # it runs again with them like in a serial build, and only what that prints is shown
+                ns_result = comp_namespace(pack_folder, namespace, pack_format, verbose, overlay, cache,
+                                           result.other, result.function_tags, spool)
+                result.func_files.update(ns_result.func_files)
+            else:
+                print(output, end='')
+                result.merge(ns_result)
+            result.add_function_tags(pack_format)
+        namespaces = []
+    for namespace in namespaces:
+        namespace: Path
+        if state is not None:
+            state.comp_namespace(pack_folder, namespace, pack_format, verbose, overlay, cache, result)
+            result.add_function_tags(pack_format)
+            continue
+        ns_result = comp_namespace(pack_folder, namespace, pack_format, verbose, overlay, cache,
+                                   result.other, result.function_tags, spool)
+        result.func_files.update(ns_result.func_files)
+        # later namespaces can see the function tags made so far
+        result.add_function_tags(pack_format)
+    result.add_function_tags(pack_format)
+    return render_pack(pack_format, result)
+
+
+def comp_fps(input_path: Path, verbose: bool, cache: TranspileCache | None = None,
+             spool: 'FunctionSpool | None' = None, files: list[Path] | None = None,
+             func_files: dict[str, list[str] | Path] | None = None) -> dict[str, list[str] | Path]:
+    """ Run the .fps files (all of them unless given), adding what they generate to func_files if given """
+    func_files = {} if func_files is None else func_files
+    for f in sorted(input_path.glob(f'*.{FUNC_EXT}')) if files is None else files:
+        func_stack = [f.name]
+        func_files[f.name] = []
+        globals = build_globals(func_stack, [], func_files, ResourceStore(), spool=spool)
+
+        with profiled('file', f.name, func_files):
+            comp_file(input_path, input_path, f, globals, verbose=verbose, cache=cache)
+        if spool and isinstance(content := func_files[func_stack[0]], list) and content:
+            func_files[func_stack[0]] = spool.put(content)
+    return func_files
+
+
+def compile(*, profile: bool = False, profile_top: int = 20, trace: str = '', profile_memory: bool = False,
+            stream: bool = False, jobs: int = 1, **options):
+    """ Compile a pack with compile_pack, profiling it and streaming its functions to disk if asked to """
+    global profiler
+    if stream and (profile or trace or profile_memory):
+        raise ValueError('--stream can not be combined with --profile, which counts the lines of every function')
+    if profile or trace or profile_memory:
+        if jobs != 1:
+            print('Profiling runs every source file in this process, ignoring --jobs', file=sys.stderr)
+            jobs = 1
+        from packscript_profile import Profiler
+        profiler = Profiler(memory=profile_memory)
+    spool = None
+    if stream:
+        if options.get('state') is not None:
+            raise ValueError('--stream can not be used while watching')
+        if options.get('minify'):
+            raise ValueError('--stream can not be combined with --minify, which needs every function in memory')
+        from packscript_jobs import FunctionSpool
+        spool = FunctionSpool.temporary(Path(options.get('output') or 'output').absolute())
+    try:
+        return compile_pack(jobs=jobs, spool=spool, **options)
+    finally:
+        if spool is not None:
+            spool.close(remove=True)
+        if profiler is not None:
+            print(profiler.summary(profile_top))
+            if trace:
+                profiler.write_trace(Path(trace))
+                print(f'Trace written to {trace}')
+            profiler.stop()
+            profiler = None
+
+
+def compile_pack(*, input: str, output: str, verbose: bool, source: bool, cache_dir: str = '',
+                 no_cache: bool = False, clear_cache: bool = False, cache_stats: bool = False, sync: bool = False,
+                 state: 'BuildState | None' = None, jobs: int = 1, compression_level: int | None = None,
+                 link: str = 'auto', spool: 'FunctionSpool | None' = None, minify: bool = False,
+                 tree_shake: bool = False, tree_shake_dry_run: bool = False, keep: list[str] = (),
+                 inline: bool = False, analyze: bool = False, analyze_json: str = '', tick_budget: int | None = None,
+                 lint: bool = False, lint_disable: list[str] = (), lint_fill_limit: int = 4096, instrument: bool = False,
+                 **_):
+    import json, shutil
+    from packscript_output import (FileLinker, ZipWriter, collect_static, minify_files, minify_report, sync_output,
+                                   write_tree)
     input_path: Path = Path(input or '.').absolute()
     has_datapack = (input_path / 'data').is_dir()
 
@@ -370,11 +800,23 @@ def compile(*, input: str, output: str, verbose: bool, source: bool, **_):
     if input_path == final_output_folder:
         raise shutil.SameFileError('Input and output directories must not have the same')
 
-    # Create a temporary directory for building
-    with tempfile.TemporaryDirectory() as temp_dir:
-        temp_output = Path(temp_dir) / final_output_folder.name
-        temp_output.mkdir(parents=True, exist_ok=True)
-
+    phase_times.clear()
+    cache = TranspileCache(Path(cache_dir).absolute() if cache_dir else input_path / CACHE_DIR)
+    if clear_cache:
+        cache.clear()
+    if no_cache:
+        cache = None
+
+    executor = None
+    if jobs != 1:
+        from concurrent.futures import ProcessPoolExecutor
+        from packscript_jobs import comp_fps_parallel, job_result, submit_job
+        executor = ProcessPoolExecutor(max_workers=jobs or None)
+
+    # Files copied from the input, and files generated by the build, keyed by their path in the output
+    static: dict[str, Path] = {}
+    files: dict[str, Content | Path] = {}
+    with executor or nullcontext():
         if has_datapack:
             data = input_path / 'data'
             if not data.exists() or not (input_path / 'pack.mcmeta').exists():
@@ -382,37 +824,13 @@ def compile(*, input: str, output: str, verbose: bool, source: bool, **_):
             if is_jar and not any((input_path / m).exists() for m in ('fabric.mod.json', 'mods.toml', 'neoforge.mods.toml')):
                 raise FileNotFoundError(f'Need "fabric.mod.json" and/or "mods.toml" and/or '
                                         f'"neoforge.mods.toml" Use {sys.argv[0]} init --modded')
-
-            def config(loc: str, *, dst='', mkdirs=False, dirs_exist_ok=False) -> bool:
-                type = 'dir' if loc.endswith('/') else 'file'
-                src = input_path / loc
-                dst = temp_output / (dst or loc)
-                if not (src.is_file() if type == 'file' else src.is_dir()):
-                    if src.exists():
-                        raise (IsADirectoryError if type == 'file' else NotADirectoryError)(loc)
-                    return False
-                if mkdirs:
-                    dst.parent.mkdir(parents=True, exist_ok=True)
-                if type == 'file':
-                    shutil.copy(src, dst)
-                else: # type == 'dir'
-                    shutil.copytree(src, dst, dirs_exist_ok=dirs_exist_ok, ignore=shutil.ignore_patterns(".DS_Store"))
-                return True
-
-            has_overlays = config('overlays/', dst='.', dirs_exist_ok=True)
-            config('data/')
-            config('pack.png')
-            if is_jar:
-                config('assets/')
-                config('fabric.mod.json')
-                config('mods.toml', dst='META-INF/mods.toml', mkdirs=True)
-                config('mods.toml', dst='META-INF/neoforge.mods.toml')
-                config('neoforge.mods.toml', dst='META-INF/neoforge.mods.toml', mkdirs=True)
             pack_meta = read_pack_meta(input_path)
             pack_format = pack_meta.get('pack', {}).get('pack_format')
             if not isinstance(pack_format, int):
                 raise ValueError('Invalid pack.mcmeta file, specify a target pack_format.')
-            comp_pack(temp_output, pack_format, source, verbose)
+            with timed('staging'):
+                static = collect_static(input_path, pack_format, is_jar, source)
+            has_overlays = (input_path / 'overlays').is_dir()
             if has_overlays:
                 registered_overlays = pack_meta.setdefault('overlays', {}).setdefault('entries', [])
                 overlay_re = re.compile(r'([pv]?[\d.]+)-([pv]?[\d.]+|future)')
@@ -435,206 +853,118 @@ def compile(*, input: str, output: str, verbose: bool, source: bool, **_):
                     if with_minor(pack_meta.get('pack', {}).get('min_format', 0)) >= (DECIMATED_PF, 0):
                         del overlay_value['formats']
                     registered_overlays.insert(0, overlay_value)
+            parallel_overlays = has_overlays and executor is not None and state is None
+            overlay_jobs = []
+            if parallel_overlays:
+                # overlays have their own globals and output folders, so they can run alongside the base pack
+                overlay_jobs = [(overlay['directory'], submit_job(
+                    executor, comp_pack, cache, spool, input_path / 'overlays' / overlay['directory'], pack_format,
+                    verbose, overlay=True)) for overlay in registered_overlays]
+            files.update(comp_pack(input_path, pack_format, verbose, cache=cache, state=state, executor=executor,
+                                   spool=spool))
+            for directory, job in overlay_jobs:
+                try:
+                    overlay_files, output = job_result(job, cache)
+                except Exception as e:
+                    e.add_note(f'while compiling overlay {directory!r}')
+                    raise
+                print(output, end='')
+                files.update({f'{directory}/{name}': content for name, content in overlay_files.items()})
+            if has_overlays and not parallel_overlays:
                 for overlay in registered_overlays:
-                    path = temp_output / overlay['directory']
-                    comp_pack(path, pack_format, source, verbose, overlay=True)
-            (temp_output / 'pack.mcmeta').write_text(json.dumps(pack_meta, indent=4))
-
-        func_files = {}
-        for f in sorted(input_path.glob(f'*.{FUNC_EXT}')):
-            func_stack = [f.name]
-            func_files[f.name] = []
-            globals = build_globals(func_stack, [], func_files, {})
-
-            comp_file(input_path, input_path, f, globals, verbose=verbose)
-        if func_files:
-            temp_output.mkdir(parents=True, exist_ok=True)
-        for f, content in func_files.items():
-            f = f[f.find(':') + 1:].replace('/', '_').removesuffix(f'.{FUNC_EXT}')
-            mcfunction_path = temp_output / f'{f}.mcfunction'
-            mcfunction_path.write_text(get_header() + '\n'.join(content) + '\n')
-        if not func_files and not has_datapack:
-            print("No datapack/func_files found!")
-            return
-
-        if is_zip or is_jar:
-            cwd = Path.cwd()
-            try:
-                chdir(temp_dir)
-                shutil.make_archive(temp_output.name, 'zip', temp_output.name)
-                if is_jar:
-                    zip_path = Path(temp_dir) / f"{temp_output.name}.zip"
-                    jar_path = final_output_folder.parent / f"{final_output_folder.name}.jar"
-                    shutil.copy(zip_path, jar_path)
-                else:
-                    zip_path = Path(temp_dir) / f"{temp_output.name}.zip"
-                    final_zip_path = final_output_folder.parent / f"{final_output_folder.name}.zip"
-                    shutil.copy(zip_path, final_zip_path)
-            finally:
-                chdir(cwd)
+                    path = input_path / 'overlays' / overlay['directory']
+                    try:
+                        with profiled('overlay', overlay['directory']):
+                            overlay_files = comp_pack(path, pack_format, verbose, overlay=True, cache=cache,
+                                                      state=state, spool=spool)
+                    except Exception as e:
+                        e.add_note(f'while compiling overlay {overlay["directory"]!r}')
+                        raise
+                    files.update({f'{overlay["directory"]}/{name}': content for name, content in overlay_files.items()})
+            files['pack.mcmeta'] = json.dumps(pack_meta, indent=4)
+
+        if state is not None:
+            func_files = state.comp_fps(input_path, verbose, cache)
+        elif executor is not None:
+            func_files = comp_fps_parallel(input_path, verbose, cache, executor, spool)
         else:
-            if final_output_folder.exists():
-                for item in final_output_folder.iterdir():
-                    if item.is_file() or item.is_symlink():
-                        item.unlink()
-                    else:
-                        shutil.rmtree(item)
-            else:
-                final_output_folder.mkdir(parents=True, exist_ok=True)
+            func_files = comp_fps(input_path, verbose, cache, spool)
+    if cache and cache_stats:
+        print(cache.stats())
+    with timed('functions'):
+        # .fps functions are all written next to each other, without their namespace
+        flattened: dict[str, str] = {}
+        for name, content in func_files.items():
+            f = name[name.find(':') + 1:].replace('/', '_').removesuffix(f'.{FUNC_EXT}')
+            if f in flattened:
+                raise ValueError(f'{flattened[f]!r} and {name!r} would both be written to {f}.mcfunction')
+            flattened[f] = name
+            files[f'{f}.mcfunction'] = content if isinstance(content, Path) else \
+                get_header() + '\n'.join(content) + '\n'
+    if not func_files and not has_datapack:
+        print("No datapack/func_files found!")
+        return
+    analyze = analyze or bool(analyze_json) or tick_budget is not None
+    if (inline or tree_shake or tree_shake_dry_run or analyze or lint or instrument) and spool is not None:
+        spool.wait()
+    if inline or tree_shake or tree_shake_dry_run or analyze or lint or instrument:
+        from packscript_analysis import (analyze_pack, analyze_report, inline_functions, inline_report,
+                                         instrument_files, lint_pack, shake_pack)
+    if inline:
+        with timed('inline'):
+            print(inline_report(*inline_functions(files, static, keep or ())))
+    if tree_shake or tree_shake_dry_run:
+        with timed('shake'):
+            print(shake_pack(files, static, keep or (), dry_run=tree_shake_dry_run))
+    if analyze:
+        with timed('analyze'):
+            analysis = analyze_pack(files, static)
+        print(analyze_report(analysis))
+        if analyze_json:
+            Path(analyze_json).write_text(json.dumps(analysis, indent=2) + '\n')
+        tick = analysis.get('#minecraft:tick', {}).get('commands', 0)
+        if tick_budget is not None and tick > tick_budget:
+            raise ValueError(f'#minecraft:tick runs {tick} commands, more than the budget of {tick_budget}')
+    if lint:
+        with timed('lint'):
+            warnings = lint_pack(files, static, lint_disable or (), lint_fill_limit)
+        print('\n'.join([f'Lint found {len(warnings)} problems in functions run every tick', *warnings]))
+    if instrument and has_datapack:
+        print(f'Instrumented {instrument_files(files, static, pack_format)} functions, run '
+              f'"/function packscript:instrument/dump" to see the most called ones')
+    if minify:
+        with timed('minify'):
+            print(minify_report(minify_files(files)))
+    if spool is not None:
+        spool.wait()
+        # streamed functions are moved into place from the spool, like static files are copied from the input
+        for name, content in list(files.items()):
+            if isinstance(content, Path):
+                static[name] = files.pop(name)
+
+    if is_zip or is_jar:
+        archive = final_output_folder.parent / f'{final_output_folder.name}{".jar" if is_jar else ".zip"}'
+        with timed('archive'), ZipWriter(archive, compression_level) as writer:
+            writer.write_pack(static, files)
+        if verbose or profiler is not None:
+            print(writer.report())
+        return
 
-            for item in temp_output.iterdir():
-                if item.is_file():
-                    shutil.copy2(item, final_output_folder / item.name)
+    linker = FileLinker(link, spool and spool.path)
+    with timed('write'):
+        if sync:
+            sync_output(final_output_folder, static, files, linker)
+            return
+        if final_output_folder.exists():
+            for item in final_output_folder.iterdir():
+                if item.is_file() or item.is_symlink():
+                    item.unlink()
                 else:
-                    shutil.copytree(item, final_output_folder / item.name, dirs_exist_ok=True)
-
-
-def init_modded_template(name: str, description: str, output: Path, namespace: str) -> None:
-    (output / 'fabric.mod.json').write_text(json.dumps({
-        "schemaVersion": 1,
-        "id": namespace,
-        "version": "1.0",
-        "name": name,
-        "description": description,
-        "authors": [],
-        "depends": {
-            "minecraft": "*",
-            "fabric-api": "*",
-        },
-        "icon": "pack.png",
-    }, indent=4, sort_keys=True))
-    (output / 'mods.toml').write_text(textwrap.dedent(f'''
-        # By default 'mods.toml' will be copied to 'neoforge.mods.toml' as well, 
-        # Create a separate 'neoforge.mods.toml' to override values here
-        modLoader="lowcodefml"
-        loaderVersion="[1,)"
-        license="All Rights Reserved"
-        showAsResourcePack=false
-        showAsDataPack=false
-
-        [[mods]]
-        modId="{namespace}"
-        version="1.0"
-        description="""{description}"""
-        logoFile="pack.png"
-        authors=""
-    '''.lstrip('\n')))
-
-
-def init_template(*, name: str, description: str, pack_format: PF, output: str, modded: bool | None, namespace: str, **_) -> None:
-    if modded and (Path(output or '.') / 'pack.mcmeta').is_file():
-        path = Path(output or '.')
-        meta = read_pack_meta(path)
-        description: str | None = description or meta.get('pack', {}).get('description')
-        if description is None:
-            description: str = input('Description ():')
-        namespaces = [d.name for d in (path / 'data').iterdir() if d.is_dir() and d.name != 'minecraft']
-        default_ns = namespaces and namespaces[0]
-        namespace = namespace or input(f'Namespace ({default_ns}): ') or str(default_ns)
-        def_name = path.parent.resolve().name
-        name = name or input(f'Name ({def_name}):') or def_name
-        init_modded_template(name, description, path, namespace)
-        return
-    if not all((name, description, pack_format, output, namespace)):
-        print('Leave a field empty to have it set to its default value')
-    name = name or input('Datapack Name (Datapack): ') or 'Datapack'
-    def_ns = re.sub(r'\W', '-', name.lower().replace(' ', '_'))
-    namespace = namespace or input(f'Namespace ({def_ns}): ') or def_ns
-    namespace = re.sub(r'\W', '-', namespace.lower().replace(' ', '_'))
-    if not namespace_re.fullmatch(namespace):
-        raise ValueError(f'Namespace must match regex: /{namespace_re.pattern}/ ({namespace} does not match)')
-    v = ''
-    while not pack_format:
-        v = input(f'Pack Format/Minecraft Version ({latest_mc_version}): ') or latest_mc_version
-        try:
-            pack_format = version_or_pf(v)
-        except ValueError:
-            print(f"You must provide a recognized mc version or a pack format, {v!r} is neither.")
-    v = v and f' for version {v}'
-    description = description or input(f'Description (Datapack {name!r}{v}): ') or \
-                  f'Datapack {name!r}{v}'
-    modded = modded if modded is not None else input('Add modded metadata for '
-                                                     'forge/fabric/neoforge? y/n (n): ')[:1].lower() == 'y'
-    output: str = output or input(f'Output Directory ({name.replace(" ", "_")}): ') or name.replace(' ', '_')
-    output: Path = Path(output).absolute()
-    if (output / 'data').exists() or (output / 'pack.mcmeta').exists():
-        raise ValueError('data or pack.mcmeta already present in this directory, '
-                         'remove them to generate the template, or specify a different directory.')
-    source = (output / 'data' / namespace / get_folder("source", pf=pack_format))
-    source.mkdir(parents=True, exist_ok=True)
-    (source / f'main.{DATA_EXT}').write_text(textwrap.dedent(f'''
-        /function tick [tick]:
-            /seed
-        /function load [load]:
-            /tellraw @a "Loaded {name}"
-    '''.lstrip('\n')))
-    major = major_pf(pack_format)
-    pack_meta = {
-        'pack': {
-            'pack_format': major,
-            'min_format': pack_format, 'max_format': pack_format,
-            'supported_formats': [major, major],
-            'description': description,
-        }
-    }
-    if major >= DECIMATED_PF:
-        del pack_meta['pack']['supported_formats']
-    (output / 'pack.mcmeta').write_text(json.dumps(pack_meta, indent=4, sort_keys=True))
-    if modded:
-        init_modded_template(name, description, output, namespace)
-
-
-# <editor-fold defaultstate="collapsed" desc="def update_pack_format(): ...">
-def update_pack_format(*, input: str, target: str, min: str, max: str, **_) -> None:
-    input: Path = Path(input or '.').absolute()
-    pack_meta = read_pack_meta(input)
-    pack_data = pack_meta.setdefault('pack', {})
-    target_pack_format = pack_data.get('pack_format')
-    if not isinstance(target_pack_format, int):
-        raise ValueError('Invalid pack.mcmeta file')
-    target_pack_format: int
-    min_pack_format, max_pack_format = None, None
-    match pack_data.get('supported_formats'):
-        case [min_pack_format, max_pack_format]: pass
-        case {'min_inclusive': min_pack_format, 'max_inclusive': max_pack_format}: pass
-
-    min_pack_format = pack_data.get('min_format', min_pack_format)
-    max_pack_format = pack_data.get('max_format', max_pack_format)
-
-    if target or min or max:
-        from builtins import min as min_f, max as max_f
-        target: PF = major_pf(version_or_pf(target, target_pack_format))
-        min: PF = min_f(with_minor(version_or_pf(min, min_pack_format)) or target, with_minor(target))
-        max: PF = max_f(with_minor(version_or_pf(max, max_pack_format)) or target, with_minor(target))
-        pack_data['min_format'] = min
-        pack_data['max_format'] = max
-        pack_data['supported_formats'] = [major_pf(min), major_pf(max)]
-        if major_pf(min) >= DECIMATED_PF:
-            del pack_data['supported_formats']
-        pack_data['pack_format'] = target
-        (input / 'pack.mcmeta').write_text(json.dumps(pack_meta, indent=4, sort_keys=True))
-    else:
-        min_pack_format: PF; max_pack_format: PF
-        target: PF; min: PF; max: PF
-        target, min, max = target_pack_format, min_pack_format, max_pack_format
-        print('edit these values via the --min, --target, or --max options')
-
-    def versions_of(pf: PF) -> str:
-        # be strict if pf is strict, otherwise be loose
-        func = major_pf if isinstance(pf, int) else with_minor
-        return f"({', '.join(key for key, value in pack_formats.items() if func(value) == func(pf))})"
-
-    isatty = sys.stdout.isatty()
-    def c(s: str) -> str:
-        """ color numbers in a string with ansi codes """
-        return re.sub(r'(\d+)', '\033[33m\\1\033[0m', s) if isatty else s
-
-    if max:
-        print(c(f"{'max pack_format:':<20}{max!s:>9} {versions_of(max)}"))
-    print(c(f"{'target pack_format:':<20}{target!s:>9} {versions_of(target)}"))
-    if min:
-        print(c(f"{'min pack_format:':<20}{min!s:>9} {versions_of(min)}"))
-# </editor-fold>
+                    shutil.rmtree(item)
+        writer = write_tree(final_output_folder, static, files, linker)
+    if verbose or profiler is not None:
+        print(writer.report())
+
 
 # <editor-fold defaultstate="collapsed" desc="def update(): ...">
 def get_data_from_url(url: str, max_redirects=10):
@@ -656,6 +986,7 @@ def get_data_from_url(url: str, max_redirects=10):
 
 
 def get_latest_version() -> str:
+    import json
     url = 'https://api.github.com/repos/Slackow/PackScript/releases/latest'
     response = get_data_from_url(url)
     if response.status == 200:
@@ -666,20 +997,34 @@ def get_latest_version() -> str:
         raise IOError(f'Could not get latest version \nstatus: {response.status}\nbody: {response.read()}')
 
 
-def replace_script_with_latest() -> None:
-    print("Updating PackScript...")
-    url = 'https://github.com/Slackow/PackScript/releases/latest/download/packscript.py'
+# the modules packscript imports once an action needs them, released and updated next to packscript.py
+MODULES = ('packscript_analysis', 'packscript_init', 'packscript_jobs', 'packscript_output', 'packscript_profile',
+           'packscript_serve', 'packscript_watch')
+
+
+def get_release_file(name: str, marker: bytes) -> bytes:
+    url = f'https://github.com/Slackow/PackScript/releases/latest/download/{name}'
     response = get_data_from_url(url)
     if response.status == 200:
         data = response.read()
-        if b'\n__version__ = ' in data:
-            Path(sys.argv[0]).write_bytes(data)
-            print("Done!")
-            return
+        if marker in data:
+            return data
         print(data, file=sys.stderr)
         raise ValueError("Bad data returned")
     else:
-        raise IOError(f'Could not get packscript.py \nstatus: {response.status}\nbody:{response.read()}')
+        raise IOError(f'Could not get {name} \nstatus: {response.status}\nbody:{response.read()}')
+
+
+def replace_script_with_latest() -> None:
+    print("Updating PackScript...")
+    script = Path(sys.argv[0])
+    # everything is downloaded before anything is written, so a failed download doesn't leave a mix of versions
+    files = {script: get_release_file('packscript.py', b'\n__version__ = ')}
+    for module in MODULES:
+        files[script.with_name(f'{module}.py')] = get_release_file(f'{module}.py', b'\nfrom packscript import ')
+    for path, data in files.items():
+        path.write_bytes(data)
+    print("Done!")
 
 
 def update() -> None:
@@ -703,6 +1048,11 @@ def update() -> None:
 
 
 def main():
+    if sys.argv[1:] in (['-V'], ['--version']):
+        # answered before the parsers are built, for tools that check the version often
+        print(f'PackScript {__version__}-{__v_type__}')
+        return
+    import argparse
     parser = argparse.ArgumentParser(
         description='This is a datapack compiler for Minecraft\n'
                     'Source: https://github.com/Slackow/packscript',
@@ -710,6 +1060,8 @@ def main():
         usage='packscript [-V | --version] [-h | --help] <command> [<args>]')
     parser.add_argument('-V', '--version', help='Print out the version', default=False, action='store_true')
     subparsers = parser.add_subparsers(dest='command', title='Commands', metavar='')
+    # only the command being run gets its arguments, the list of commands doesn't need them
+    command = next((arg for arg in sys.argv[1:] if not arg.startswith('-')), None)
 
     # "compile" command
     parser_compile = subparsers.add_parser('compile', aliases=['comp', 'c'],
@@ -719,12 +1071,131 @@ def main():
                                                        'Use this command to compile your datapack into a format that '
                                                        'Minecraft can read.',
                                            formatter_class=argparse.RawTextHelpFormatter)
-    parser_compile.add_argument('-o', '--output', type=str, help='Output directory/zip', default='output')
-    parser_compile.add_argument('-i', '--input', type=str, help='Input directory', default='.')
-    parser_compile.add_argument('-v', '--verbose', help='Print generated Python code.', default=False,
-                                action='store_true')
-    parser_compile.add_argument('-S', '--source', help='Include source files in output.', default=False,
-                                action='store_true')
+    # "watch" command
+    parser_watch = subparsers.add_parser('watch', aliases=['w'],
+                                         help='Compile the datapack, then recompile it whenever it changes.\n'
+                                              '"packscript watch --help" for more info',
+                                         description='Watch the datapack and recompile it on every change\n\n'
+                                                     'Only the namespaces, overlays and .fps files that changed are '
+                                                     'run again,\nand only changed output files are written.',
+                                         formatter_class=argparse.RawTextHelpFormatter)
+    compiling, watching = command in ('compile', 'comp', 'c'), command in ('watch', 'w')
+    if compiling:
+        # compile takes several -i/-o pairs to build many packs at once
+        parser_compile.add_argument('-o', '--output', type=str, action='append',
+                                    help='Output directory/zip (default: output), repeat with -i for more packs')
+        parser_compile.add_argument('-i', '--input', type=str, action='append',
+                                    help='Input directory (default: .), repeat with -o for more packs')
+    if watching:
+        parser_watch.add_argument('-o', '--output', type=str, help='Output directory/zip', default='output')
+        parser_watch.add_argument('-i', '--input', type=str, help='Input directory', default='.')
+    if compiling or watching:
+        # arguments both of them take
+        compile_parser = parser_compile if compiling else parser_watch
+        compile_parser.add_argument('-v', '--verbose', help='Print generated Python code.', default=False,
+                                    action='store_true')
+        compile_parser.add_argument('-S', '--source', help='Include source files in output.', default=False,
+                                    action='store_true')
+        compile_parser.add_argument('--link', choices=('auto', 'copy', 'reflink', 'hardlink'), default='auto',
+                                    help='How files are copied from the input to an output directory. auto and\n'
+                                         'reflink share data between copies when the filesystem supports it,\n'
+                                         'hardlink makes the output files the same files as the inputs.')
+        compile_parser.add_argument('--cache-dir', type=str, default='',
+                                    help=f'Transpile cache directory (default: <input>/{CACHE_DIR})')
+        compile_parser.add_argument('--no-cache', help='Do not read or write the transpile cache.', default=False,
+                                    action='store_true')
+        compile_parser.add_argument('--clear-cache', help='Empty the transpile cache before compiling.',
+                                    default=False, action='store_true')
+        compile_parser.add_argument('--cache-stats', help='Print transpile cache hits and misses.', default=False,
+                                    action='store_true')
+    if compiling:
+        parser_compile.add_argument('-j', '--jobs', type=int, default=1,
+                                    help='Run each namespace and root .fps file in up to this many worker processes\n'
+                                         '(0 uses every CPU). A namespace using dp resources of an earlier\n'
+                                         'namespace is run again afterwards, to see them. When building several\n'
+                                         'packs, this many packs are built at once instead.')
+        parser_compile.add_argument('--manifest', type=str, default='', metavar='FILE',
+                                    help='Build every pack listed in this JSON file, like\n'
+                                         '{"options": {"minify": true}, "packs": [{"input": "a", "output": "a.zip"}]}')
+        parser_compile.add_argument('--fail-fast', default=False, action='store_true',
+                                    help='Stop building the other packs as soon as one fails')
+        parser_compile.add_argument('--compression-level', type=int, default=None, choices=range(10), metavar='0-9',
+                                    help='Compression level of zip/jar outputs, 0 stores files uncompressed')
+        parser_compile.add_argument('--profile', default=False, action='store_true',
+                                    help='Print the time, output and phases of the slowest files, namespaces and\n'
+                                         'overlays after compiling.')
+        parser_compile.add_argument('--profile-top', type=int, default=20, metavar='N',
+                                    help='Rows of each --profile table (default: 20)')
+        parser_compile.add_argument('--profile-memory', default=False, action='store_true',
+                                    help='Also measure the peak memory of each file with tracemalloc (slow)')
+        parser_compile.add_argument('--trace', type=str, default='', metavar='FILE',
+                                    help='Write a Chrome trace of the build to FILE, for chrome://tracing or Perfetto')
+        parser_compile.add_argument('--minify', default=False, action='store_true',
+                                    help='Release mode: write compact JSON, leave out the header, blank and comment\n'
+                                         'lines of functions, and skip empty tags.')
+        parser_compile.add_argument('--tree-shake', default=False, action='store_true',
+                                    help='Leave out generated functions that no function tag, other resource, static\n'
+                                         'function or --keep pattern can reach through function and schedule calls.')
+        parser_compile.add_argument('--tree-shake-dry-run', default=False, action='store_true',
+                                    help='List the functions --tree-shake would leave out without removing them')
+        parser_compile.add_argument('--inline', default=False, action='store_true',
+                                    help='Replace calls of generated functions that run a single command with\n'
+                                         'that command when it is their only call, and calls of functions that\n'
+                                         'only run another function with a call of that function.')
+        parser_compile.add_argument('--analyze', default=False, action='store_true',
+                                    help='Print how many commands each function tag runs through all of its calls,\n'
+                                         'the deepest chain of calls, recursion, fan-out and the heaviest functions.')
+        parser_compile.add_argument('--analyze-json', type=str, default='', metavar='FILE',
+                                    help='Also write the --analyze report to FILE as JSON')
+        parser_compile.add_argument('--tick-budget', type=int, default=None, metavar='COMMANDS',
+                                    help='Fail if #minecraft:tick runs more than this many commands')
+        parser_compile.add_argument('--lint', default=False, action='store_true',
+                                    help='Warn about expensive commands in functions #minecraft:tick runs: @e without\n'
+                                         'type, limit or distance, nested execute as @e, and large fills. A comment\n'
+                                         'like "# packscript-lint: disable=large-fill" skips the next command.')
+        parser_compile.add_argument('--lint-disable', action='append', default=[], choices=LINT_RULES, metavar='RULE',
+                                    help=f'Turn a --lint rule off (repeatable): {", ".join(LINT_RULES)}')
+        parser_compile.add_argument('--lint-fill-limit', type=int, default=4096, metavar='BLOCKS',
+                                    help='Blocks a fill can change before --lint warns about it (default: 4096)')
+        parser_compile.add_argument('--instrument', default=False, action='store_true',
+                                    help='Profiling build: count the calls of every generated function on the\n'
+                                         f'{INSTRUMENT_OBJECTIVE} scoreboard, "/function packscript:instrument/dump"\n'
+                                         'shows the most called ones in game.')
+        parser_compile.add_argument('--keep', action='append', default=[], metavar='PATTERN',
+                                    help='Functions --tree-shake and --inline must keep, like ns:debug/*\n'
+                                         '(repeatable), for functions only run by hand or by other packs.')
+        parser_compile.add_argument('--stream', default=False, action='store_true',
+                                    help='Write each generated function to disk as soon as it is finished instead of\n'
+                                         'keeping every function in memory until the end of the build.')
+        parser_compile.add_argument('--sync', help='Only rewrite output files that changed, tracked by a manifest\n'
+                                                   'next to the output directory.', default=False, action='store_true')
+    if watching:
+        parser_watch.add_argument('--poll', help='Poll for changes instead of using inotify.', default=False,
+                                  action='store_true')
+        parser_watch.add_argument('--debounce', type=int, default=100,
+                                  help='Milliseconds to wait for more changes before rebuilding (default: 100)')
+        parser_watch.add_argument('--full', help='Rerun every source file on each change.', default=False,
+                                  action='store_true')
+
+    # "serve" command
+    parser_serve = subparsers.add_parser('serve', aliases=['s'],
+                                         help='Keep PackScript running and compile packs on request, for editors\n'
+                                              'and the reloader mod. "packscript serve --help" for more info',
+                                         description='Compile packs on request\n\n'
+                                                     'Each line sent to the server is a JSON request like\n'
+                                                     '{"id": 1, "cwd": "/path", "options": {"input": ".", "output": '
+                                                     '"output"}}\nwhere options are the compile options. Each one is '
+                                                     'answered with a line of JSON\nwith "ok", "seconds", "phases", '
+                                                     '"output" and on failure "error".',
+                                         formatter_class=argparse.RawTextHelpFormatter)
+    if command in ('serve', 's'):
+        parser_serve.add_argument('--socket', type=str, default='',
+                                  help='Unix socket to listen on (default: packscript-<uid>.sock in\n'
+                                       '$XDG_RUNTIME_DIR or the temporary directory), only this user can\n'
+                                       'connect to it')
+        parser_serve.add_argument('--host', type=str, help='Listen on TCP at this address instead, requests then need\n'
+                                                           'the token printed at startup (default: 127.0.0.1)')
+        parser_serve.add_argument('--port', type=int, help='Listen on TCP at this port instead (default: 7235)')
 
     # "init" command
     parser_init = subparsers.add_parser('init',
@@ -735,15 +1206,17 @@ def main():
                                                     'up a basic structure for your project. '
                                                     'Information can be provided in args or interactively.',
                                         formatter_class=argparse.RawTextHelpFormatter)
-    parser_init.add_argument('-o', '--output', type=str, help='Output directory', default='')
-    parser_init.add_argument('-N', '--name', type=str, help='Name of the datapack', default='')
-    parser_init.add_argument('-n', '--namespace', type=str, help='Custom namespace name', default='')
-    parser_init.add_argument('-d', '--description', type=str, help='The description of the datapack', default='')
-    parser_init.add_argument('-f', '--pack-format', type=int,
-                             help='Pack format (keeps track of compatible versions)', default=0)
-    parser_init.add_argument('-m', '--modded', help='Init modded config files, for fabric, forge, and neoforge',
-                             action='store_true', default=None)
-    parser_init.add_argument('--no-modded', action='store_false', dest='modded', help='Do not initialize any modded config files')
+    if command == 'init':
+        parser_init.add_argument('-o', '--output', type=str, help='Output directory', default='')
+        parser_init.add_argument('-N', '--name', type=str, help='Name of the datapack', default='')
+        parser_init.add_argument('-n', '--namespace', type=str, help='Custom namespace name', default='')
+        parser_init.add_argument('-d', '--description', type=str, help='The description of the datapack', default='')
+        parser_init.add_argument('-f', '--pack-format', type=int,
+                                 help='Pack format (keeps track of compatible versions)', default=0)
+        parser_init.add_argument('-m', '--modded', help='Init modded config files, for fabric, forge, and neoforge',
+                                 action='store_true', default=None)
+        parser_init.add_argument('--no-modded', action='store_false', dest='modded',
+                                 help='Do not initialize any modded config files')
 
     # "pack_format" command
     parser_pack_format = subparsers.add_parser('pack_format', aliases=['pf'],
@@ -752,10 +1225,11 @@ def main():
                                                     'and min/max must be within the range of target',
                                                description="Update or view your pack's supported pack format versions.",
                                                formatter_class=argparse.RawTextHelpFormatter)
-    parser_pack_format.add_argument('-i', '--input', type=str, help='Input directory', default='.')
-    parser_pack_format.add_argument('-t', '--target', type=str, help='Set the target pack_format', default='')
-    parser_pack_format.add_argument('-m', '--min', type=str, help='Set the minimum pack_format', default='')
-    parser_pack_format.add_argument('-M', '--max', type=str, help='Set the maximum pack_format', default='')
+    if command in ('pack_format', 'pf'):
+        parser_pack_format.add_argument('-i', '--input', type=str, help='Input directory', default='.')
+        parser_pack_format.add_argument('-t', '--target', type=str, help='Set the target pack_format', default='')
+        parser_pack_format.add_argument('-m', '--min', type=str, help='Set the minimum pack_format', default='')
+        parser_pack_format.add_argument('-M', '--max', type=str, help='Set the maximum pack_format', default='')
 
     # "update" command
     subparsers.add_parser('update', aliases=['u'],
@@ -771,12 +1245,31 @@ def main():
     elif args.command is None:
         parser.print_help()
     elif args.command.startswith('c'):
-        compile(**args_dict)
+        inputs, outputs = args_dict.pop('input') or [], args_dict.pop('output') or []
+        manifest, fail_fast = args_dict.pop('manifest'), args_dict.pop('fail_fast')
+        if len(inputs) > 1 or len(outputs) > 1 or manifest:
+            if len(inputs) != len(outputs):
+                parser_compile.error('give an -o for every -i when building several packs')
+            from packscript_serve import compile_batch, read_manifest
+            packs = read_manifest(Path(manifest)) if manifest else []
+            packs += [{'input': input, 'output': output} for input, output in zip(inputs, outputs)]
+            if not all(result['ok'] for result in compile_batch(packs=packs, fail_fast=fail_fast, **args_dict)):
+                sys.exit(1)
+        else:
+            compile(input=inputs[0] if inputs else '.', output=outputs[0] if outputs else 'output', **args_dict)
     elif args.command.startswith('p'):
+        from packscript_init import update_pack_format
         update_pack_format(**args_dict)
     elif args.command.startswith('u'):
         update()
+    elif args.command.startswith('w'):
+        from packscript_watch import watch
+        watch(**args_dict)
+    elif args.command.startswith('s'):
+        from packscript_serve import serve
+        serve(**args_dict)
     else:
+        from packscript_init import init_template
         try:
             init_template(**args_dict)
         except KeyboardInterrupt:
@@ -785,4 +1278,10 @@ def main():
 
 
 if __name__ == '__main__':
-    main()
+    try:
+        main()
+    except ModuleNotFoundError as e:
+        if e.name in MODULES:
+            e.add_note(f'{e.name}.py is part of PackScript, download it from '
+                       f'https://github.com/Slackow/PackScript/releases into {Path(__file__).parent}')
+        raise
@@ -0,0 +1,467 @@
+""" The passes over a compiled pack that follow its function calls: --tree-shake, --inline, --analyze, --lint and
+--instrument. packscript imports this only when one of them is asked for """
+import re
+from pathlib import Path
+
+from packscript import INSTRUMENT_OBJECTIVE, LINT_RULES, PF, Content, get_folder, get_header
+from packscript_output import to_bytes
+
+
+# function references in commands, including ones inside JSON text like run_command click events
+function_ref_re = re.compile(r'(?<![\w.-])function\s+(#?[\w.:/$()-]+)')
+macro_arg_re = re.compile(r'\$\([^)]*\)')
+# calls that run a function during the current tick, unlike schedule or a click event in JSON text
+run_call_re = re.compile(r'(?:^\$?|\s(?:run|if|unless)\s+)function\s+(#?[\w.:/$()-]+)')
+
+
+def resource_id(name: str, folders: tuple[str, ...], ext: str) -> str | None:
+    """ The namespaced id of a pack file in one of the folders (like function or tags/function), if it is one """
+    parts = name.removesuffix(ext).split('/')
+    if not name.endswith(ext) or 'data' not in parts[:2]:
+        return None
+    parts = parts[parts.index('data') + 1:]
+    for folder in folders:
+        depth = folder.count('/') + 1
+        if '/'.join(parts[1:1 + depth]) == folder and len(parts) > 1 + depth:
+            return f'{parts[0]}:{"/".join(parts[1 + depth:])}'
+    return None
+
+
+class CallGraph:
+    """ Which functions the functions, function tags and other resources of a rendered pack can run """
+
+    def __init__(self, files: dict[str, Content | Path], static: dict[str, Path]):
+        # generated functions, with their files in the base pack and overlays
+        self.generated: dict[str, list[str]] = {}
+        self.bodies: dict[str, list[str]] = {}
+        self.tags: dict[str, list] = {}
+        self.others: list = []
+        # the first reference with macro arguments that could run any function
+        self.dynamic: str | None = None
+        self.calls: dict[str, list[set[str]]] | None = None
+        for name, content in [*files.items(), *static.items()]:
+            if (func := resource_id(name, ('function', 'functions'), '.mcfunction')) is not None:
+                self.bodies.setdefault(func, []).append(self.text(content))
+                if name in files:
+                    self.generated.setdefault(func, []).append(name)
+            elif (tag := resource_id(name, ('tags/function', 'tags/functions'), '.json')) is not None:
+                value = self.json_value(content)
+                self.tags.setdefault(tag, []).extend(value.get('values', []) if isinstance(value, dict) else [])
+            elif name.endswith('.json') or name == 'pack.mcmeta':
+                self.others.append(self.json_value(content))
+        self.functions = set(self.bodies)
+
+    @staticmethod
+    def text(content: Content | Path) -> str:
+        return content.read_text() if isinstance(content, Path) else to_bytes(content).decode(errors='replace')
+
+    @classmethod
+    def json_value(cls, content: Content | Path):
+        import json
+        if isinstance(content, (dict, list)):
+            return content
+        try:
+            return json.loads(cls.text(content))
+        except ValueError:
+            return None
+
+    @staticmethod
+    def normal(ref: str) -> str:
+        tag = ref.startswith('#')
+        ref = ref.removeprefix('#')
+        return f'{"#" * tag}{ref if ":" in ref else f"minecraft:{ref}"}'
+
+    def targets(self, ref: str) -> set[str]:
+        """ The functions a reference can run, a reference with macro arguments can run any function it matches """
+        import fnmatch
+        ref = self.normal(ref)
+        if '$(' not in ref:
+            return {ref}
+        pattern = macro_arg_re.sub('*', ref)
+        if pattern.strip('#*:') == '' or pattern.split(':')[0].strip('#') == '*':
+            self.dynamic = self.dynamic or ref
+        return set(fnmatch.filter(self.functions, pattern)) | set(fnmatch.filter((f'#{tag}' for tag in self.tags),
+                                                                                 pattern))
+
+    def string_refs(self, value, found: set[str]) -> None:
+        """ Strings in JSON that are function ids, or commands that run one """
+        if isinstance(value, dict):
+            value = list(value.values())
+        if isinstance(value, list):
+            for item in value:
+                self.string_refs(item, found)
+        elif isinstance(value, str):
+            if (ref := self.normal(value)).removeprefix('#') in self.functions or ref.removeprefix('#') in self.tags:
+                found.add(ref)
+            for ref in function_ref_re.findall(value):
+                found |= self.targets(ref)
+
+    def members(self, tag: str) -> set[str]:
+        found: set[str] = set()
+        self.string_refs(self.tags.get(tag, []), found)
+        for entry in self.tags.get(tag, []):
+            if isinstance(entry, str):
+                found.add(self.normal(entry))
+            elif isinstance(entry, dict) and isinstance(entry.get('id'), str):
+                found.add(self.normal(entry['id']))
+        return found
+
+    def roots(self, keep: list[str] = ()) -> set[str]:
+        """ Tags, static functions, functions named by other resources and ones matching --keep, which can all be
+            run from outside the pack """
+        import fnmatch
+        roots = {f'#{tag}' for tag in self.tags} | (self.functions - self.generated.keys())
+        for value in self.others:
+            self.string_refs(value, roots)
+        for pattern in keep:
+            roots |= set(fnmatch.filter(self.functions, self.normal(pattern)))
+        return roots
+
+    @staticmethod
+    def commands(body: str) -> list[str]:
+        return [line.strip() for line in body.split('\n') if line.strip() and not line.lstrip().startswith('#')]
+
+    def run_calls(self) -> dict[str, list[set[str]]]:
+        """ The functions each call of a function or tag runs in the same tick, for every call in order """
+        if self.calls is None:
+            self.calls = {f'#{tag}': [{member} for member in self.members(tag)] for tag in self.tags}
+            for func, bodies in self.bodies.items():
+                # overlays can replace a function, use its longest version
+                body = max(bodies, key=lambda body: len(self.commands(body)))
+                self.calls[func] = [self.targets(ref) for line in self.commands(body)
+                                    for ref in run_call_re.findall(line)]
+        return self.calls
+
+    def run_reachable(self, node: str) -> set[str]:
+        """ The functions and tags a function or tag runs in the same tick, and itself """
+        calls = self.run_calls()
+        reached = {node}
+        pending = [node]
+        while pending:
+            for targets in calls.get(pending.pop(), ()):
+                pending.extend(targets - reached)
+                reached |= targets
+        return reached
+
+    def reachable(self, roots: set[str]) -> set[str]:
+        reached: set[str] = set()
+        pending = list(roots)
+        while pending:
+            node = pending.pop()
+            if node in reached:
+                continue
+            reached.add(node)
+            if node.startswith('#'):
+                pending.extend(self.members(node[1:]) - reached)
+                continue
+            for body in self.bodies.get(node, ()):
+                for ref in function_ref_re.findall(body):
+                    pending.extend(self.targets(ref) - reached)
+        return reached
+
+
+def shake_files(files: dict[str, Content | Path], static: dict[str, Path],
+                keep: list[str] = ()) -> tuple[set[str], set[str], str | None]:
+    """ Find generated functions that nothing can run, returns them, every generated function, and what was
+        kept because of a fully dynamic reference if there was one """
+    graph = CallGraph(files, static)
+    reached = graph.reachable(graph.roots(keep))
+    if graph.dynamic is not None:
+        return set(), set(graph.generated), graph.dynamic
+    return {func for func in graph.generated if func not in reached}, set(graph.generated), None
+
+
+def shake_pack(files: dict[str, Content | Path], static: dict[str, Path], keep: list[str] = (),
+               dry_run: bool = False) -> str:
+    """ Remove generated functions that nothing can run from files for --tree-shake, returns what it did """
+    unreachable, generated, dynamic = shake_files(files, static, keep)
+    if dynamic is not None:
+        return f'Tree shaking kept all {len(generated)} functions, {dynamic!r} can run any function'
+    if not dry_run:
+        for name in [name for name in files if resource_id(name, ('function', 'functions'), '.mcfunction')
+                     in unreachable]:
+            del files[name]
+    verb = 'would remove' if dry_run else 'removed'
+    return '\n'.join([f'Tree shaking {verb} {len(unreachable)} of {len(generated)} functions'
+                      + (':' if unreachable else ''), *(f'  {func}' for func in sorted(unreachable))])
+
+
+# a line that runs one function, directly or at the end of an execute, without storing its result
+call_site_re = re.compile(r'(?:(execute\s.*\s)run\s+)?function\s+([\w.:/-]+)')
+forward_re = re.compile(r'function\s+([\w.:/-]+)(?:\s+with\s.*)?')
+returns_re = re.compile(r'(?:^|\srun\s+)return\b')
+
+
+def inline_functions(files: dict[str, Content | Path], static: dict[str, Path],
+                     keep: list[str] = ()) -> tuple[int, set[str]]:
+    """ Inline generated functions of one command into their only call site, and point calls of functions that just
+        run another function at that function, for --inline. Returns how many calls were removed and the functions
+        nothing calls any more, which are removed from files """
+    graph = CallGraph(files, static)
+    # functions run by anything other than a generated function can't be removed, but calls to them can be changed
+    pinned = graph.roots(keep)
+    for tag in graph.tags:
+        pinned |= graph.members(tag)
+    for func, bodies in graph.bodies.items():
+        for ref in (ref for body in bodies for ref in function_ref_re.findall(body)):
+            if func not in graph.generated or '$(' in ref:
+                pinned |= graph.targets(ref)
+    lines = {name: graph.text(files[name]).split('\n') for names in graph.generated.values() for name in names}
+    calls: dict[str, int] = {}
+    for body in lines.values():
+        for ref in (ref for line in body for ref in function_ref_re.findall(line)):
+            calls[graph.normal(ref)] = calls.get(graph.normal(ref), 0) + 1
+    called = {func for func, count in calls.items() if count}
+
+    def command(func: str) -> str | None:
+        """ The only command of a generated function that can run in place of calling it """
+        if func not in graph.generated or len(graph.bodies[func]) != 1:
+            return None
+        commands = [line.strip() for line in lines[graph.generated[func][0]]
+                    if line.strip() and not line.lstrip().startswith('#')]
+        if len(commands) != 1 or commands[0].startswith('$') or returns_re.search(commands[0]):
+            return None
+        return commands[0]
+
+    def forwards(func: str, seen: set[str]) -> bool:
+        """ Whether the function only runs another function, without ending up back where it started """
+        if func in seen or (body := command(func)) is None or not (match := forward_re.fullmatch(body)):
+            return False
+        target = graph.normal(match[1])
+        return command(target) is None or not forward_re.fullmatch(command(target)) or forwards(target, seen | {func})
+
+    removed_calls = 0
+    changed = set()
+    progress = True
+    while progress:
+        progress = False
+        for name, body in lines.items():
+            caller = resource_id(name, ('function', 'functions'), '.mcfunction')
+            for i, line in enumerate(body):
+                match = call_site_re.fullmatch(line.strip())
+                if not match or line.startswith('$') or re.search(r'\bstore\s', match[1] or ''):
+                    continue
+                callee = graph.normal(match[2])
+                if callee == caller or (inlined := command(callee)) is None:
+                    continue
+                if not forwards(callee, set()) and (calls.get(callee) != 1 or callee in pinned):
+                    continue
+                new = line[:len(line) - len(line.lstrip())] + (f'{match[1]}run ' if match[1] else '') + inlined
+                for ref in function_ref_re.findall(line):
+                    calls[graph.normal(ref)] -= 1
+                for ref in function_ref_re.findall(new):
+                    calls[graph.normal(ref)] = calls.get(graph.normal(ref), 0) + 1
+                body[i] = new
+                removed_calls += 1
+                changed.add(name)
+                progress = True
+    unused = {func for func in called if not calls[func] and func not in pinned and func in graph.generated}
+    for func in unused:
+        for name in graph.generated[func]:
+            del files[name]
+    for name in changed:
+        if name in files:
+            files[name] = '\n'.join(lines[name])
+    return removed_calls, unused
+
+
+def inline_report(removed_calls: int, unused: set[str]) -> str:
+    return f'Inlining removed {removed_calls} function calls and {len(unused)} functions'
+
+
+def analyze_pack(files: dict[str, Content | Path], static: dict[str, Path], top: int = 5) -> dict:
+    """ Estimate the work each function tag does for --analyze: the commands run through every call (counting
+        recursive calls once), the deepest chain of calls, the recursion cycles, the function calling the most
+        different functions and the most expensive functions under it """
+    graph = CallGraph(files, static)
+    calls = graph.run_calls()
+    own = {func: max(len(graph.commands(body)) for body in bodies) for func, bodies in graph.bodies.items()}
+
+    costs: dict[str, tuple[int, int]] = {}
+    stack: list[str] = []
+    cycles: list[list[str]] = []
+
+    def cost(node: str) -> tuple[int, int]:
+        """ Commands run and call depth of a function or tag """
+        if node in costs:
+            return costs[node]
+        if node in stack:
+            cycles.append(stack[stack.index(node):] + [node])
+            return 0, 0
+        stack.append(node)
+        total, depth = own.get(node, 0), 0
+        for targets in calls.get(node, ()):
+            # a call with macro arguments runs one of the functions it could match, count the most expensive one
+            target_costs = [cost(target) for target in sorted(targets)]
+            total += max((commands for commands, _ in target_costs), default=0)
+            depth = max([depth, *(depth for _, depth in target_costs)])
+        stack.pop()
+        costs[node] = total, depth + (not node.startswith('#'))
+        return costs[node]
+
+    report = {}
+    for tag in sorted(graph.tags, key=lambda tag: (tag not in ('minecraft:tick', 'minecraft:load'), tag)):
+        total, depth = cost(f'#{tag}')
+        reached = sorted(func for func in graph.run_reachable(f'#{tag}') if not func.startswith('#'))
+        fan_out = {func: len(set().union(*calls.get(func, ()))) for func in reached}
+        widest = max(reached, key=lambda func: fan_out[func], default=None)
+        heaviest = sorted(reached, key=lambda func: -costs.get(func, (0, 0))[0])[:top]
+        report[f'#{tag}'] = {
+            'commands': total,
+            'functions': len(reached),
+            'depth': depth,
+            'fan_out': {'function': widest, 'calls': fan_out[widest]} if widest else None,
+            'cycles': [' -> '.join(cycle) for cycle in cycles if cycle[0] in reached],
+            'heaviest': {func: costs.get(func, (0, 0))[0] for func in heaviest},
+        }
+    return report
+
+
+def analyze_report(report: dict) -> str:
+    """ The --analyze table """
+    if not report:
+        return 'No function tags to analyze'
+    rows = [('tag', 'commands', 'functions', 'depth', 'fan-out', 'cycles')]
+    for tag, entry in report.items():
+        fan_out = entry['fan_out']
+        rows.append((tag, entry['commands'], entry['functions'], entry['depth'],
+                     f'{fan_out["calls"]} ({fan_out["function"]})' if fan_out else '-', len(entry['cycles'])))
+    widths = [max(len(str(row[i])) for row in rows) for i in range(len(rows[0]))]
+    lines = ['  '.join(f'{value:<{width}}' if i in (0, 4) else f'{value:>{width}}'
+                       for i, (value, width) in enumerate(zip(row, widths))).rstrip() for row in rows]
+    for tag, entry in report.items():
+        if entry['heaviest'] or entry['cycles']:
+            lines.append(f'{tag}:')
+        lines.extend(f'  {commands:>8}  {func}' for func, commands in entry['heaviest'].items())
+        lines.extend(f'  recursion: {cycle}' for cycle in entry['cycles'])
+    return '\n'.join(lines)
+
+
+lint_disable_re = re.compile(r'#\s*packscript-lint:\s*disable(?:=([\w,\s-]+))?')
+lint_fill_re = re.compile(r'(?:^\$?|\srun\s+)fill' + r'\s+(\S+)' * 6)
+as_entities_re = re.compile(r'\bas\s+@e(?!\w)')
+coordinate_re = re.compile(r'([~^]?)(-?(?:\d+\.?\d*|\.\d+)?)')
+
+
+def selector_args(command: str, start: int) -> dict[str, str]:
+    """ The arguments of the selector ending at start, like {'type': 'minecraft:pig'} for @e[type=minecraft:pig] """
+    if command[start:start + 1] != '[':
+        return {}
+    args = {}
+    depth = 0
+    quote = None
+    arg_start = start + 1
+    for i in range(start, len(command)):
+        char = command[i]
+        if quote:
+            quote = None if char == quote and command[i - 1] != '\\' else quote
+        elif char in '"\'':
+            quote = char
+        elif char in '[{':
+            depth += 1
+        elif depth == 1 and char in ',]}':
+            key, _, value = command[arg_start:i].partition('=')
+            if key.strip():
+                args.setdefault(key.strip(), value.strip())
+            arg_start = i + 1
+            if char != ',':
+                break
+        elif char in ']}':
+            depth -= 1
+    return args
+
+
+def lint_command(command: str, calls_as_entities, fill_limit: int) -> list[tuple[str, str]]:
+    """ The rules a command breaks, with what is wrong """
+    problems = []
+    if '@e' in command:
+        for match in re.finditer(r'@e(?!\w)', command):
+            args = selector_args(command, match.end())
+            if not any(key in args and not args[key].startswith('!')
+                       for key in ('type', 'limit', 'distance', 'dx', 'dy', 'dz')):
+                problems.append(('unbounded-selector', LINT_RULES['unbounded-selector']))
+                break
+        as_entities = [match for match in as_entities_re.finditer(command)
+                       if 'limit' not in selector_args(command, match.end())]
+        if len(as_entities) > 1 or as_entities and calls_as_entities(command):
+            problems.append(('nested-as-e', LINT_RULES['nested-as-e']))
+    if 'fill' in command and (match := lint_fill_re.search(command)):
+        corners = [coordinate_re.fullmatch(token) for token in match.groups()]
+        if all(corners) and all(corners[axis][1] == corners[axis + 3][1] for axis in range(3)):
+            volume = 1
+            for axis in range(3):
+                volume *= abs(int(float(corners[axis][2] or 0)) - int(float(corners[axis + 3][2] or 0))) + 1
+            if volume > fill_limit:
+                problems.append(('large-fill', LINT_RULES['large-fill'].format(volume=volume)))
+    return problems
+
+
+def lint_pack(files: dict[str, Content | Path], static: dict[str, Path], disabled: list[str] = (),
+              fill_limit: int = 4096) -> list[str]:
+    """ Find expensive commands in the functions #minecraft:tick runs for --lint. A comment line like
+        # packscript-lint: disable=large-fill turns rules off for the command after it """
+    graph = CallGraph(files, static)
+    has_as_entities: dict[str, bool] = {}
+
+    def runs_as_entities(func: str) -> bool:
+        """ Whether a function has an execute as @e without a limit itself """
+        if func not in has_as_entities:
+            has_as_entities[func] = any('limit' not in selector_args(command, match.end())
+                                        for body in graph.bodies.get(func, ()) for command in graph.commands(body)
+                                        for match in as_entities_re.finditer(command))
+        return has_as_entities[func]
+
+    def calls_as_entities(command: str) -> bool:
+        return any(runs_as_entities(target) for ref in run_call_re.findall(command) for target in graph.targets(ref))
+
+    warnings = []
+    for func in sorted(graph.run_reachable('#minecraft:tick')):
+        for body in graph.bodies.get(func, ()):
+            suppressed: set[str] = set()
+            for number, line in enumerate(body.split('\n'), 1):
+                command = line.strip()
+                if not command:
+                    continue
+                if command.startswith('#'):
+                    if match := lint_disable_re.match(command):
+                        suppressed |= {rule.strip() for rule in match[1].split(',')} if match[1] else {'all'}
+                    continue
+                if '@e' in command or 'fill' in command:
+                    for rule, problem in lint_command(command, calls_as_entities, fill_limit):
+                        if rule not in disabled and rule not in suppressed and 'all' not in suppressed:
+                            warnings.append(f'{func}:{number}: {rule}: {problem}\n    {command}')
+                suppressed = set()
+    return warnings
+
+
+def instrument_files(files: dict[str, Content | Path], static: dict[str, Path], pack_format: PF) -> int:
+    """ Count every call of each generated function on a scoreboard for --instrument, adding packscript:instrument
+        functions to set it up on load, show the most called functions and reset the counts. Returns how many
+        functions were instrumented """
+    func_dir = get_folder('function', pack_format)
+    header = get_header()
+    instrumented = 0
+    for name, content in files.items():
+        if (func := resource_id(name, ('function', 'functions'), '.mcfunction')) is None:
+            continue
+        text = CallGraph.text(content)
+        count = f'scoreboard players add {func} {INSTRUMENT_OBJECTIVE} 1\n'
+        files[name] = header + count + text.removeprefix(header) if text.startswith(header) else count + text
+        instrumented += 1
+
+    functions = {
+        'load': [f'scoreboard objectives add {INSTRUMENT_OBJECTIVE} dummy "Function calls"'],
+        'dump': [f'scoreboard objectives setdisplay sidebar {INSTRUMENT_OBJECTIVE}',
+                 'tellraw @s {"text":"The most called functions are on the sidebar","color":"gold"}'],
+        'reset': [f'scoreboard players reset * {INSTRUMENT_OBJECTIVE}'],
+    }
+    for function, lines in functions.items():
+        files[f'data/packscript/{func_dir}/instrument/{function}.mcfunction'] = header + '\n'.join(lines) + '\n'
+    # set the objective up on load, before whatever the pack's own load tag runs
+    load = f'data/minecraft/tags/{func_dir}/load.json'
+    tag = CallGraph.json_value(files[load] if load in files else static.pop(load)) \
+        if load in files or load in static else None
+    tag = tag if isinstance(tag, dict) else {'values': []}
+    tag['values'] = ['packscript:instrument/load', *tag.get('values', [])]
+    files[load] = tag
+    return instrumented
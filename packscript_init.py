@@ -0,0 +1,158 @@
+""" The init and pack_format commands, which set up a new pack and change the versions an existing one supports.
+packscript imports this only when one of them is run """
+import re, sys
+from pathlib import Path
+
+from packscript import (DATA_EXT, DECIMATED_PF, PF, get_folder, latest_mc_version, major_pf, namespace_re, pack_formats,
+                        read_pack_meta, version_or_pf, with_minor)
+
+
+def init_modded_template(name: str, description: str, output: Path, namespace: str) -> None:
+    import json, textwrap
+    (output / 'fabric.mod.json').write_text(json.dumps({
+        "schemaVersion": 1,
+        "id": namespace,
+        "version": "1.0",
+        "name": name,
+        "description": description,
+        "authors": [],
+        "depends": {
+            "minecraft": "*",
+            "fabric-api": "*",
+        },
+        "icon": "pack.png",
+    }, indent=4, sort_keys=True))
+    (output / 'mods.toml').write_text(textwrap.dedent(f'''
+        # By default 'mods.toml' will be copied to 'neoforge.mods.toml' as well, 
+        # Create a separate 'neoforge.mods.toml' to override values here
+        modLoader="lowcodefml"
+        loaderVersion="[1,)"
+        license="All Rights Reserved"
+        showAsResourcePack=false
+        showAsDataPack=false
+
+        [[mods]]
+        modId="{namespace}"
+        version="1.0"
+        description="""{description}"""
+        logoFile="pack.png"
+        authors=""
+    '''.lstrip('\n')))
+
+
+def init_template(*, name: str, description: str, pack_format: PF, output: str, modded: bool | None, namespace: str, **_) -> None:
+    import json, textwrap
+    if modded and (Path(output or '.') / 'pack.mcmeta').is_file():
+        path = Path(output or '.')
+        meta = read_pack_meta(path)
+        description: str | None = description or meta.get('pack', {}).get('description')
+        if description is None:
+            description: str = input('Description ():')
+        namespaces = [d.name for d in (path / 'data').iterdir() if d.is_dir() and d.name != 'minecraft']
+        default_ns = namespaces and namespaces[0]
+        namespace = namespace or input(f'Namespace ({default_ns}): ') or str(default_ns)
+        def_name = path.parent.resolve().name
+        name = name or input(f'Name ({def_name}):') or def_name
+        init_modded_template(name, description, path, namespace)
+        return
+    if not all((name, description, pack_format, output, namespace)):
+        print('Leave a field empty to have it set to its default value')
+    name = name or input('Datapack Name (Datapack): ') or 'Datapack'
+    def_ns = re.sub(r'\W', '-', name.lower().replace(' ', '_'))
+    namespace = namespace or input(f'Namespace ({def_ns}): ') or def_ns
+    namespace = re.sub(r'\W', '-', namespace.lower().replace(' ', '_'))
+    if not namespace_re.fullmatch(namespace):
+        raise ValueError(f'Namespace must match regex: /{namespace_re.pattern}/ ({namespace} does not match)')
+    v = ''
+    while not pack_format:
+        v = input(f'Pack Format/Minecraft Version ({latest_mc_version}): ') or latest_mc_version
+        try:
+            pack_format = version_or_pf(v)
+        except ValueError:
+            print(f"You must provide a recognized mc version or a pack format, {v!r} is neither.")
+    v = v and f' for version {v}'
+    description = description or input(f'Description (Datapack {name!r}{v}): ') or \
+                  f'Datapack {name!r}{v}'
+    modded = modded if modded is not None else input('Add modded metadata for '
+                                                     'forge/fabric/neoforge? y/n (n): ')[:1].lower() == 'y'
+    output: str = output or input(f'Output Directory ({name.replace(" ", "_")}): ') or name.replace(' ', '_')
+    output: Path = Path(output).absolute()
+    if (output / 'data').exists() or (output / 'pack.mcmeta').exists():
+        raise ValueError('data or pack.mcmeta already present in this directory, '
+                         'remove them to generate the template, or specify a different directory.')
+    source = (output / 'data' / namespace / get_folder("source", pf=pack_format))
+    source.mkdir(parents=True, exist_ok=True)
+    (source / f'main.{DATA_EXT}').write_text(textwrap.dedent(f'''
+        /function tick [tick]:
+            /seed
+        /function load [load]:
+            /tellraw @a "Loaded {name}"
+    '''.lstrip('\n')))
+    major = major_pf(pack_format)
+    pack_meta = {
+        'pack': {
+            'pack_format': major,
+            'min_format': pack_format, 'max_format': pack_format,
+            'supported_formats': [major, major],
+            'description': description,
+        }
+    }
+    if major >= DECIMATED_PF:
+        del pack_meta['pack']['supported_formats']
+    (output / 'pack.mcmeta').write_text(json.dumps(pack_meta, indent=4, sort_keys=True))
+    if modded:
+        init_modded_template(name, description, output, namespace)
+
+
+# <editor-fold defaultstate="collapsed" desc="def update_pack_format(): ...">
+def update_pack_format(*, input: str, target: str, min: str, max: str, **_) -> None:
+    import json
+    input: Path = Path(input or '.').absolute()
+    pack_meta = read_pack_meta(input)
+    pack_data = pack_meta.setdefault('pack', {})
+    target_pack_format = pack_data.get('pack_format')
+    if not isinstance(target_pack_format, int):
+        raise ValueError('Invalid pack.mcmeta file')
+    target_pack_format: int
+    min_pack_format, max_pack_format = None, None
+    match pack_data.get('supported_formats'):
+        case [min_pack_format, max_pack_format]: pass
+        case {'min_inclusive': min_pack_format, 'max_inclusive': max_pack_format}: pass
+
+    min_pack_format = pack_data.get('min_format', min_pack_format)
+    max_pack_format = pack_data.get('max_format', max_pack_format)
+
+    if target or min or max:
+        from builtins import min as min_f, max as max_f
+        target: PF = major_pf(version_or_pf(target, target_pack_format))
+        min: PF = min_f(with_minor(version_or_pf(min, min_pack_format)) or target, with_minor(target))
+        max: PF = max_f(with_minor(version_or_pf(max, max_pack_format)) or target, with_minor(target))
+        pack_data['min_format'] = min
+        pack_data['max_format'] = max
+        pack_data['supported_formats'] = [major_pf(min), major_pf(max)]
+        if major_pf(min) >= DECIMATED_PF:
+            del pack_data['supported_formats']
+        pack_data['pack_format'] = target
+        (input / 'pack.mcmeta').write_text(json.dumps(pack_meta, indent=4, sort_keys=True))
+    else:
+        min_pack_format: PF; max_pack_format: PF
+        target: PF; min: PF; max: PF
+        target, min, max = target_pack_format, min_pack_format, max_pack_format
+        print('edit these values via the --min, --target, or --max options')
+
+    def versions_of(pf: PF) -> str:
+        # be strict if pf is strict, otherwise be loose
+        func = major_pf if isinstance(pf, int) else with_minor
+        return f"({', '.join(key for key, value in pack_formats.items() if func(value) == func(pf))})"
+
+    isatty = sys.stdout.isatty()
+    def c(s: str) -> str:
+        """ color numbers in a string with ansi codes """
+        return re.sub(r'(\d+)', '\033[33m\\1\033[0m', s) if isatty else s
+
+    if max:
+        print(c(f"{'max pack_format:':<20}{max!s:>9} {versions_of(max)}"))
+    print(c(f"{'target pack_format:':<20}{target!s:>9} {versions_of(target)}"))
+    if min:
+        print(c(f"{'min pack_format:':<20}{min!s:>9} {versions_of(min)}"))
+# </editor-fold>
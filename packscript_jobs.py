@@ -0,0 +1,188 @@
+""" Running namespaces, overlays and .fps files in worker processes for --jobs, and spooling finished functions to
+disk for --stream. packscript imports this only when one of them is used """
+import sys
+from pathlib import Path
+
+from packscript import (FUNC_EXT, PF, PackResult, ResourceStore, TranspileCache, comp_fps, comp_namespace, get_header,
+                        ns)
+
+
+class TrackedResourceStore(ResourceStore):
+    """ A ResourceStore that remembers which types of resources were looked at (reads), used (uses) and added to
+    through table() (tables), which doesn't depend on what is already there """
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.reads: set[str] = set()
+        self.uses: set[str] = set()
+        self.tables: set[str] = set()
+
+    def __contains__(self, type: str) -> bool:
+        self.reads.add(type)
+        return super().__contains__(type)
+
+    # the resources themselves can be changed in place, so getting a type counts as using it
+    def __getitem__(self, type: str) -> dict[str, object]:
+        self.uses.add(type)
+        return super().__getitem__(type)
+
+    def get(self, type: str, default=None):
+        self.uses.add(type)
+        return super().get(type, default)
+
+    def setdefault(self, type: str, default=None):
+        self.tables.add(type)
+        return super().setdefault(type, default)
+
+    def __iter__(self):
+        self.uses.add('*')
+        return super().__iter__()
+
+    def keys(self):
+        self.uses.add('*')
+        return super().keys()
+
+    def values(self):
+        self.uses.add('*')
+        return super().values()
+
+    def items(self):
+        self.uses.add('*')
+        return super().items()
+
+
+class FunctionSpool:
+    """ Writes finished functions to a folder from a background thread, so their lines don't stay in memory """
+    def __init__(self, path: Path):
+        import queue, threading, uuid
+        self.path = path
+        # worker processes share the folder, and a worker makes a new spool for every job it runs
+        self.prefix = uuid.uuid4().hex
+        self.count = 0
+        self.error: BaseException | None = None
+        # bounded, so a slow disk holds up the build instead of letting the queued functions pile up
+        self.queue = queue.Queue(maxsize=64)
+        self.thread = threading.Thread(target=self.run, name='packscript-spool', daemon=True)
+        self.thread.start()
+
+    @classmethod
+    def temporary(cls, near: Path) -> 'FunctionSpool':
+        """ A spool in a new folder next to near, on the same filesystem so spooled files can be moved into place """
+        import tempfile
+        near.parent.mkdir(parents=True, exist_ok=True)
+        return cls(Path(tempfile.mkdtemp(dir=near.parent, prefix=f'.{near.name}.', suffix='.spool')))
+
+    def run(self) -> None:
+        while (item := self.queue.get()) is not None:
+            path, content = item
+            try:
+                if self.error is None:
+                    path.write_bytes((get_header() + '\n'.join(content) + '\n').encode())
+            except BaseException as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+        self.queue.task_done()
+
+    def put(self, content: list[str]) -> Path:
+        """ Queue a function to be written, returning the file it will be in """
+        self.count += 1
+        path = self.path / f'{self.prefix}-{self.count}.mcfunction'
+        self.queue.put((path, content))
+        return path
+
+    def wait(self) -> None:
+        """ Wait for every queued function to be written """
+        self.queue.join()
+        if self.error is not None:
+            raise self.error
+
+    def read(self, path: Path) -> list[str]:
+        """ The lines of a spooled function, so it can be added to again """
+        self.wait()
+        return path.read_text().removeprefix(get_header()).removesuffix('\n').split('\n')
+
+    def close(self, remove: bool = False) -> None:
+        import shutil
+        self.queue.put(None)
+        self.thread.join()
+        if remove:
+            shutil.rmtree(self.path, ignore_errors=True)
+
+
+def comp_namespace_tracked(pack_folder: Path, namespace: Path, pack_format: PF, verbose: bool, overlay: bool,
+                           cache: TranspileCache | None = None,
+                           spool: FunctionSpool | None = None) -> tuple[PackResult, set[str]]:
+    """ comp_namespace with resources of its own, also returns the types of resources it looked at """
+    other = TrackedResourceStore()
+    result = comp_namespace(pack_folder, namespace, pack_format, verbose, overlay, cache, other, spool=spool)
+    return result, other.reads | other.uses
+
+
+def saw_earlier(looked_at: set[str], earlier) -> bool:
+    """ If a namespace that looked at these types of resources would have seen some of the earlier namespaces' """
+    return any(type in earlier for type in looked_at) or '*' in looked_at and bool(earlier)
+
+
+def run_job(job, cache_path: Path | None, spool_path: Path | None, *args, retry=False, **kwargs):
+    """ Call job with a cache and spool of its own in a worker process, also returns what it printed and the worker's
+    cache hits and misses. With retry, a failing job gives None, for callers that run it again in the main process
+    where the error is reported """
+    import contextlib, io
+    cache = cache_path and TranspileCache(cache_path)
+    spool = spool_path and FunctionSpool(spool_path)
+    # the caller prints this once it knows the job won't be run again, so nothing is printed twice
+    output = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+            result = job(*args, cache=cache, spool=spool, **kwargs)
+        if spool:
+            spool.wait()
+    except Exception:
+        if not retry:
+            sys.stderr.write(output.getvalue())
+            raise
+        result = None
+    finally:
+        if spool:
+            spool.close()
+    return result, output.getvalue(), (cache.hits, cache.misses) if cache else (0, 0)
+
+
+def submit_job(executor, job, cache: TranspileCache | None, spool: FunctionSpool | None, *args, **kwargs):
+    """ Start run_job in the executor, sharing the cache and spool folders """
+    return executor.submit(run_job, job, cache and cache.path, spool and spool.path, *args, **kwargs)
+
+
+def job_result(future, cache: TranspileCache | None):
+    """ What a job started by submit_job returned and printed, counting its cache hits and misses in cache """
+    result, output, (hits, misses) = future.result()
+    if cache:
+        cache.hits += hits
+        cache.misses += misses
+    return result, output
+
+
+def comp_fps_parallel(input_path: Path, verbose: bool, cache: TranspileCache | None, executor,
+                      spool: FunctionSpool | None = None) -> dict[str, list[str] | Path]:
+    """ comp_fps with every file run in a worker process, merged in the same order a serial build uses """
+    jobs = [(f, submit_job(executor, comp_fps, cache, spool, input_path, verbose, files=[f], retry=True))
+            for f in sorted(input_path.glob(f'*.{FUNC_EXT}'))]
+    anon = ns('anon/function')
+    func_files: dict[str, list[str] | Path] = {}
+    origins: dict[str, str] = {}
+    for f, job in jobs:
+        result, output = job_result(job, cache)
+        if result is None or any(name.startswith(anon) and name in func_files for name in result):
+            # anonymous functions are numbered after the ones made before them, and a file can add to a function of an
+            # earlier file, so these run again with the functions so far like a serial build
+            before = set(func_files)
+            comp_fps(input_path, verbose, cache, spool, [f], func_files)
+            origins.update(dict.fromkeys(func_files.keys() - before, f.name))
+            continue
+        print(output, end='')
+        for name, content in result.items():
+            if name in func_files:
+                raise ValueError(f'Duplicate function name: {name!r} (generated by {origins[name]} and {f.name})')
+            func_files[name] = content
+            origins[name] = f.name
+    return func_files
@@ -0,0 +1,376 @@
+""" Writing a compiled pack into a folder or an archive, and --minify. packscript imports this once a build has
+something to write """
+import os, sys
+from pathlib import Path
+
+from packscript import PF, Content, __version__, get_folder, get_header
+
+
+def resource_type(name: str) -> str:
+    """ The kind of a file in the pack, like function, tags/block or loot_table """
+    if name.endswith('.mcfunction'):
+        return 'function'
+    parts = name.split('/')
+    if 'data' not in parts[:2]:
+        return name
+    parts = parts[parts.index('data') + 2:-1]
+    return '/'.join(parts[:2]) if parts[:1] == ['tags'] else parts[0] if parts else name
+
+
+def minify_files(files: dict[str, Content | Path]) -> dict[str, list[int]]:
+    """ Shrink generated files in place for --minify, returns the files, bytes before and bytes after by type """
+    import json
+    header = get_header()
+    report: dict[str, list[int]] = {}
+    for name, content in list(files.items()):
+        kind = resource_type(name)
+        before = len(to_bytes(content))
+        if name == 'pack.mcmeta':
+            content = json.loads(content)
+        if kind == 'function' and isinstance(content, str):
+            lines = [line for line in content.removeprefix(header).split('\n')
+                     if line.strip() and not line.lstrip().startswith('#')]
+            # functions left empty are still written, so commands calling them keep working
+            content = '\n'.join(lines) + '\n' if lines else ''
+        elif isinstance(content, (dict, list)):
+            # empty tags are kept like empty functions, calls like function #ns:hooks fail if the tag is missing
+            content = json.dumps(content, ensure_ascii=False, sort_keys=name != 'pack.mcmeta', separators=(',', ':'))
+        files[name] = content
+        totals = report.setdefault(kind, [0, 0, 0])
+        totals[0] += 1
+        totals[1] += before
+        totals[2] += len(to_bytes(content))
+    return report
+
+
+def minify_report(report: dict[str, list[int]]) -> str:
+    width = max([len('type'), *map(len, report)])
+    out = [f'{"type":<{width}}  {"files":>7}  {"before":>10}  {"after":>10}  {"saved":>10}']
+    for kind, (files, before, after) in sorted(report.items(), key=lambda item: item[1][2] - item[1][1]):
+        out.append(f'{kind:<{width}}  {files:>7}  {before:>10}  {after:>10}  {before - after:>10}'
+                   f' ({(before - after) / max(before, 1):.0%})')
+    before, after = sum(totals[1] for totals in report.values()), sum(totals[2] for totals in report.values())
+    out.append(f'Minified {before} bytes to {after}, saving {before - after} ({(before - after) / max(before, 1):.0%})')
+    return '\n'.join(out)
+
+
+def collect_static(input_path: Path, pack_format: PF, is_jar: bool, source: bool) -> dict[str, Path]:
+    """ Find the input files that are copied into the pack as they are, keyed by their path in the pack """
+    static: dict[str, Path] = {}
+
+    def config(loc: str, *, dst='') -> bool:
+        type = 'dir' if loc.endswith('/') else 'file'
+        src = input_path / loc
+        if not (src.is_file() if type == 'file' else src.is_dir()):
+            if src.exists():
+                raise (IsADirectoryError if type == 'file' else NotADirectoryError)(loc)
+            return False
+        if type == 'file':
+            static[dst or loc] = src
+            return True
+        prefix = Path(dst or loc)
+        for file in sorted(src.rglob('*')):
+            rel = file.relative_to(src)
+            if '.DS_Store' not in rel.parts and file.is_file():
+                static[(prefix / rel).as_posix()] = file
+        return True
+
+    config('overlays/', dst='.')
+    config('data/')
+    config('pack.png')
+    if is_jar:
+        config('assets/')
+        config('fabric.mod.json')
+        config('mods.toml', dst='META-INF/mods.toml')
+        config('mods.toml', dst='META-INF/neoforge.mods.toml')
+        config('neoforge.mods.toml', dst='META-INF/neoforge.mods.toml')
+    if not source:
+        source_folder = get_folder('source', pack_format)
+        overlays = {overlay.name for overlay in (input_path / 'overlays').glob('*/')}
+        for name in list(static):
+            parts = name.split('/')
+            if parts[0] in overlays:
+                parts = parts[1:]
+            if len(parts) > 3 and parts[0] == 'data' and parts[2] == source_folder:
+                del static[name]
+    return static
+
+
+class FileLinker:
+    """ Copies static input files into the output, sharing their data through reflinks or hardlinks if possible """
+    FICLONE = 0x40049409
+
+    def __init__(self, mode: str = 'auto', spool: Path | None = None):
+        self.mode = mode
+        self.reflink = mode in ('auto', 'reflink') and sys.platform.startswith('linux')
+        self.spool = spool
+
+    def link(self, src: Path, dst: Path) -> None:
+        import shutil
+        if self.spool is not None and src.parent == self.spool:
+            # written by --stream for this build only, so it can be moved
+            os.replace(src, dst)
+            return
+        if self.mode == 'hardlink':
+            try:
+                os.link(src, dst)
+                return
+            except OSError:  # across filesystems, or not supported
+                pass
+        elif self.reflink:
+            import fcntl
+            try:
+                with src.open('rb') as s, dst.open('wb') as d:
+                    fcntl.ioctl(d.fileno(), self.FICLONE, s.fileno())
+                shutil.copystat(src, dst)
+                return
+            except OSError:
+                # the filesystem can't do it, so don't try again for every file
+                self.reflink = False
+        shutil.copy2(src, dst)
+
+
+def to_bytes(content: Content) -> bytes:
+    import json
+    if isinstance(content, (dict, list)):
+        # resources are serialized as late as possible, so it can happen on the writer threads
+        content = json.dumps(content, indent=2, ensure_ascii=False, sort_keys=True)
+    return content if isinstance(content, bytes) else content.encode()
+
+
+def write_report(files: int, size: int, seconds: float) -> str:
+    seconds = max(seconds, 1e-9)
+    return (f'Wrote {files} file{"s" * (files != 1)} ({size / 2 ** 20:.2f} MiB) in {seconds * 1000:.0f} ms, '
+            f'{files / seconds:.0f} files/s, {size / 2 ** 20 / seconds:.2f} MiB/s')
+
+
+class OutputWriter:
+    """ Writes files into a folder from a pool of threads, creating every folder only once """
+    # files per task, so the pool isn't dominated by the overhead of its futures
+    CHUNK = 64
+
+    def __init__(self, root: Path, linker: FileLinker, threads: int | None = None):
+        self.root = root
+        self.linker = linker
+        self.threads = threads
+        self.dirs: set[Path] = set()
+        self.files = 0
+        self.size = 0
+        self.seconds = 0.0
+
+    def folder(self, path: Path) -> None:
+        if path not in self.dirs:
+            path.mkdir(parents=True, exist_ok=True)
+            self.dirs.add(path)
+            self.dirs.update(path.parents)
+
+    def write_chunk(self, names: list[str], static: dict[str, Path], files: dict[str, Content]) -> int:
+        size = 0
+        for name in names:
+            path = self.root / name
+            try:
+                if name in files:
+                    content = to_bytes(files[name])
+                    path.write_bytes(content)
+                    size += len(content)
+                else:
+                    self.linker.link(static[name], path)
+                    size += path.stat().st_size
+            except Exception as e:
+                e.add_note(f'while writing {name!r}')
+                raise
+        return size
+
+    def write(self, static: dict[str, Path], files: dict[str, Content]) -> None:
+        import time
+        start = time.perf_counter()
+        names = sorted(static.keys() | files.keys())
+        # folders are made up front, on this thread, so the writers never race to create them
+        for name in names:
+            self.folder((self.root / name).parent)
+        chunks = [names[i:i + self.CHUNK] for i in range(0, len(names), self.CHUNK)]
+        if len(chunks) <= 1:
+            # not worth starting threads for, or importing concurrent.futures, which takes longer than the writing
+            self.size += sum(self.write_chunk(chunk, static, files) for chunk in chunks)
+        else:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(self.threads, thread_name_prefix='packscript-writer') as pool:
+                jobs = [pool.submit(self.write_chunk, chunk, static, files) for chunk in chunks]
+                for job in jobs:
+                    self.size += job.result()
+        self.files += len(names)
+        self.seconds += time.perf_counter() - start
+
+    def report(self) -> str:
+        return write_report(self.files, self.size, self.seconds)
+
+
+def write_tree(root: Path, static: dict[str, Path], files: dict[str, Content], linker: FileLinker) -> OutputWriter:
+    writer = OutputWriter(root, linker)
+    writer.write(static, files)
+    return writer
+
+
+class ZipWriter:
+    """ Writes a pack straight into a zip/jar, the destination is only replaced once the archive is complete """
+    # fixed timestamps, so building the same pack twice gives the same archive
+    DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+    def __init__(self, path: Path, compression_level: int | None = None):
+        import tempfile, zipfile
+        self.path = path
+        fd, temp = tempfile.mkstemp(dir=path.parent, prefix=f'.{path.name}.', suffix='.tmp')
+        self.temp = Path(temp)
+        self.file = os.fdopen(fd, 'wb')
+        self.compression = zipfile.ZIP_STORED if compression_level == 0 else zipfile.ZIP_DEFLATED
+        self.zip = zipfile.ZipFile(self.file, 'w', self.compression, compresslevel=compression_level)
+        self.dirs: set[str] = set()
+        self.files = 0
+        self.size = 0
+        self.seconds = 0.0
+
+    def info(self, name: str):
+        import zipfile
+        info = zipfile.ZipInfo(name, date_time=self.DATE_TIME)
+        info.compress_type = self.compression
+        info.external_attr = (0o40755 if name.endswith('/') else 0o100644) << 16
+        return info
+
+    def add_dirs(self, name: str) -> None:
+        *parents, _ = name.split('/')
+        for i in range(1, len(parents) + 1):
+            folder = '/'.join(parents[:i]) + '/'
+            if folder not in self.dirs:
+                self.dirs.add(folder)
+                self.zip.writestr(self.info(folder), b'')
+
+    def write(self, name: str, content: Content) -> None:
+        self.add_dirs(name)
+        content = to_bytes(content)
+        self.zip.writestr(self.info(name), content)
+        self.files += 1
+        self.size += len(content)
+
+    def copy(self, name: str, src: Path) -> None:
+        import shutil
+        self.add_dirs(name)
+        info = self.info(name)
+        # the size has to be known up front, files over 2 GiB need zip64 headers
+        info.file_size = src.stat().st_size
+        with src.open('rb') as f, self.zip.open(info, 'w') as dst:
+            shutil.copyfileobj(f, dst, 1 << 20)
+        self.files += 1
+        self.size += info.file_size
+
+    def write_pack(self, static: dict[str, Path], files: dict[str, Content]) -> None:
+        import time
+        start = time.perf_counter()
+        for name in sorted(static.keys() | files.keys()):
+            if name in files:
+                self.write(name, files[name])
+            else:
+                self.copy(name, static[name])
+        self.seconds += time.perf_counter() - start
+
+    def report(self) -> str:
+        return write_report(self.files, self.size, self.seconds)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *_):
+        try:
+            self.zip.close()
+        finally:
+            self.file.close()
+            if exc_type is None:
+                # mkstemp only gives the owner access, use the permissions a normally created file would have
+                umask = os.umask(0)
+                os.umask(umask)
+                os.chmod(self.temp, 0o666 & ~umask)
+                os.replace(self.temp, self.path)
+            else:
+                self.temp.unlink(missing_ok=True)
+
+
+def file_hash(path: Path) -> str:
+    import hashlib
+    with path.open('rb') as f:
+        return hashlib.file_digest(f, 'sha256').hexdigest()
+
+
+def manifest_path(output: Path) -> Path:
+    return output.parent / f'.{output.name}.packscript.json'
+
+
+def sync_output(dst: Path, static: dict[str, Path], files: dict[str, Content], linker: FileLinker) -> None:
+    """ Make dst contain exactly the given files, only touching the ones whose contents differ """
+    import hashlib, json, shutil
+    manifest_file = manifest_path(dst)
+    try:
+        manifest = json.loads(manifest_file.read_text())
+        recorded_files: dict[str, list] = manifest['files']
+        recorded_inputs: dict[str, list] = manifest['inputs']
+    except (OSError, ValueError, KeyError, TypeError):
+        recorded_files, recorded_inputs = {}, {}
+    dst.mkdir(parents=True, exist_ok=True)
+    new_files: dict[str, list] = {}
+    new_inputs: dict[str, list] = {}
+    added, changed, unchanged = [], [], 0
+
+    def recorded_hash(path: Path, recorded: list | None) -> str:
+        stat = path.stat()
+        match recorded:
+            # trust the manifest as long as the file looks untouched since it was hashed
+            case [digest, size, mtime] if (size, mtime) == (stat.st_size, stat.st_mtime_ns):
+                return digest
+            case _:
+                return file_hash(path)
+
+    for rel in sorted(static.keys() | files.keys()):
+        target = dst / rel
+        if rel in files:
+            content = to_bytes(files[rel])
+            digest = hashlib.sha256(content).hexdigest()
+        else:
+            src = static[rel]
+            digest = recorded_hash(src, recorded_inputs.get(str(src)))
+            if src.parent != linker.spool:
+                stat = src.stat()
+                new_inputs[str(src)] = [digest, stat.st_size, stat.st_mtime_ns]
+        current = None
+        if target.is_symlink():
+            target.unlink()
+        elif target.is_dir():
+            shutil.rmtree(target)
+        elif target.is_file():
+            current = recorded_hash(target, recorded_files.get(rel))
+        if current != digest:
+            (changed if current is not None else added).append(rel)
+            target.parent.mkdir(parents=True, exist_ok=True)
+            temp = target.with_name(f'.{target.name}.tmp')
+            temp.unlink(missing_ok=True)
+            if rel in files:
+                temp.write_bytes(content)
+            else:
+                linker.link(static[rel], temp)
+            os.replace(temp, target)
+        else:
+            unchanged += 1
+        stat = target.stat()
+        new_files[rel] = [digest, stat.st_size, stat.st_mtime_ns]
+
+    folders = {parent.as_posix() for rel in new_files for parent in Path(rel).parents}
+    removed = []
+    for item in sorted(dst.rglob('*'), reverse=True):
+        rel = item.relative_to(dst).as_posix()
+        if item.is_dir() and not item.is_symlink():
+            if rel not in folders and not any(item.iterdir()):
+                item.rmdir()
+        elif rel not in new_files:
+            item.unlink()
+            removed.append(rel)
+
+    manifest_file.write_text(json.dumps({'version': __version__, 'files': new_files, 'inputs': new_inputs},
+                                        indent=1, sort_keys=True))
+    print(f'Synced output: {len(added)} added, {len(changed)} changed, {len(removed)} removed, {unchanged} unchanged')
@@ -0,0 +1,105 @@
+""" The --profile, --profile-memory and --trace profiler. packscript imports this only when one of them is asked for """
+import os
+from contextlib import contextmanager
+from pathlib import Path
+
+from packscript import phase_times
+
+
+class Profiler:
+    """ Wall and CPU time, phases, output counts and peak memory of every file, namespace and overlay in a build """
+    def __init__(self, memory: bool = False):
+        import time
+        self.memory = memory
+        self.start = time.perf_counter()
+        self.spans: list[dict] = []
+        self.stack: list[dict] = []
+        self.events: list[dict] = []
+        if memory:
+            import tracemalloc
+            tracemalloc.start()
+
+    @staticmethod
+    def counts(func_files: dict | None, other: dict | None) -> tuple[int, int, int]:
+        """ Lines emitted, functions created, and dp resources written so far """
+        if func_files is None:
+            return 0, 0, 0
+        return (sum(map(len, func_files.values())), len(func_files),
+                sum(map(len, other.values())) if other is not None else 0)
+
+    def event(self, name: str, category: str, start: float, seconds: float, args: dict | None = None) -> None:
+        self.events.append({'name': name, 'cat': category, 'ph': 'X', 'pid': os.getpid(), 'tid': 0,
+                            'ts': round((start - self.start) * 1e6), 'dur': round(seconds * 1e6),
+                            **({'args': args} if args else {})})
+
+    def phase(self, phase: str, start: float, seconds: float) -> None:
+        for span in self.stack:
+            span['phases'][phase] = span['phases'].get(phase, 0.0) + seconds
+        self.event(phase, 'phase', start, seconds)
+
+    @contextmanager
+    def span(self, kind: str, name: str, func_files: dict | None = None, other: dict | None = None):
+        import time, tracemalloc
+        span = {'kind': kind, 'name': name, 'phases': {}, 'lines': 0, 'functions': 0, 'resources': 0,
+                'counted': func_files is not None}
+        before = self.counts(func_files, other)
+        memory = self.memory and kind == 'file'
+        if memory:
+            tracemalloc.reset_peak()
+            memory_start = tracemalloc.get_traced_memory()[0]
+        self.stack.append(span)
+        start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            span['wall'] = time.perf_counter() - start
+            span['cpu'] = time.process_time() - cpu_start
+            self.stack.pop()
+            if func_files is not None:
+                after = self.counts(func_files, other)
+                span['lines'], span['functions'], span['resources'] = (b - a for a, b in zip(before, after))
+                # spans that can't count their own output, like overlays, add up the ones inside them
+                if not any(parent['counted'] for parent in self.stack):
+                    for parent in self.stack:
+                        for key in ('lines', 'functions', 'resources'):
+                            parent[key] += span[key]
+            if memory:
+                span['peak'] = tracemalloc.get_traced_memory()[1] - memory_start
+            self.spans.append(span)
+            self.event(name, kind, start, span['wall'], {key: value for key, value in span.items()
+                                                         if key not in ('kind', 'name', 'counted')})
+
+    def summary(self, top: int = 20) -> str:
+        """ The slowest overlays, namespaces and files, as a table """
+        out = ['Phases: ' + ', '.join(f'{phase} {seconds * 1000:.1f}ms' for phase, seconds in
+                                      sorted(phase_times.items(), key=lambda item: -item[1]))]
+        for kind in ('overlay', 'namespace', 'file'):
+            spans = sorted((span for span in self.spans if span['kind'] == kind), key=lambda span: -span['wall'])
+            if not spans or top < 1:
+                continue
+            columns = ['wall ms', 'cpu ms', 'transpile', 'exec', 'lines', 'functions', 'resources']
+            memory = self.memory and kind == 'file'
+            if memory:
+                columns.append('peak KiB')
+            width = max(len(kind), *(len(span['name']) for span in spans[:top]))
+            out.append(f'\n{f"Slowest {kind}s" if len(spans) > top else kind.capitalize() + "s"}:')
+            out.append(f'  {kind:<{width}}' + ''.join(f'{column:>11}' for column in columns))
+            for span in spans[:top]:
+                values = [f'{span["wall"] * 1000:.1f}', f'{span["cpu"] * 1000:.1f}',
+                          f'{span["phases"].get("transpile", 0) * 1000:.1f}',
+                          f'{span["phases"].get("exec", 0) * 1000:.1f}',
+                          span['lines'], span['functions'], span['resources']]
+                if memory:
+                    values.append(f'{span["peak"] / 1024:.1f}')
+                out.append(f'  {span["name"]:<{width}}' + ''.join(f'{value:>11}' for value in values))
+        return '\n'.join(out)
+
+    def write_trace(self, path: Path) -> None:
+        """ Write the spans as Chrome trace events, for chrome://tracing or Perfetto """
+        import json
+        path.write_text(json.dumps({'traceEvents': self.events, 'displayTimeUnit': 'ms'}))
+
+    def stop(self) -> None:
+        if self.memory:
+            import tracemalloc
+            tracemalloc.stop()
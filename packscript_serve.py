@@ -0,0 +1,236 @@
+""" Compiling packs on request and in batches, for packscript serve and compiles of several packs. packscript
+imports this only when it is used """
+import os, sys
+from contextlib import contextmanager
+from pathlib import Path
+
+from packscript import CACHE_DIR, TranspileCache, __version__, comp_file, compile, phase_times
+from packscript_watch import BuildState
+
+
+def error_source(e: BaseException) -> dict:
+    """ The source file, generated line and an excerpt of the generated code an error happened in, if it happened
+        running a .dps or .fps file """
+    import traceback
+    found = {}
+    for frame, line in traceback.walk_tb(e.__traceback__):
+        if frame.f_code is comp_file.__code__:
+            found = {'file': str(frame.f_locals['curr_file']), 'code': frame.f_locals.get('code')}
+        elif found and frame.f_code.co_filename == '<string>':
+            found['line'] = line
+    if found and isinstance(e, SyntaxError) and e.filename == '<string>':
+        found['line'] = e.lineno
+    code, line = found.pop('code', None), found.get('line')
+    if code and line:
+        width = len(str(len(code)))
+        found['excerpt'] = [f'{i:>{width}}: {code[i - 1]}' for i in range(max(1, line - 3), min(len(code), line + 3) + 1)]
+    return found
+
+
+# helper modules each pack built by serve or a batch imported from its own folder, with the fingerprint of their files
+pack_helpers: dict[Path, tuple[dict[str, object], tuple | None]] = {}
+
+
+@contextmanager
+def pack_modules(input_path: Path):
+    """ Import the helper modules a pack imports from its own folder only once, unless one of their files changed. They
+        are only in sys.modules while the block runs, so packs with modules of the same name don't see each other's """
+    def fingerprint(modules: dict[str, object]) -> tuple | None:
+        try:
+            return BuildState.fingerprint(sorted(Path(module.__file__).absolute() for module in modules.values()),
+                                          input_path)
+        except OSError:
+            return None
+
+    modules, kept = pack_helpers.pop(input_path, ({}, None))
+    if kept is not None and fingerprint(modules) == kept:
+        sys.modules.update(modules)
+    before = set(sys.modules) - modules.keys()
+    try:
+        yield
+    finally:
+        modules = {}
+        for name in set(sys.modules) - before:
+            file = getattr(sys.modules[name], '__file__', None)
+            if file and Path(file).absolute().is_relative_to(input_path):
+                modules[name] = sys.modules.pop(name)
+        pack_helpers[input_path] = modules, fingerprint(modules)
+
+
+def compile_request(request: dict) -> dict:
+    """ Run one compile for serve or a batch, returning the result as JSON """
+    import io, time, traceback
+    from contextlib import redirect_stderr, redirect_stdout
+    options = {'verbose': False, 'source': False, **request.get('options', {})}
+    cwd = Path(request.get('cwd', '.'))
+    for key in ('input', 'output', 'cache_dir', 'analyze_json', 'trace'):
+        if options.get(key):
+            options[key] = str(cwd / options[key])
+    options.pop('state', None)
+    output = io.StringIO()
+    start = time.perf_counter()
+    result = {'id': request.get('id'), 'ok': True}
+    with redirect_stdout(output), redirect_stderr(output), pack_modules(Path(options.get('input') or '.').absolute()):
+        try:
+            compile(**options)
+        except Exception as e:
+            traceback.print_exc()
+            result['ok'] = False
+            result['error'] = {'type': type(e).__name__, 'message': str(e), **error_source(e)}
+    result['seconds'] = time.perf_counter() - start
+    result['phases'] = dict(phase_times)
+    result['output'] = output.getvalue()
+    return result
+
+
+def read_manifest(path: Path) -> list[dict]:
+    """ The packs of a batch manifest, a JSON list of compile options for each pack, or an object with that list as
+        "packs" and options for every pack as "options". Paths are relative to the manifest """
+    import json
+    manifest = json.loads(path.read_text())
+    if isinstance(manifest, list):
+        manifest = {'packs': manifest}
+    if not isinstance(manifest, dict) or not isinstance(manifest.get('packs'), list) or \
+            not all(isinstance(pack, dict) and pack.get('output') for pack in manifest['packs']):
+        raise ValueError(f'{path} must list packs with at least an "output" each, like '
+                         f'{{"packs": [{{"input": "pack", "output": "build/pack.zip"}}]}}')
+    packs = []
+    for pack in manifest['packs']:
+        pack = {**manifest.get('options', {}), **pack}
+        pack['input'] = pack.get('input') or '.'
+        # without a cache_dir, the pack uses its own <input>/.packscript_cache or the one given on the command line
+        for key in ('input', 'output', 'cache_dir'):
+            if pack.get(key):
+                pack[key] = str(path.absolute().parent / pack[key])
+        packs.append(pack)
+    return packs
+
+
+def compile_batch(*, packs: list[dict], jobs: int = 1, fail_fast: bool = False, clear_cache: bool = False,
+                  **options) -> list[dict]:
+    """ Compile several packs in one process, or in up to jobs worker processes at once, printing what each one
+        printed and a summary. Returns the result of each pack like compile_request, unless fail_fast stopped it """
+    import time
+    if clear_cache:
+        # packs can share a cache directory, so clear each one once before any of them start
+        for path in {Path(pack.get('cache_dir') or options.get('cache_dir') or Path(pack['input']) / CACHE_DIR)
+                     for pack in packs}:
+            TranspileCache(path.absolute()).clear()
+    requests = [{'id': i, 'options': {**options, **pack, 'jobs': 1}} for i, pack in enumerate(packs)]
+    results: list[dict] = []
+
+    def done(result: dict) -> bool:
+        results.append(result)
+        pack = packs[result['id']]
+        print(f'== {pack["input"]} -> {pack["output"]} ==\n{result.pop("output")}', end='', flush=True)
+        return fail_fast and not result['ok']
+
+    start = time.perf_counter()
+    if jobs == 1:
+        for request in requests:
+            if done(compile_request(request)):
+                break
+    else:
+        from concurrent.futures import ProcessPoolExecutor, as_completed
+        with ProcessPoolExecutor(max_workers=jobs or None) as executor:
+            futures = [executor.submit(compile_request, request) for request in requests]
+            for future in as_completed(futures):
+                if done(future.result()):
+                    for other in futures:
+                        other.cancel()
+                    break
+    print(batch_report(packs, sorted(results, key=lambda result: result['id']), time.perf_counter() - start))
+    return results
+
+
+def batch_report(packs: list[dict], results: list[dict], seconds: float) -> str:
+    failed = sum(not result['ok'] for result in results)
+    summary = f'Built {len(results) - failed} of {len(packs)} packs in {seconds:.2f} s'
+    if failed:
+        summary += f', {failed} failed'
+    if len(results) < len(packs):
+        summary += f', {len(packs) - len(results)} skipped'
+    lines = [summary]
+    for result in results:
+        pack = packs[result['id']]
+        lines.append(f'  {"ok" if result["ok"] else "FAILED":<6}  {result["seconds"]:>7.2f} s  '
+                     f'{pack["input"]} -> {pack["output"]}')
+        if error := result.get('error'):
+            where = ''
+            if error.get('file'):
+                where = f' (in {error["file"]}' + (f', generated line {error["line"]}' if error.get('line') else '') + ')'
+            lines.append(f'          {error["type"]}: {error["message"]}{where}')
+    return '\n'.join(lines)
+
+
+def serve_socket() -> Path:
+    """ Where serve listens by default, a Unix socket in the user's runtime directory """
+    import tempfile
+    return Path(os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir()) / f'packscript-{os.getuid()}.sock'
+
+
+def serve(*, host: str | None = None, port: int | None = None, socket: str = '', **_) -> None:
+    """ Compile packs on request, reading a JSON object per line and answering with one. Listens on a Unix socket only
+    the user can connect to, or on TCP with a token every request has to send """
+    import hmac, secrets, socketserver, stat, threading
+    # compile() keeps the state of the build in globals like phase_times and prints its progress, so builds take turns
+    lock = threading.Lock()
+    tcp = host is not None or port is not None or not hasattr(socketserver, 'UnixStreamServer')
+    # anyone who can connect can run code, which a TCP port doesn't limit to this user
+    token = tcp and (os.environ.get('PACKSCRIPT_SERVE_TOKEN') or secrets.token_urlsafe(24))
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            import json
+            for line in self.rfile:
+                if not line.strip():
+                    continue
+                try:
+                    request = json.loads(line)
+                    if not isinstance(request, dict):
+                        raise ValueError('Requests must be JSON objects')
+                except ValueError as e:
+                    response = {'ok': False, 'error': {'type': type(e).__name__, 'message': str(e)}}
+                else:
+                    if token and not hmac.compare_digest(str(request.get('token', '')).encode(), token.encode()):
+                        response = {'id': request.get('id'), 'ok': False,
+                                    'error': {'type': 'PermissionError', 'message': 'Missing or wrong "token"'}}
+                    elif request.get('command', 'compile') == 'ping':
+                        response = {'id': request.get('id'), 'ok': True, 'version': __version__}
+                    else:
+                        with lock:
+                            response = compile_request(request)
+                self.wfile.write(json.dumps(response).encode() + b'\n')
+                self.wfile.flush()
+
+    if tcp:
+        server = socketserver.ThreadingTCPServer((host or '127.0.0.1', 7235 if port is None else port), Handler)
+        address = '{}:{}'.format(*server.server_address[:2])
+    else:
+        path = Path(socket) if socket else serve_socket()
+        try:
+            if not stat.S_ISSOCK(path.lstat().st_mode):
+                raise ValueError(f'{path} is not a socket, not replacing it')
+            # left behind by a server that didn't stop cleanly
+            path.unlink()
+        except FileNotFoundError:
+            pass
+        # the socket is made only readable and writable by this user, there's no moment anyone else can connect
+        umask = os.umask(0o177)
+        try:
+            server = socketserver.ThreadingUnixStreamServer(str(path), Handler)
+        finally:
+            os.umask(umask)
+        address = str(path)
+    server.daemon_threads = True
+    with server:
+        print(f'Serving compiles on {address}, press Ctrl+C to stop', flush=True)
+        if token:
+            print(f'Every request has to include "token": "{token}"', flush=True)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            print('\nStopped serving')
+        finally:
+            if not tcp:
+                path.unlink(missing_ok=True)
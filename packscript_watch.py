@@ -0,0 +1,454 @@
+""" Rebuilding a pack when its files change, for packscript watch: what each build keeps for the next one and
+the file watchers. packscript imports this only when watching """
+import os, sys
+from pathlib import Path
+from types import CodeType
+
+from packscript import (CACHE_DIR, DATA_EXT, FUNC_EXT, PF, PackResult, ResourceStore, TranspileCache, build_globals,
+                        comp_file, comp_fps, comp_namespace, compile, get_folder, profiled, source_folder)
+from packscript_jobs import TrackedResourceStore, saw_earlier
+from packscript_output import manifest_path
+
+
+class SourceGraph:
+    """ What each source file of a namespace read and wrote in the last build, so a change only reruns the files it can
+    affect. Files are keyed by what they touch: global:<name>, function:<name>, resource:<type> and tag:<name> """
+    # calls that can read any global
+    DYNAMIC = frozenset(('globals', 'vars', 'locals', 'eval', 'exec'))
+    # set by exec and by the transpiled code right before they are used, so they never carry anything between files
+    SCRATCH = frozenset(('__builtins__', '__f', '__extra'))
+
+    def __init__(self, pack_folder: Path, namespace: Path, pack_format: PF, overlay: bool):
+        self.namespace = namespace.name
+        self.pack_format = pack_format
+        self.base = pack_folder.parent if overlay else pack_folder
+        self.key = namespace.relative_to(self.base).as_posix()
+        self.working_folder = source_folder(namespace, pack_format)
+        self.records: dict[str, dict] = {}
+        self.helpers: tuple = ()
+        self.ran: list[str] = []
+        self.reason = ''
+
+    def start(self) -> None:
+        self.func_files: dict[str, list[str]] = {'': []}
+        self.func_stack: list[str] = ['']
+        self.capturer_stack: list[list[str]] = []
+        self.other = TrackedResourceStore()
+        self.function_tags: dict[str, list[str]] = {}
+        self.globals = build_globals(self.func_stack, self.capturer_stack, self.func_files, self.other, self.namespace,
+                                     self.function_tags)
+        self.initial = dict(self.globals)
+        self.records = {}
+
+    @staticmethod
+    def code_names(code_obj: CodeType) -> set[str]:
+        """ Every global (and attribute) name the code and the functions and classes defined in it use """
+        names = set(code_obj.co_names)
+        for const in code_obj.co_consts:
+            if isinstance(const, CodeType):
+                names |= SourceGraph.code_names(const)
+        return names
+
+    @staticmethod
+    def overlaps(writes: set[str], keys: set[str]) -> bool:
+        """ If anything written is in keys, where a key ending in * stands for every key starting with the rest """
+        if not writes.isdisjoint(keys):
+            return True
+        return any(a.endswith('*') and b.startswith(a[:-1]) or b.endswith('*') and a.startswith(b[:-1])
+                   for a in writes for b in keys if a.endswith('*') or b.endswith('*'))
+
+    def conflict(self, a: dict, b: dict) -> bool:
+        return (self.overlaps(a['writes'], b['reads'] | b['writes']) or
+                self.overlaps(b['writes'], a['reads'] | a['writes']))
+
+    def dependents(self, changed: list[str]) -> set[str]:
+        """ The changed files and every file that shares something with them, directly or through other files """
+        dirty = set(changed)
+        todo = list(changed)
+        while todo:
+            record = self.records[todo.pop()]
+            for rel, other in self.records.items():
+                if rel not in dirty and self.conflict(record, other):
+                    dirty.add(rel)
+                    todo.append(rel)
+        return dirty
+
+    def label(self, rel: str) -> str:
+        return (self.working_folder / rel).relative_to(self.base).as_posix()
+
+    def run(self, rel: str, stat: tuple, verbose: bool, cache: TranspileCache | None) -> None:
+        """ Run a source file, recording what it touched """
+        before = dict(self.globals)
+        lengths = {name: len(lines) for name, lines in self.func_files.items()}
+        tags = {tag: len(names) for tag, names in self.function_tags.items()}
+        with profiled('file', self.label(rel), self.func_files, self.other):
+            self.other.reads, self.other.uses, self.other.tables = set(), set(), set()
+            code_obj = comp_file(self.base, self.working_folder, self.working_folder / rel, self.globals,
+                                 verbose=verbose, cache=cache)
+            touched_reads, touched_writes = self.other.reads, self.other.uses | self.other.tables
+            looked_at = self.other.reads | self.other.uses
+        names = self.code_names(code_obj)
+        reads = {f'global:{name}' for name in names - self.SCRATCH} | {f'resource:{type}' for type in touched_reads}
+        if names & self.DYNAMIC:
+            reads.add('global:*')
+        rebound = {name for name, value in self.globals.items() if before.get(name, self) is not value}
+        rebound |= before.keys() - self.globals.keys()
+        writes = {f'global:{name}' for name in rebound - self.SCRATCH}
+        writes |= {f'resource:{type}' for type in touched_writes}
+        functions = [name for name in self.func_files if name not in lengths]
+        writes |= {f'function:{name}' for name, lines in self.func_files.items()
+                   if name and len(lines) != lengths.get(name)}
+        if any(name.startswith(f'{self.namespace}:anon/function') for name in functions):
+            # anonymous functions are numbered after the ones made before them
+            writes.add(f'function:{self.namespace}:anon/*')
+        writes |= {f'tag:{tag}' for tag, names in self.function_tags.items() if len(names) != tags.get(tag)}
+        self.records[rel] = {'stat': stat, 'reads': reads - writes, 'writes': writes, 'functions': functions,
+                             'looked_at': looked_at}
+
+    def run_all(self, sources: dict[str, tuple], verbose: bool, cache: TranspileCache | None) -> None:
+        self.start()
+        self.ran = [self.key]
+        with profiled('namespace', self.key, self.func_files, self.other):
+            for rel, stat in sources.items():
+                self.run(rel, stat, verbose, cache)
+
+    def rerun(self, dirty: set[str], sources: dict[str, tuple], verbose: bool, cache: TranspileCache | None) -> bool:
+        """ Undo what the dirty files did and run them again, false if they now share something with the others """
+        for key in set().union(*(self.records[rel]['writes'] for rel in dirty)):
+            kind, _, name = key.partition(':')
+            if kind == 'global':
+                if name in self.initial:
+                    self.globals[name] = self.initial[name]
+                else:
+                    self.globals.pop(name, None)
+            elif kind == 'function':
+                self.func_files.pop(name, None)
+            elif kind == 'resource':
+                # every file using a type is dirty, so none of its resources are kept
+                if name == '*':
+                    dict.clear(self.other)
+                else:
+                    dict.pop(self.other, name, None)
+            elif kind == 'tag':
+                self.function_tags.pop(name, None)
+        self.func_files[''] = []
+        self.func_stack[:] = ['']
+        self.capturer_stack.clear()
+        self.ran = []
+        with profiled('namespace', self.key, self.func_files, self.other):
+            for rel, stat in sources.items():
+                if rel in dirty:
+                    self.run(rel, stat, verbose, cache)
+                    self.ran.append(self.label(rel))
+        clean = [record for rel, record in self.records.items() if rel not in dirty]
+        return not any(self.conflict(self.records[rel], record) for rel in dirty for record in clean)
+
+    def update(self, extra: tuple, stats: tuple, verbose: bool, cache: TranspileCache | None) -> 'PackResult':
+        """ Bring the namespace up to date with its source folder, given the fingerprint of it """
+        sources = {rel: (size, mtime) for rel, size, mtime in stats if rel.endswith(f'.{DATA_EXT}')}
+        helpers = (extra, [stat for stat in stats if not stat[0].endswith(f'.{DATA_EXT}')])
+        changed = [rel for rel, stat in sources.items() if self.records.get(rel, {}).get('stat') != stat]
+        dirty = set()
+        if not self.records:
+            self.reason = 'nothing recorded by an earlier build'
+        elif helpers != self.helpers:
+            self.reason = 'a helper module or the build options changed'
+        elif sources.keys() != self.records.keys():
+            self.reason = 'a source file was added or removed'
+        else:
+            dirty = self.dependents(changed)
+            self.reason = 'every file depends on the change' if len(dirty) == len(sources) else ''
+        self.helpers = helpers
+        try:
+            if self.reason:
+                self.run_all(sources, verbose, cache)
+            elif not self.rerun(dirty, sources, verbose, cache):
+                self.reason = f'{", ".join(map(self.label, sorted(dirty)))} now share something with other files'
+                self.run_all(sources, verbose, cache)
+        except BaseException:
+            # the globals are left half way through a build, start over next time
+            self.records = {}
+            raise
+        functions = {name: self.func_files[name] for record in self.records.values() for name in record['functions']}
+        return PackResult(functions, ResourceStore(dict.items(self.other)),
+                          {tag: list(names) for tag, names in self.function_tags.items()})
+
+    def looked_at(self) -> set[str]:
+        """ The types of resources the namespace looked at, like comp_namespace_tracked returns """
+        return set().union(*(record['looked_at'] for record in self.records.values()))
+
+    def describe(self) -> dict:
+        """ The dependency graph as JSON, with the reads shown only when another file writes them """
+        written = set().union(*(record['writes'] for record in self.records.values()))
+        return {'ran': self.ran, 'full_rebuild': self.reason or None, 'files': {self.label(rel): {
+            'reads': sorted(key for key in record['reads'] if self.overlaps(written - record['writes'], {key})),
+            'writes': sorted(record['writes']),
+            'depends_on': [self.label(other) for other, other_record in self.records.items()
+                           if other != rel and self.conflict(record, other_record)],
+        } for rel, record in self.records.items()}}
+
+
+class BuildState:
+    """ Results kept between builds of a long-running process, so unchanged parts of a pack aren't run again """
+    def __init__(self):
+        self.results: dict[str, tuple[tuple, object]] = {}
+        self.helpers: dict[str, set[str]] = {}
+        self.executed: list[str] = []
+        self.graphs: dict[str, SourceGraph] = {}
+        # namespaces that looked at resources of earlier namespaces last time, which are run after them every build
+        self.serial: set[str] = set()
+
+    @staticmethod
+    def fingerprint(paths: list[Path], base: Path, *extra) -> tuple:
+        stats = []
+        for path in paths:
+            stat = path.stat()
+            stats.append((path.relative_to(base).as_posix(), stat.st_size, stat.st_mtime_ns))
+        return extra, tuple(stats)
+
+    def reuse(self, key: str, fingerprint: tuple, folder: Path, run, ran=None):
+        cached = self.results.get(key)
+        if cached and cached[0] == fingerprint:
+            return cached[1]
+        source_exts = (f'.{DATA_EXT}', f'.{FUNC_EXT}')
+        if cached and [f for f in cached[0][1] if not f[0].endswith(source_exts)] != \
+                [f for f in fingerprint[1] if not f[0].endswith(source_exts)]:
+            # a helper module (or something else run by the sources) changed, so import it again
+            for name in self.helpers.pop(key, ()):
+                sys.modules.pop(name, None)
+        self.results.pop(key, None)
+        result = self.import_helpers(key, folder, run)
+        self.results[key] = (fingerprint, result)
+        self.executed.extend(ran() if ran else [key])
+        return result
+
+    def import_helpers(self, key: str, folder: Path, run):
+        """ Call run, remembering the modules in folder it imported as helpers of key """
+        before = set(sys.modules)
+        result = run()
+        self.helpers[key] = self.helpers.get(key, set()) | {
+            name for name in sys.modules.keys() - before
+            if str(getattr(sys.modules[name], '__file__', None) or '').startswith(str(folder))}
+        return result
+
+    def comp_namespace(self, pack_folder: Path, namespace: Path, pack_format: PF, verbose: bool, overlay: bool,
+                       cache: TranspileCache | None, result: PackResult) -> None:
+        """ Add what a namespace generates to result, the namespaces before it. Namespaces are run independently, so
+        unchanged ones can be reused from the last build. One that looks at resources of a type an earlier namespace
+        created is run against result instead, like in a serial build """
+        import contextlib, io
+        base = pack_folder.parent if overlay else pack_folder
+        key = namespace.relative_to(base).as_posix()
+        working_folder = namespace / get_folder('source', pack_format)
+        if key not in self.serial:
+            files = sorted(f for f in working_folder.rglob('*') if f.is_file())
+            fingerprint = self.fingerprint(files, working_folder, pack_format, verbose)
+            graph = self.graphs.get(key)
+            if graph is None or graph.pack_format != pack_format:
+                graph = self.graphs[key] = SourceGraph(pack_folder, namespace, pack_format, overlay)
+            # what it prints and ran is only shown if it isn't run again
+            output = io.StringIO()
+            executed = len(self.executed)
+            try:
+                with contextlib.redirect_stdout(output):
+                    # within the namespace only the changed files, and the files sharing something with them, are run
+                    ns_result, looked_at = self.reuse(
+                        key, fingerprint, working_folder,
+                        lambda: (graph.update(*fingerprint, verbose, cache), graph.looked_at()), lambda: graph.ran)
+            except BaseException:
+                print(output.getvalue(), end='')
+                raise
+            if not saw_earlier(looked_at, result.other):
+                print(output.getvalue(), end='')
+                result.merge(ns_result)
+                return
+            del self.executed[executed:]
+        earlier = set(result.other)
+        other = TrackedResourceStore(dict.items(result.other))
+        # it's run every build, so its helper modules are imported again too
+        for name in self.helpers.pop(key, ()):
+            sys.modules.pop(name, None)
+        ns_result = self.import_helpers(key, working_folder, lambda: comp_namespace(
+            pack_folder, namespace, pack_format, verbose, overlay, cache, other, result.function_tags))
+        result.func_files.update(ns_result.func_files)
+        for type, table in dict.items(other):
+            result.other.setdefault(type, table)
+        if saw_earlier(other.reads | other.uses, earlier):
+            self.serial.add(key)
+        else:
+            # it's reused again from the next build on
+            self.serial.discard(key)
+        self.executed.append(key)
+
+    def write_graph(self, path: Path) -> None:
+        """ Save the dependency graph of every namespace, to see why a change reran the files it did """
+        import json
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps({key: graph.describe() for key, graph in self.graphs.items()}, indent=2) + '\n')
+
+    def comp_fps(self, input_path: Path, verbose: bool, cache: TranspileCache | None) -> dict[str, list[str]]:
+        # .fps files share function names, so they are rerun together
+        files = sorted([*input_path.glob(f'*.{FUNC_EXT}'), *input_path.glob('*.py')])
+        return self.reuse(f'*.{FUNC_EXT}', self.fingerprint(files, input_path, verbose), input_path,
+                          lambda: comp_fps(input_path, verbose, cache))
+
+
+WATCHED_ROOT_FILES = ('pack.mcmeta', 'pack.png', 'fabric.mod.json', 'mods.toml', 'neoforge.mods.toml')
+WATCHED_DIRS = ('data', 'overlays', 'assets')
+
+
+class PollingWatcher:
+    """ Detects changes to a pack by comparing file stats """
+    def __init__(self, input_path: Path, ignore: list[Path], interval: float = 0.25):
+        self.input_path = input_path
+        self.ignore = ignore
+        self.interval = interval
+        self.last = self.snapshot()
+
+    def ignored(self, path: Path) -> bool:
+        return any(path == i or path.is_relative_to(i) for i in self.ignore)
+
+    def snapshot(self) -> dict[Path, tuple[int, int]]:
+        files = [f for f in self.input_path.iterdir()
+                 if f.name in WATCHED_ROOT_FILES or f.suffix in (f'.{FUNC_EXT}', '.py')]
+        for folder in WATCHED_DIRS:
+            files.extend((self.input_path / folder).rglob('*'))
+        snapshot = {}
+        for f in files:
+            try:
+                if not self.ignored(f):
+                    stat = f.stat()
+                    snapshot[f] = stat.st_size, stat.st_mtime_ns
+            except OSError:  # deleted while scanning
+                pass
+        return snapshot
+
+    def wait(self, debounce: float) -> float:
+        """ Block until something changes and settles for debounce seconds, returns when the first change was seen """
+        import time
+        while (current := self.snapshot()) == self.last:
+            time.sleep(self.interval)
+        changed_at = time.perf_counter()
+        while True:
+            time.sleep(max(debounce, self.interval))
+            self.last, current = current, self.snapshot()
+            if current == self.last:
+                return changed_at
+
+
+class InotifyWatcher(PollingWatcher):
+    """ Detects changes to a pack with inotify (Linux only) """
+    # IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+    MASK = 0x2 | 0x4 | 0x8 | 0x40 | 0x80 | 0x100 | 0x200 | 0x400
+    IN_IGNORED = 0x8000
+
+    def __init__(self, input_path: Path, ignore: list[Path]):
+        if not sys.platform.startswith('linux'):
+            raise OSError('inotify is only available on Linux')
+        import ctypes, ctypes.util
+        self.input_path = input_path
+        self.ignore = ignore
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.watches: dict[int, Path] = {}
+        self.refresh()
+
+    def refresh(self) -> None:
+        """ Watch every directory that exists now, so new folders are picked up after each change """
+        folders = [self.input_path]
+        for name in WATCHED_DIRS:
+            if (self.input_path / name).is_dir():
+                folders.append(self.input_path / name)
+                folders.extend(d for d in (self.input_path / name).rglob('*') if d.is_dir())
+        watched = set(self.watches.values())
+        for folder in folders:
+            if folder not in watched and not self.ignored(folder):
+                wd = self.libc.inotify_add_watch(self.fd, os.fsencode(folder), self.MASK)
+                if wd >= 0:
+                    self.watches[wd] = folder
+
+    def changes(self) -> bool:
+        import struct
+        changed = False
+        try:
+            data = os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return False
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = struct.unpack_from('iIII', data, offset)
+            name = data[offset + 16:offset + 16 + length].rstrip(b'\0').decode(errors='surrogateescape')
+            offset += 16 + length
+            folder = self.watches.get(wd)
+            if mask & self.IN_IGNORED:
+                self.watches.pop(wd, None)
+            if folder is None or not name:
+                continue
+            path = folder / name
+            if folder == self.input_path:
+                if not (name in WATCHED_ROOT_FILES or name in WATCHED_DIRS or path.suffix in (f'.{FUNC_EXT}', '.py')):
+                    continue
+            if not self.ignored(path):
+                changed = True
+        return changed
+
+    def wait(self, debounce: float) -> float:
+        import select, time
+        while True:
+            select.select([self.fd], [], [])
+            if self.changes():
+                break
+        changed_at = time.perf_counter()
+        # keep reading until the burst of events (like an editor saving several files) is over
+        while select.select([self.fd], [], [], debounce)[0]:
+            self.changes()
+        self.refresh()
+        return changed_at
+
+
+def watch(*, input: str, output: str, poll: bool, debounce: int, full: bool, **options) -> None:
+    import time, traceback
+    input_path: Path = Path(input or '.').absolute()
+    output_path = Path(output.removesuffix('.zip').removesuffix('.jar')).absolute()
+    cache_dir = Path(options['cache_dir']).absolute() if options.get('cache_dir') else input_path / CACHE_DIR
+    ignore = [output_path, output_path.with_name(f'{output_path.name}.zip'),
+              output_path.with_name(f'{output_path.name}.jar'), manifest_path(output_path), cache_dir]
+    state = None if full else BuildState()
+
+    def build(changed_at: float | None = None):
+        start = time.perf_counter()
+        if state is not None:
+            state.executed.clear()
+        try:
+            compile(input=input, output=output, sync=True, state=state, **options)
+            if state is not None:
+                state.write_graph(cache_dir / 'deps.json')
+        except Exception:
+            traceback.print_exc()
+            print('Build failed, waiting for changes...', file=sys.stderr)
+            return
+        end = time.perf_counter()
+        report = f'Rebuilt in {(end - start) * 1000:.0f} ms'
+        if changed_at is not None:
+            report += f' ({(end - changed_at) * 1000:.0f} ms after the change)'
+        if state is not None:
+            report += f', ran {", ".join(state.executed) or "nothing"}'
+        print(report, flush=True)
+
+    watcher = None
+    if not poll:
+        try:
+            watcher = InotifyWatcher(input_path, ignore)
+        except OSError:
+            poll = True
+    if watcher is None:
+        watcher = PollingWatcher(input_path, ignore)
+    try:
+        build()
+        print(f'Watching {input_path} for changes{" (polling)" * poll}, press Ctrl+C to stop', flush=True)
+        while True:
+            build(watcher.wait(debounce / 1000))
+    except KeyboardInterrupt:
+        print('\nStopped watching')
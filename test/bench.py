@@ -0,0 +1,159 @@
+"""
+Benchmark of every compile phase, on a generated pack.
+
+Generates a pack with the given number of namespaces, .dps files, functions (nested to the given depth), dp resources,
+overlays and .fps files, compiles it a few times to a folder and to a zip, and prints the time each phase took as JSON.
+Phases are the ones compile() records in packscript.phase_times: staging, transpile, exec, functions, other, write and
+archive. Pass --baseline with an earlier result to fail when a phase got slower.
+
+    python3 test/bench.py [--namespaces N] [--files M] [--functions K] [--depth D] ... [--baseline old.json]
+"""
+import argparse
+import contextlib
+import io
+import json
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+import packscript
+
+PACK_FORMAT = 61
+
+
+def function_source(name: str, depth: int, lines: int, indent: str = '') -> list[str]:
+    """ A function with a loop of interpolated lines, some static lines, and a chain of nested functions """
+    source = [
+        f'{indent}/function {name}:',
+        f'{indent}    /scoreboard players set @s {name.replace(":", "_").replace("/", "_")[-16:]} 0',
+        f'{indent}    for i in range({lines}):',
+        f'{indent}        /execute as @a[scores={{timer=$i}}] at @s run particle minecraft:flame ~ ~${{i / 4}} ~',
+        f'{indent}    /tellraw @a {{"text":"done","color":"gold"}}',
+        f'{indent}    /effect give @a minecraft:speed 1 1 true',
+    ]
+    if depth > 0:
+        source += function_source(f'{name}_d', depth - 1, lines, indent + '    ')
+    return source
+
+
+def dps_source(namespace: str, file: int, functions: int, depth: int, lines: int, resources: int) -> str:
+    source = []
+    for k in range(functions):
+        source += function_source(f'{namespace}:f{file}/func_{k}', depth, lines)
+    for r in range(resources):
+        source += [
+            f'dp.tags.block.b{file}_{r} = {{"values": ["minecraft:stone", "minecraft:dirt"]}}',
+            f'create predicate p{file}_{r} -> {{"condition": "minecraft:random_chance", "chance": {r / 100}}}',
+        ]
+    return '\n'.join(source) + '\n'
+
+
+def generate_pack(root: Path, *, namespaces: int, files: int, functions: int, depth: int, lines: int,
+                  resources: int, overlays: int, fps: int) -> Path:
+    """ Write a pack of the given shape into root/input_pack, returning its path """
+    pack = root / 'input_pack'
+    meta = {'pack': {'pack_format': PACK_FORMAT, 'description': 'PackScript benchmark'},
+            'overlays': {'entries': [{'formats': [PACK_FORMAT, PACK_FORMAT], 'directory': f'overlay_{o}'}
+                                     for o in range(overlays)]}}
+    pack.mkdir(parents=True)
+    (pack / 'pack.mcmeta').write_text(json.dumps(meta, indent=4))
+    folders = [pack] + [pack / 'overlays' / f'overlay_{o}' for o in range(overlays)]
+    for folder in folders:
+        for n in range(namespaces):
+            namespace = f'bench{n}'
+            source = folder / 'data' / namespace / 'source'
+            source.mkdir(parents=True)
+            for m in range(files):
+                (source / f'file_{m}.dps').write_text(dps_source(namespace, m, functions, depth, lines, resources))
+            static = folder / 'data' / namespace / 'loot_table'
+            static.mkdir()
+            (static / 'static.json').write_text('{"pools": []}')
+    for f in range(fps):
+        (pack / f'script_{f}.fps').write_text('\n'.join(
+            [f'/say script {f}', 'for i in range(8):', '    /scoreboard players add @s counter $i']
+            + function_source(f'bench0:gen_{f}', 1, lines)) + '\n')
+    return pack
+
+
+def run(input_pack: Path, output: Path, repeat: int, **options) -> dict:
+    """ Compile repeatedly, returning the median total and phase times in seconds """
+    totals = []
+    phases: dict[str, list[float]] = {}
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            packscript.compile(input=str(input_pack), output=str(output), verbose=False, source=False, **options)
+            totals.append(time.perf_counter() - start)
+        for phase, seconds in packscript.phase_times.items():
+            phases.setdefault(phase, []).append(seconds)
+    return {'total': statistics.median(totals),
+            'phases': {phase: statistics.median(times) for phase, times in sorted(phases.items())}}
+
+
+def regressions(baseline: dict, result: dict, threshold: float) -> list[str]:
+    """ Describe every total or phase that got more than threshold times slower than the baseline """
+    slower = []
+    for name, run_result in result['runs'].items():
+        old = baseline.get('runs', {}).get(name)
+        if old is None:
+            continue
+        times = [('total', old['total'], run_result['total'])]
+        times += [(phase, old['phases'][phase], seconds) for phase, seconds in run_result['phases'].items()
+                  if phase in old['phases']]
+        for phase, before, after in times:
+            # ignore phases too short to time reliably
+            if after > before * threshold and after - before > 0.005:
+                slower.append(f'{name} {phase}: {before:.4f}s -> {after:.4f}s')
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--namespaces', type=int, default=4)
+    parser.add_argument('--files', type=int, default=8, help='.dps files per namespace')
+    parser.add_argument('--functions', type=int, default=10, help='Top level functions per .dps file')
+    parser.add_argument('--depth', type=int, default=3, help='Functions nested inside each top level function')
+    parser.add_argument('--lines', type=int, default=20, help='Interpolated lines per function')
+    parser.add_argument('--resources', type=int, default=10, help='Pairs of dp resources per .dps file')
+    parser.add_argument('--overlays', type=int, default=1)
+    parser.add_argument('--fps', type=int, default=4, help='.fps files')
+    parser.add_argument('--repeat', type=int, default=5, help='Compiles per run, the median is reported')
+    parser.add_argument('-o', '--output', help='Write the results here as well as printing them')
+    parser.add_argument('--baseline', help='Results of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help='Fail if a phase takes this many times as long as in the baseline')
+    args = parser.parse_args()
+
+    shape = {key: getattr(args, key) for key in
+             ('namespaces', 'files', 'functions', 'depth', 'lines', 'resources', 'overlays', 'fps')}
+    with tempfile.TemporaryDirectory() as temp:
+        temp = Path(temp)
+        input_pack = generate_pack(temp, **shape)
+        result = {
+            'packscript': packscript.__version__,
+            'python': platform.python_version(),
+            'shape': shape,
+            'repeat': args.repeat,
+            'runs': {
+                'folder': run(input_pack, temp / 'out', args.repeat, no_cache=True),
+                'folder_cached': run(input_pack, temp / 'out', args.repeat, cache_dir=str(temp / 'cache')),
+                'zip': run(input_pack, temp / 'out.zip', args.repeat, no_cache=True),
+            },
+        }
+    text = json.dumps(result, indent=2)
+    print(text)
+    if args.output:
+        Path(args.output).write_text(text + '\n')
+    if args.baseline:
+        slower = regressions(json.loads(Path(args.baseline).read_text()), result, args.threshold)
+        if slower:
+            sys.exit('Slower than the baseline:\n' + '\n'.join(slower))
+
+
+if __name__ == '__main__':
+    main()
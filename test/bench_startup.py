@@ -0,0 +1,106 @@
+"""
+Startup benchmark for the packscript command line.
+
+Times `packscript.py --version`, `python -m packscript --version`, `packscript.py pf` and a no-op compile (a one
+function pack whose sources are in the transpile cache) in fresh interpreters, and how much longer each takes than a bare
+`python -c pass`. Running the file as a script compiles all of it on every run, while -m and the packscript_*.py
+modules it imports for some commands use the cached bytecode. Also lists the imports that take the longest when printing
+the version, measured with -X importtime.
+
+Fails when --version or the no-op compile take longer than their targets, in milliseconds more than the bare
+interpreter. The defaults come from 0.2.7, before the transpile cache, --sync and the modules were added, which took
+71 ms longer than python -c pass for --version and 81 ms for a full compile of this pack. 0.2.7 has no no-op compile to
+compare with: this one also hashes its files for the transpile cache and --sync, and parses the options added since,
+so its target is 100. Lower them when startup gets faster, so it can't slowly get slower again.
+
+    python3 test/bench_startup.py [--repeat N] [--top N] [--version-target MS] [--compile-target MS]
+"""
+import argparse
+import py_compile
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+SCRIPT = Path(__file__).resolve().parent.parent / 'packscript.py'
+
+
+def run_time(args: list[str], repeat: int, cwd: Path) -> float:
+    """ Median milliseconds it takes to run the command in a new interpreter """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, *args], cwd=cwd, check=True, stdout=subprocess.DEVNULL)
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+
+def import_times(args: list[str], cwd: Path) -> dict[str, int]:
+    """ Cumulative microseconds of each top level import the command makes, that a bare interpreter doesn't """
+    def imports(args: list[str]) -> dict[str, int]:
+        result = subprocess.run([sys.executable, '-X', 'importtime', *args], cwd=cwd, check=True,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        found = {}
+        for line in result.stderr.splitlines():
+            if not line.startswith('import time:') or line.endswith('imported package'):
+                continue
+            _, cumulative, name = line.removeprefix('import time:').split('|')
+            if cumulative.strip().isdigit() and not name.startswith('  '):
+                found[name.strip()] = int(cumulative)
+        return found
+
+    bare = imports(['-c', 'pass'])
+    return {name: micros for name, micros in imports(args).items() if name not in bare}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=10, help='Runs of each command, the median is reported')
+    parser.add_argument('--top', type=int, default=10, help='Slowest imports to list')
+    parser.add_argument('--version-target', type=float, default=70,
+                        help='Fail if --version takes this many ms longer than python -c pass (default: 70)')
+    parser.add_argument('--compile-target', type=float, default=100,
+                        help='Fail if the no-op compile takes this many ms longer than python -c pass (default: 100)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp:
+        temp = Path(temp)
+        source = temp / 'pack/data/bench/source'
+        source.mkdir(parents=True)
+        (temp / 'pack/pack.mcmeta').write_text('{"pack": {"pack_format": 61, "description": "startup"}}')
+        (source / 'main.dps').write_text('/function tick [tick]:\n    /say hi\n')
+        compile_args = [str(SCRIPT), 'compile', '-i', 'pack', '-o', 'output', '--sync']
+        subprocess.run([sys.executable, *compile_args], cwd=temp, check=True, stdout=subprocess.DEVNULL)
+        # -m and the modules read their bytecode from __pycache__, make sure it is there even with
+        # PYTHONDONTWRITEBYTECODE
+        for module in [SCRIPT, *SCRIPT.parent.glob('packscript_*.py')]:
+            py_compile.compile(str(module))
+
+        times = {
+            'python -c pass': run_time(['-c', 'pass'], args.repeat, temp),
+            '--version': run_time([str(SCRIPT), '--version'], args.repeat, temp),
+            '-m --version': run_time(['-m', 'packscript', '--version'], args.repeat, SCRIPT.parent),
+            'pf': run_time([str(SCRIPT), 'pf', '-i', 'pack'], args.repeat, temp),
+            'no-op compile': run_time(compile_args, args.repeat, temp),
+        }
+        imports = import_times([str(SCRIPT), '--version'], temp)
+
+    bare = times['python -c pass']
+    print(f'median of {args.repeat} runs')
+    for name, ms in times.items():
+        print(f'  {name:<15} {ms:>8.1f} ms' + (f'  (+{ms - bare:.1f} ms)' if ms is not bare else ''))
+    print(f'slowest imports for --version ({sum(imports.values()) / 1000:.1f} ms in total):')
+    for name, micros in sorted(imports.items(), key=lambda item: -item[1])[:args.top]:
+        print(f'  {name:<15} {micros / 1000:>8.1f} ms')
+
+    slower = [f'{name}: +{times[name] - bare:.1f} ms > +{target} ms' for name, target in
+              (('--version', args.version_target), ('no-op compile', args.compile_target))
+              if times[name] - bare > target]
+    if slower:
+        sys.exit('Slower than the target:\n' + '\n'.join(slower))
+
+
+if __name__ == '__main__':
+    main()
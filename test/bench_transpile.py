@@ -0,0 +1,196 @@
+"""
+Micro-benchmark for the .dps/.fps line transpiler.
+
+Runs the current transpiler and the regex-stack transpiler it replaced (kept below as the baseline) over a large
+synthetic source, checks that the Python both generate emits the same functions, and prints how many lines per second
+each one transpiles and how many the generated code emits. The speedup is the median of several runs, along with the
+lowest and highest one, since a single run can be off by more than the difference.
+
+    python3 test/bench_transpile.py [--lines N] [--repeat N]
+"""
+import argparse
+import random
+import re
+import statistics
+import sys
+import time
+import warnings
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from packscript import ResourceStore, build_globals, ns, transpile
+
+
+def baseline_transpile(text: str, namespace: str) -> list[str]:
+    """ The transpiler as it was before the single-pass scanner """
+    func_re = re.compile(r'(?<!-)\bfunction\b(?!-)')
+
+    def right_most_function(contents: str) -> int | None:
+        matches = list(func_re.finditer(contents))
+        return matches[-1].end() if matches else None
+
+    command_re = re.compile(r'([\t ]*)/(.*)')
+    interpolation_re = re.compile(r'\$\{\{(.*?)}}|(?<!^)\$([a-zA-Z_]\w*)')
+    create_statement_re = re.compile(r'([\t ]*)create\b[ \t]*([\w/]+)\b[ \t]*([a-z\d:/_.-]*)[ \t]*->(.*)')
+    code = []
+    concat_line = None
+    for line in text.splitlines():
+        line = line.rstrip()
+        if concat_line is not None:
+            line = f'{concat_line}{line.lstrip()}'
+            concat_line = None
+        if line.endswith('\\'):
+            concat_line = line[:-1]
+            continue
+        command_match = command_re.match(line)
+        if command_match:
+            indent, contents = command_match.groups()
+            contents = contents.replace('{', '{{').replace('}', '}}')
+            contents = interpolation_re.sub(r'{\1\2}', contents)
+            extra_line = None
+            if (end_chr := contents[-1:]) in (':', ';'):
+                func_def_start = right_most_function(contents)
+                if func_def_start is None:
+                    raise ValueError(f'Command {contents!r} ends with colon/semicolon but does not contain function')
+                func_def = contents[func_def_start:-1].strip()
+                code.append(f'{indent}__f, __extra = __function_name__(f"{func_def}")')
+                contents = f'{contents[:func_def_start]} {{__f}}{{__extra}}'
+                extra_line = f'{indent}with __function__(__f):'
+                if end_chr == ';':
+                    extra_line = f'{indent}__function__(__f).replace()'
+            code.append(f'{indent}__line__(rf""" {contents} """[1:-1])')
+            if extra_line:
+                code.append(extra_line)
+        else:
+            create_match = create_statement_re.fullmatch(line)
+            if create_match:
+                indent, file_type, name, data = create_match.groups()
+                name = ns(name, default=namespace)
+                code.append(f'{indent}__other__("{file_type}")["{name}"] ={data}')
+            else:
+                code.append(line)
+    return code
+
+
+BLOCK = '''\
+/function gen/block_{i} [tick]:
+    for x in range(4):
+        /execute as @a[tag=t{i}] at @s run particle minecraft:flame ~ ~$x ~ 0 0 0 0 1
+        /data modify storage ns:data list append value {{id:"item_{i}",Count:1b,tag:{{a:[1,2,3]}}}}
+        /tellraw @a {{"text":"Hello ${{x * 2}} $name","color":"gold"}}
+    /$say $(message) macro line {i}
+    /scoreboard players add @s counter_{i} 1
+    /execute if score @s counter_{i} matches 10.. run function gen/inner_{i} [] with storage ns:args:
+        /say inner {i}
+        /execute as @e[type=minecraft:zombie,distance=..16] run tp @s ~ ~1 ~
+    /fill ~-1 ~-1 ~-1 ~1 ~1 ~1 minecraft:stone \\
+        replace minecraft:air
+/function gen/static_{i}:
+    for _ in range(8):
+        /scoreboard players set @s timer_{i} 0
+        /effect give @a[tag=frozen] minecraft:slowness 1 255 true
+        # keep the mobs in place
+        /execute as @e[tag=pinned] run tp @s ~ ~ ~
+        /particle minecraft:end_rod ~ ~1 ~ 0.2 0.2 0.2 0 4
+create tags/block block_{i} -> {{'values': ['minecraft:stone']}}
+# comment line {i}
+'''
+
+
+def synthetic_sources(lines: int, file_lines: int = 1000) -> list[str]:
+    """ Source files of about file_lines lines each, adding up to at least lines """
+    files = []
+    blocks = []
+    count = 0
+    i = 0
+    while count < lines:
+        block = BLOCK.format(i=i)
+        blocks.append(block)
+        count += block.count('\n')
+        i += 1
+        if len(blocks) * block.count('\n') >= file_lines:
+            files.append(''.join(blocks))
+            blocks = []
+    if blocks:
+        files.append(''.join(blocks))
+    return files
+
+
+def fuzz_sources(count: int, seed: int = 0) -> list[str]:
+    """ Short random snippets made of the characters and line shapes the transpiler cares about """
+    pieces = ['$', '{', '}', '${', 'a', 'b1', ' ', 'function', '-function', 'functions', ':', ';', '/', '\\', '"',
+              'x_y', '$(m)', '{{', '}}', '$$', 'é', '[t]', 'with storage a:b', 'create', '->', '\t']
+    rng = random.Random(seed)
+    sources = []
+    for _ in range(count):
+        lines = []
+        for _ in range(rng.randint(1, 6)):
+            line = ''.join(rng.choice(pieces) for _ in range(rng.randint(0, 12)))
+            lines.append(rng.choice(['', '    ']) + rng.choice(['/', '/', '/', '', '# ']) + line)
+        sources.append('\n'.join(lines))
+    return sources
+
+
+def run(code_obj) -> dict[str, list[str]]:
+    """ Execute generated code, returning the functions it emitted """
+    func_files = {'': []}
+    globals = build_globals([''], [], func_files, ResourceStore(), 'bench', {})
+    exec(code_obj, globals | {'name': 'bench_name'})
+    return func_files
+
+
+def outputs(func, source: str):
+    """ The functions a source emits, or the type of error it raises """
+    try:
+        return run(compile('\n'.join(func(source, 'bench')), '<string>', 'exec'))
+    except Exception as e:
+        return type(e).__name__
+
+
+def run_times(repeat: int, before, after) -> tuple[list[float], list[float]]:
+    """ How long before() and after() took on each run, taking turns so noise affects both alike """
+    times = ([], [])
+    for _ in range(repeat):
+        for func, phase_times in zip((before, after), times):
+            start = time.perf_counter()
+            func()
+            phase_times.append(time.perf_counter() - start)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--lines', type=int, default=200_000, help='Lines in the synthetic source')
+    parser.add_argument('--repeat', type=int, default=9,
+                        help='Runs of each phase, the median and the spread of the speedup are reported')
+    args = parser.parse_args()
+
+    with warnings.catch_warnings(action='ignore', category=SyntaxWarning):
+        for source in fuzz_sources(5_000):
+            if outputs(transpile, source) != outputs(baseline_transpile, source):
+                sys.exit(f'transpile() output differs from the baseline for:\n{source}')
+    sources = synthetic_sources(args.lines)
+    lines = sum(source.count('\n') for source in sources)
+    print(f'{lines} lines in {len(sources)} files, median of {args.repeat} runs')
+    code_objs = {}
+    for name, func in (('before', baseline_transpile), ('after', transpile)):
+        code_objs[name] = [compile('\n'.join(func(source, 'bench')), '<string>', 'exec') for source in sources]
+    if [run(code_obj) for code_obj in code_objs['before']] != [run(code_obj) for code_obj in code_objs['after']]:
+        sys.exit('transpile() output differs from the baseline on the synthetic source')
+
+    phases = {
+        'transpile': run_times(args.repeat, lambda: [baseline_transpile(source, 'bench') for source in sources],
+                               lambda: [transpile(source, 'bench') for source in sources]),
+        'run': run_times(args.repeat, lambda: list(map(run, code_objs['before'])),
+                         lambda: list(map(run, code_objs['after']))),
+    }
+    for phase, (before, after) in phases.items():
+        # the spread of the speedup over the runs shows how much of it is noise
+        speedups = sorted(b / a for b, a in zip(before, after))
+        print(f'{phase:<9}  before: {lines / statistics.median(before):>10,.0f} lines/s  '
+              f'after: {lines / statistics.median(after):>10,.0f} lines/s  '
+              f'{statistics.median(speedups):.2f}x (from {speedups[0]:.2f}x to {speedups[-1]:.2f}x)')
+
+if __name__ == '__main__':
+    main()
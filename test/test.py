@@ -1,14 +1,24 @@
+import contextlib
 import filecmp
+import io
+import json
 import os
+import pickle
 import shutil
+import subprocess
 import sys
+import tempfile
 import unittest
+import zipfile
 from pathlib import Path
 
 parent_dir = Path(__file__).resolve().parent.parent
 sys.path.append(str(parent_dir))
 
-from packscript import version_or_pf
+from packscript import ResourceStore, build_globals, compile, transpile, version_or_pf
+from packscript_jobs import FunctionSpool
+from packscript_serve import compile_batch, compile_request, read_manifest, serve
+from packscript_watch import BuildState
 
 
 def packscript(*args):
@@ -22,16 +32,7 @@ def read_mcfunction(filepath):
         return '\n'.join(line for line in file.readlines()[1:] if line.strip())
 
 
-class TestPackScriptCompilation(unittest.TestCase):
-    def setUp(self):
-        """ Setup temporary directory for output. """
-        self.temp_dir = "tests/temp_output"
-        os.makedirs(self.temp_dir, exist_ok=True)
-
-    def tearDown(self):
-        """ Clean up after tests. """
-        shutil.rmtree(self.temp_dir)
-
+class PackComparison(unittest.TestCase):
     def compare_mcfunction_files(self, file1, file2):
         """ Compare two .mcfunction files under specific conditions. """
         content1 = read_mcfunction(file1)
@@ -50,6 +51,31 @@ class TestPackScriptCompilation(unittest.TestCase):
         for common_dir in comp.common_dirs:
             self.deep_compare_dirs(os.path.join(dir1, common_dir), os.path.join(dir2, common_dir))
 
+    def write_pack(self, source: str | list[str]) -> Path:
+        """ Write a pack whose only source file is main.dps in the test namespace, into input in a temporary folder
+            that is removed after the test, returning the folder """
+        temp = Path(self.enterContext(tempfile.TemporaryDirectory()))
+        (temp / 'input/data/test/source').mkdir(parents=True)
+        (temp / 'input/pack.mcmeta').write_text('{"pack": {"pack_format": 61, "description": "test"}}')
+        (temp / 'input/data/test/source/main.dps').write_text(source if isinstance(source, str) else '\n'.join(source))
+        return temp
+
+    def build(self, temp: Path, **options) -> None:
+        """ Compile the pack written by write_pack into output, without the transpile cache """
+        compile(**{'input': str(temp / 'input'), 'output': str(temp / 'output'), 'verbose': False, 'source': False,
+                   'no_cache': True, **options})
+
+
+class TestPackScriptCompilation(PackComparison):
+    def setUp(self):
+        """ Setup temporary directory for output. """
+        self.temp_dir = "tests/temp_output"
+        os.makedirs(self.temp_dir, exist_ok=True)
+
+    def tearDown(self):
+        """ Clean up after tests. """
+        shutil.rmtree(self.temp_dir)
+
     def test_compile_datapack(self):
         """ Test the compilation of datapacks. """
         test_cases = os.listdir('tests/data')
@@ -66,6 +92,7 @@ class TestPackScriptCompilation(unittest.TestCase):
                 self.deep_compare_dirs(output_dir, expected_output_dir)
         print(f'\nTested {len(test_cases)} cases')
 
+
 class TestPackFormat(unittest.TestCase):
     def test_pack_format(self):
         """ Test the parsing of pack formats """
@@ -77,6 +104,614 @@ class TestPackFormat(unittest.TestCase):
         self.assertEqual(version_or_pf("v4", -1), -1)
 
 
+class TestTranspile(unittest.TestCase):
+    def test_static_lines(self):
+        """ Runs of static command lines are emitted together, also inside capture_lines() """
+        source = '\n'.join([
+            '/function test:foo:',
+            '    /say one',
+            '    # comment',
+            '',
+            '    /say {"two": 2}',
+            '    /$say $(macro)',
+            '    /say $name',
+            '    with capture_lines() as captured:',
+            '        /say three',
+            '        /say four',
+            '    /say ${len(captured)}',
+            '    /say five',
+        ])
+        code = transpile(source, 'test')
+        self.assertIn("    __lines__(('say one',", code)
+        func_files = {'': []}
+        exec('\n'.join(code), build_globals([''], [], func_files, ResourceStore(), 'test', {}) | {'name': 'x'})
+        self.assertEqual(func_files['test:foo'], ['say one', 'say {"two": 2}', '$say $(macro)', 'say x', 'say 2',
+                                                  'say five'])
+
+
+class TestDp(unittest.TestCase):
+    def test_query(self):
+        """ dp supports glob queries, bulk updates and iteration on top of the existing syntax """
+        other = ResourceStore()
+        source = '\n'.join([
+            'dp.tags.block.ores = {"values": ["minecraft:iron_ore"]}',
+            'dp["tags/block", "other:ores"] = {"values": []}',
+            'dp.set_all("tags/block", {"logs": {"values": []}, "other:logs": {"values": []}})',
+            'updated = dp.update_all("tags/block", "*", lambda tag: tag["values"].append("minecraft:stone"))',
+            'dp.update_all("tags/block", "other:*", lambda tag: {"values": ["minecraft:dirt"]})',
+            'names = list(dp.tags.block)',
+            'found = dp.query("tags/block", "o*")',
+            'same = dp.tags.block is dp.tags.block',
+            'empty = bool(dp.tags.item)',
+        ])
+        globals = build_globals([''], [], {'': []}, other, 'test', {})
+        exec('\n'.join(transpile(source, 'test')), globals)
+        self.assertEqual(globals['updated'], 2)
+        self.assertEqual(globals['names'], ['test:ores', 'other:ores', 'test:logs', 'other:logs'])
+        self.assertEqual(globals['found'], {'test:ores': {'values': ['minecraft:iron_ore', 'minecraft:stone']}})
+        self.assertTrue(globals['same'])
+        self.assertIn('logs', globals['dp'].tags.block)
+        self.assertEqual(len(globals['dp'].query('tags/block')), 4)
+        self.assertEqual(other.query('tags/block', 'other:*'), {'other:ores': {'values': ['minecraft:dirt']},
+                                                                 'other:logs': {'values': ['minecraft:dirt']}})
+        self.assertTrue(globals['empty'])
+        other['tags/block'].pop('other:ores')
+        copy = pickle.loads(pickle.dumps(other))
+        self.assertEqual(copy.query('tags/block', 'other:*'), {'other:logs': {'values': ['minecraft:dirt']}})
+
+
+class TestTranspileCache(unittest.TestCase):
+    def test_cache_hits(self):
+        """ Unchanged files are loaded from the cache, changed ones are transpiled again """
+        with tempfile.TemporaryDirectory() as temp:
+            temp = Path(temp)
+            shutil.copytree('tests/data/sub_function/input_pack', temp / 'input')
+            cache = temp / 'cache'
+            options = dict(input=str(temp / 'input'), output=str(temp / 'output'), verbose=False, source=False,
+                           cache_dir=str(cache))
+            compile(**options)
+            self.assertEqual(len(list(cache.iterdir())), 1)
+            expected = (temp / 'output/data/test/functions/tick.mcfunction').read_text()
+            compile(**options)
+            self.assertEqual((temp / 'output/data/test/functions/tick.mcfunction').read_text(), expected)
+
+            main = temp / 'input/data/test/sources/main.dps'
+            main.write_text(main.read_text() + '\n/function extra:\n    /say extra\n')
+            compile(**options)
+            self.assertEqual(len(list(cache.iterdir())), 2)
+            self.assertTrue((temp / 'output/data/test/functions/extra.mcfunction').is_file())
+
+            compile(**options, clear_cache=True, no_cache=True)
+            self.assertFalse(cache.exists())
+
+            # a cache folder with other files in it only loses the cache entries
+            compile(**options)
+            (cache / 'notes.txt').write_text('keep me')
+            compile(**options, clear_cache=True, no_cache=True)
+            self.assertEqual([path.name for path in cache.iterdir()], ['notes.txt'])
+
+
+class TestProfile(PackComparison):
+    def test_trace(self):
+        """ Profiling doesn't change the output, and traces every file, namespace and overlay """
+        with tempfile.TemporaryDirectory() as temp:
+            temp = Path(temp)
+            compile(input='tests/data/overlay/input_pack', output=str(temp / 'output'), verbose=False, source=False,
+                    no_cache=True, profile=True, trace=str(temp / 'trace.json'))
+            self.deep_compare_dirs(temp / 'output', Path('tests/data/overlay/output_pack'))
+            events = json.loads((temp / 'trace.json').read_text())['traceEvents']
+            spans = {(event['cat'], event['name']): event for event in events if event['cat'] != 'phase'}
+            self.assertEqual(spans.keys(), {('overlay', '1_20_5'), ('namespace', 'data/test'),
+                                            ('namespace', '1_20_5/data/test'), ('file', 'data/test/source/main.dps'),
+                                            ('file', '1_20_5/data/test/source/src.dps')})
+            self.assertEqual(spans['overlay', '1_20_5']['args']['functions'], 1)
+
+
+class TestStream(PackComparison):
+    def test_stream(self):
+        """ Streamed builds give the same output, without leaving the spool behind """
+        with tempfile.TemporaryDirectory() as temp:
+            temp = Path(temp)
+            for name in ('overlay', 'semicolon_func'):
+                compile(input=f'tests/data/{name}/input_pack', output=str(temp / name), verbose=False, source=False,
+                        no_cache=True, stream=True)
+                self.deep_compare_dirs(temp / name, Path(f'tests/data/{name}/output_pack'))
+            self.assertEqual(sorted(item.name for item in temp.iterdir()), ['overlay', 'semicolon_func'])
+            with self.assertRaisesRegex(ValueError, '--profile'):
+                compile(input='tests/data/overlay/input_pack', output=str(temp / 'profiled'), verbose=False,
+                        source=False, no_cache=True, stream=True, profile=True)
+
+    def test_jobs(self):
+        """ Worker processes running several namespaces each don't write over each other's spooled functions """
+        with tempfile.TemporaryDirectory() as temp:
+            temp = Path(temp)
+            (temp / 'input').mkdir()
+            (temp / 'input/pack.mcmeta').write_text('{"pack": {"pack_format": 61, "description": ""}}')
+            for name in 'abcdefgh':
+                source = temp / f'input/data/{name}/source'
+                source.mkdir(parents=True)
+                (source / 'main.dps').write_text(f'/function one:\n    /say {name} one\n'
+                                                 f'/function two:\n    /say {name} two\n')
+            options = dict(input=str(temp / 'input'), verbose=False, source=False, no_cache=True)
+            with contextlib.redirect_stdout(io.StringIO()):
+                compile(output=str(temp / 'serial'), **options)
+                compile(output=str(temp / 'parallel'), jobs=2, stream=True, **options)
+            self.deep_compare_dirs(temp / 'serial', temp / 'parallel')
+            self.assertEqual((temp / 'parallel/data/a/function/one.mcfunction').read_text().splitlines()[1:],
+                             ['say a one'])
+
+    def test_reopen(self):
+        """ Functions are spooled once their scope closes, and read back if they are added to again """
+        source = '\n'.join([
+            '/function test:a:',
+            '    /say a1',
+            'with __function__("test:a"):',
+            '    /say a2',
+            '/function test:b:',
+            '    /say b1',
+            '    /function test:c;',
+            '    /say c1',
+        ])
+        with tempfile.TemporaryDirectory() as temp:
+            spool = FunctionSpool(Path(temp))
+            func_files = {'': []}
+            exec('\n'.join(transpile(source, 'test')),
+                 build_globals([''], [], func_files, ResourceStore(), 'test', {}, spool))
+            spool.wait()
+            spool.close()
+            self.assertTrue(all(isinstance(func_files[name], Path) for name in ('test:a', 'test:b', 'test:c')))
+            self.assertEqual({name: spool.read(path) for name, path in func_files.items() if name},
+                             {'test:a': ['say a1', 'say a2'], 'test:b': ['say b1', 'function test:c'],
+                              'test:c': ['say c1']})
+
+
+class TestMinify(PackComparison):
+    def test_minify(self):
+        """ Minified packs have compact JSON and no comments or headers in functions, empty tags are kept """
+        temp = self.write_pack([
+            '/function tick [tick]:',
+            '    /# a comment',
+            '    /say hi',
+            '    /',
+            '/function nothing:',
+            '    /# only a comment',
+            'dp.tags.block.empty = {"values": []}',
+            'dp.tags.block.clear = {"values": [], "replace": True}',
+            'dp.loot_table.table = {"pools": [{"rolls": 1}]}',
+        ])
+        self.build(temp, minify=True)
+        output = temp / 'output/data/test'
+        self.assertEqual((output / 'function/tick.mcfunction').read_text(), 'say hi\n')
+        self.assertEqual((output / 'function/nothing.mcfunction').read_text(), '')
+        self.assertEqual((output / 'tags/block/empty.json').read_text(), '{"values":[]}')
+        self.assertEqual((output / 'tags/block/clear.json').read_text(), '{"replace":true,"values":[]}')
+        self.assertEqual((output / 'loot_table/table.json').read_text(), '{"pools":[{"rolls":1}]}')
+        self.assertEqual((temp / 'output/pack.mcmeta').read_text(),
+                         '{"pack":{"pack_format":61,"description":"test"}}')
+
+
+class TestTreeShake(PackComparison):
+    def test_tree_shake(self):
+        """ Functions nothing can reach are removed, ones reached through tags, resources, macros and --keep stay """
+        temp = self.write_pack([
+            '/function load [load]:',
+            '    /execute if entity @a run function called:',
+            '        /schedule function test:later 1t',
+            '/function later:',
+            '    /$function test:dynamic/$(name)',
+            '/function dynamic/a:',
+            '    /say a',
+            '/function reward:',
+            '    /say reward',
+            '/function debug/dump:',
+            '    /say dump',
+            '/function unused:',
+            '    /function unused_too:',
+            '        /say unused',
+            'create advancement done -> {"criteria": {}, "rewards": {"function": "test:reward"}}',
+        ])
+        self.build(temp, tree_shake=True, keep=['test:debug/*'])
+        functions = temp / 'output/data/test/function'
+        self.assertEqual(sorted(path.relative_to(functions).as_posix() for path in functions.rglob('*.mcfunction')),
+                         ['called.mcfunction', 'debug/dump.mcfunction', 'dynamic/a.mcfunction',
+                          'later.mcfunction', 'load.mcfunction', 'reward.mcfunction'])
+
+
+class TestInline(PackComparison):
+    def test_inline(self):
+        """ Single command functions called once are inlined and forwarders skipped, other calls are left alone """
+        temp = self.write_pack([
+            '/function tick [tick]:',
+            '    /execute as @a at @s run function once:',
+            '        /particle minecraft:flame ~ ~ ~',
+            '    /function test:forward',
+            '    /execute store result score @s x run function stored:',
+            '        /say stored',
+            '    /function returns:',
+            '        /return 1',
+            '    /function test:twice',
+            '    /function test:twice',
+            '/function forward:',
+            '    /function test:target',
+            '/function target:',
+            '    /say one',
+            '    /say two',
+            '/function twice:',
+            '    /say twice',
+        ])
+        self.build(temp, inline=True)
+        functions = temp / 'output/data/test/function'
+        self.assertEqual((functions / 'tick.mcfunction').read_text().splitlines()[1:], [
+            'execute as @a at @s run particle minecraft:flame ~ ~ ~',
+            'function test:target',
+            'execute store result score @s x run function test:stored',
+            'function test:returns',
+            'function test:twice',
+            'function test:twice',
+        ])
+        self.assertFalse((functions / 'once.mcfunction').exists())
+        self.assertFalse((functions / 'forward.mcfunction').exists())
+        self.assertTrue((functions / 'twice.mcfunction').exists())
+
+
+class TestAnalyze(PackComparison):
+    def test_analyze(self):
+        """ The analysis counts commands through every call, and the tick budget fails the build """
+        temp = self.write_pack([
+            '/function tick [tick]:',
+            '    /execute as @a run function test:player:',
+            '        /say player',
+            '        /function test:deep:',
+            '            /say one',
+            '            /say two',
+            '    /function test:loop',
+            '    /schedule function test:later 1t',
+            '    /$function test:spell/$(name)',
+            '/function loop:',
+            '    /execute if score @s x matches 1.. run function test:loop',
+            '/function later:',
+            '    /say later',
+        ])
+        self.build(temp, analyze_json=str(temp / 'analysis.json'))
+        tick = json.loads((temp / 'analysis.json').read_text())['#minecraft:tick']
+        self.assertEqual(tick['commands'], 9)
+        self.assertEqual(tick['functions'], 4)
+        self.assertEqual(tick['depth'], 3)
+        self.assertEqual(tick['cycles'], ['test:loop -> test:loop'])
+        self.assertEqual(list(tick['heaviest'])[:2], ['test:tick', 'test:player'])
+        with self.assertRaises(ValueError):
+            self.build(temp, analyze_json=str(temp / 'analysis.json'), tick_budget=8)
+
+
+class TestLint(PackComparison):
+    def test_lint(self):
+        """ Expensive commands in functions run every tick are reported, unless suppressed or run elsewhere """
+        temp = self.write_pack([
+            '/function tick [tick]:',
+            '    /kill @e[type=minecraft:zombie,tag=undead]',
+            '    /execute as @e[tag=a] at @s run function test:inner:',
+            '        /execute as @e[type=minecraft:pig] run say hi',
+            '    /say @e[nbt={Tags:["a,limit=1"]},distance=..5]',
+            '    /# packscript-lint: disable=unbounded-selector',
+            '    /kill @e[tag=b]',
+            '    /fill ~-20 ~-20 ~-20 ~20 ~20 ~20 minecraft:air',
+            '    /fill 0 0 0 10 10 10 minecraft:air',
+            '/function cold:',
+            '    /kill @e',
+        ])
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            self.build(temp, lint=True, lint_disable=['large-fill'])
+        problems = [line.split(': ')[0:2] for line in output.getvalue().splitlines() if line.startswith('test:')]
+        self.assertEqual(problems, [['test:tick:3', 'unbounded-selector'], ['test:tick:3', 'nested-as-e']])
+
+
+class TestInstrument(PackComparison):
+    def test_instrument(self):
+        """ Instrumented functions count their calls, and the objective is set up before the pack's own load tag """
+        temp = self.write_pack('/function init [load]:\n    /say hi\n')
+        self.build(temp, instrument=True)
+        data = temp / 'output/data'
+        self.assertEqual((data / 'test/function/init.mcfunction').read_text().splitlines()[1:],
+                         ['scoreboard players add test:init packscript.calls 1', 'say hi'])
+        self.assertEqual(json.loads((data / 'minecraft/tags/function/load.json').read_text())['values'],
+                         ['packscript:instrument/load', 'test:init'])
+        for function in ('load', 'dump', 'reset'):
+            self.assertTrue((data / f'packscript/function/instrument/{function}.mcfunction').is_file())
+
+
+class TestServe(PackComparison):
+    def test_compile_request(self):
+        """ Served compiles report their output and timings, and where in the generated code an error happened """
+        temp = self.write_pack('/function tick [tick]:\n    /say hi\n')
+        request = {'id': 1, 'cwd': str(temp), 'options': {'input': 'input', 'output': 'output', 'no_cache': True}}
+        result = compile_request(request)
+        self.assertTrue(result['ok'])
+        self.assertEqual(result['id'], 1)
+        self.assertIn('exec', result['phases'])
+        self.assertTrue((temp / 'output/data/test/function/tick.mcfunction').is_file())
+
+        source = temp / 'input/data/test/source'
+        (source / 'main.dps').write_text('/say before\nvalue = 1 / 0\n/say after\n')
+        result = compile_request(request)
+        self.assertFalse(result['ok'])
+        self.assertEqual(result['error']['type'], 'ZeroDivisionError')
+        self.assertEqual(result['error']['file'], str(source / 'main.dps'))
+        self.assertEqual(result['error']['line'], 2)
+        self.assertIn('2: value = 1 / 0', result['error']['excerpt'])
+
+    def test_helper_modules(self):
+        """ Helper modules stay imported between builds of a pack, until one of their files changes """
+        temp = self.write_pack(['from helper import BUILDS', 'BUILDS.append(1)', '/function builds:',
+                                '    /say ${len(BUILDS)}'])
+        helper = temp / 'input/data/test/source/helper.py'
+        helper.write_text('BUILDS = []\n')
+        request = {'id': 1, 'cwd': str(temp), 'options': {'input': 'input', 'output': 'output', 'no_cache': True}}
+        builds = temp / 'output/data/test/function/builds.mcfunction'
+        for expected in ('say 1', 'say 2'):
+            self.assertTrue(compile_request(request)['ok'])
+            self.assertEqual(builds.read_text().splitlines()[1:], [expected])
+        self.assertNotIn('helper', sys.modules)
+        helper.write_text('BUILDS = [0]\n')
+        self.assertTrue(compile_request(request)['ok'])
+        self.assertEqual(builds.read_text().splitlines()[1:], ['say 2'])
+
+    def test_socket_file(self):
+        """ serve doesn't replace a file that isn't a socket """
+        path = Path(self.enterContext(tempfile.TemporaryDirectory())) / 'notes.txt'
+        path.write_text('keep')
+        with self.assertRaises(ValueError):
+            serve(socket=str(path))
+        self.assertEqual(path.read_text(), 'keep')
+
+
+class TestBatch(unittest.TestCase):
+    def test_batch(self):
+        """ A failing pack doesn't stop the others, and helper modules of one pack aren't seen by the next """
+        with tempfile.TemporaryDirectory() as temp:
+            temp = Path(temp)
+            packs = []
+            for name, value in (('first', '1'), ('broken', '1 / 0'), ('second', '2')):
+                source = temp / name / 'data/test/source'
+                source.mkdir(parents=True)
+                (temp / name / 'pack.mcmeta').write_text('{"pack": {"pack_format": 61, "description": "test"}}')
+                (source / 'helper.py').write_text(f'VALUE = {value}\n')
+                (source / 'main.dps').write_text('from helper import VALUE\n/function value:\n    /say $VALUE\n')
+                packs.append({'input': str(temp / name), 'output': str(temp / f'{name}_out')})
+            with contextlib.redirect_stdout(io.StringIO()):
+                results = compile_batch(packs=packs, verbose=False, source=False, no_cache=True)
+            self.assertEqual([result['ok'] for result in results], [True, False, True])
+            self.assertEqual(results[1]['error']['type'], 'ZeroDivisionError')
+            for name, value in (('first', '1'), ('second', '2')):
+                self.assertEqual((temp / f'{name}_out/data/test/function/value.mcfunction').read_text().splitlines()[1:],
+                                 [f'say {value}'])
+
+            with contextlib.redirect_stdout(io.StringIO()):
+                results = compile_batch(packs=packs, verbose=False, source=False, no_cache=True, fail_fast=True)
+            self.assertEqual([result['ok'] for result in results], [True, False])
+
+    def test_manifest_cache(self):
+        """ Packs in a manifest without a cache_dir use their own cache, and clearing it leaves other files alone """
+        with tempfile.TemporaryDirectory() as temp:
+            temp = Path(temp)
+            source = temp / 'pack/data/test/source'
+            source.mkdir(parents=True)
+            (temp / 'pack/pack.mcmeta').write_text('{"pack": {"pack_format": 61, "description": "test"}}')
+            (source / 'main.dps').write_text('/function value:\n    /say 1\n')
+            (temp / 'notes.txt').write_text('keep me')
+            (temp / 'm.json').write_text('{"packs": [{"input": "pack", "output": "out"}]}')
+            packs = read_manifest(temp / 'm.json')
+            self.assertNotIn('cache_dir', packs[0])
+            for clear_cache in (False, True):
+                with contextlib.redirect_stdout(io.StringIO()):
+                    results = compile_batch(packs=packs, verbose=False, source=False, clear_cache=clear_cache)
+                self.assertTrue(results[0]['ok'])
+                self.assertEqual(list(temp.glob('*.psc')), [])
+                self.assertTrue(list((temp / 'pack/.packscript_cache').glob('*.psc')))
+                self.assertEqual((temp / 'notes.txt').read_text(), 'keep me')
+
+
+class TestSyncOutput(PackComparison):
+    def test_sync(self):
+        """ Syncing leaves untouched files alone and removes stale ones """
+        with tempfile.TemporaryDirectory() as temp:
+            temp = Path(temp)
+            output = temp / 'output'
+            options = dict(input='tests/data/muliple_dps_and_namespaces/input_pack', output=str(output),
+                           verbose=False, source=False, no_cache=True, sync=True)
+            compile(**options)
+            tick = output / 'data/zlo/functions/tick.mcfunction'
+            mtime = tick.stat().st_mtime_ns
+            (output / 'stale.txt').write_text('stale')
+            (output / 'stale_dir').mkdir()
+            compile(**options)
+            self.assertEqual(tick.stat().st_mtime_ns, mtime)
+            self.assertFalse((output / 'stale.txt').exists())
+            self.assertFalse((output / 'stale_dir').exists())
+            self.assertTrue((temp / '.output.packscript.json').is_file())
+            self.deep_compare_dirs(output, options['input'].replace('input', 'output'))
+
+
+class TestBuildState(PackComparison):
+    def test_reuse(self):
+        """ Rebuilding with a BuildState only reruns the namespaces that changed """
+        with tempfile.TemporaryDirectory() as temp:
+            temp = Path(temp)
+            case = 'tests/data/muliple_dps_and_namespaces'
+            shutil.copytree(f'{case}/input_pack', temp / 'input')
+            state = BuildState()
+            options = dict(input=str(temp / 'input'), output=str(temp / 'output'), verbose=False, source=False,
+                           no_cache=True, sync=True, state=state)
+            compile(**options)
+            self.assertEqual(state.executed, ['data/example', 'data/zlo', '*.fps'])
+            state.executed.clear()
+            compile(**options)
+            self.assertEqual(state.executed, [])
+            main = temp / 'input/data/zlo/sources/main.dps'
+            main.write_text(main.read_text() + '\n')
+            compile(**options)
+            self.assertEqual(state.executed, ['data/zlo'])
+            self.deep_compare_dirs(temp / 'output', f'{case}/output_pack')
+
+    def test_source_files(self):
+        """ Within a namespace only the changed files and the files sharing something with them are rerun """
+        with tempfile.TemporaryDirectory() as temp:
+            temp = Path(temp)
+            source = temp / 'input/data/test/source'
+            source.mkdir(parents=True)
+            (temp / 'input/pack.mcmeta').write_text('{"pack": {"pack_format": 61, "description": ""}}')
+            (source / 'a.dps').write_text("def greet(name):\n    /say hello $name\n/function a:\n    greet('a')\n")
+            (source / 'b.dps').write_text("/function b:\n    greet('b')\n")
+            (source / 'c.dps').write_text("create tags/block stones -> {'values': []}\n/function c:\n    /say c\n")
+            state = BuildState()
+            options = dict(input=str(temp / 'input'), output=str(temp / 'output'), verbose=False, source=False,
+                           no_cache=True, sync=True, state=state)
+            with contextlib.redirect_stdout(io.StringIO()):
+                compile(**options)
+                state.executed.clear()
+                (source / 'c.dps').write_text("create tags/block stones -> {'values': []}\n/function c:\n    /say cc\n")
+                compile(**options)
+                self.assertEqual(state.executed, ['data/test/source/c.dps'])
+                state.executed.clear()
+                (source / 'a.dps').write_text("def greet(name):\n    /say hi $name\n/function a:\n    greet('a')\n")
+                compile(**options)
+                self.assertEqual(state.executed, ['data/test/source/a.dps', 'data/test/source/b.dps'])
+                state.executed.clear()
+                # c now uses a function defined in a, which it couldn't before, so everything is run again
+                (source / 'c.dps').write_text("/function c:\n    greet('c')\n")
+                compile(**options)
+                self.assertEqual(state.executed, ['data/test'])
+            function = temp / 'output/data/test/function'
+            self.assertEqual((function / 'b.mcfunction').read_text().splitlines()[1:], ['say hi b'])
+            self.assertEqual((function / 'c.mcfunction').read_text().splitlines()[1:], ['say hi c'])
+            self.assertFalse((temp / 'output/data/test/tags/block/stones.json').exists())
+            state.write_graph(temp / 'deps.json')
+            graph = json.loads((temp / 'deps.json').read_text())['data/test']
+            self.assertEqual(graph['files']['data/test/source/c.dps']['depends_on'], ['data/test/source/a.dps'])
+            self.assertEqual(graph['files']['data/test/source/a.dps']['writes'], ['function:test:a', 'global:greet'])
+
+
+    def test_earlier_namespaces(self):
+        """ A namespace looking at resources of an earlier namespace sees them, and is run again when they change """
+        with tempfile.TemporaryDirectory() as temp:
+            temp = Path(temp)
+            (temp / 'input').mkdir()
+            (temp / 'input/pack.mcmeta').write_text('{"pack": {"pack_format": 61, "description": ""}}')
+            for name in 'abc':
+                (temp / f'input/data/{name}/source').mkdir(parents=True)
+            a = temp / 'input/data/a/source/main.dps'
+            a.write_text("dp.tags.block.x = {'values': []}\n")
+            (temp / 'input/data/b/source/main.dps').write_text(
+                'print("b ran")\n/function count:\n    /say ${len(dp.query("tags/block"))}\n')
+            (temp / 'input/data/c/source/main.dps').write_text('/function c:\n    /say c\n')
+            state = BuildState()
+            options = dict(input=str(temp / 'input'), output=str(temp / 'output'), verbose=False, source=False,
+                           no_cache=True, sync=True, state=state)
+            count = temp / 'output/data/b/function/count.mcfunction'
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                compile(**options)
+            self.assertEqual(count.read_text().splitlines()[1:], ['say 1'])
+            self.assertEqual(output.getvalue().count('b ran'), 1)
+            self.assertEqual(state.executed, ['data/a', 'data/b', 'data/c', '*.fps'])
+            state.executed.clear()
+            a.write_text("dp.tags.block.x = {'values': []}\ndp.tags.block.y = {'values': []}\n")
+            with contextlib.redirect_stdout(io.StringIO()):
+                compile(**options)
+            self.assertEqual(count.read_text().splitlines()[1:], ['say 2'])
+            self.assertEqual(state.executed, ['data/a', 'data/b'])
+
+
+class TestParallelCompile(PackComparison):
+    def test_jobs(self):
+        """ Compiling namespaces in worker processes gives the same output """
+        with tempfile.TemporaryDirectory() as temp:
+            for case in ('muliple_dps_and_namespaces', 'overlay'):
+                with self.subTest(case=case):
+                    output = Path(temp) / case
+                    compile(input=f'tests/data/{case}/input_pack', output=str(output), verbose=False, source=False,
+                            no_cache=True, jobs=2)
+                    self.deep_compare_dirs(output, f'tests/data/{case}/output_pack')
+
+    def test_shared_resources(self):
+        """ Namespaces looking at resources made by an earlier namespace see them like in a serial build, and ones
+            making the same resource replace it """
+        with tempfile.TemporaryDirectory() as temp:
+            temp = Path(temp)
+            (temp / 'input').mkdir()
+            (temp / 'input/pack.mcmeta').write_text('{"pack": {"pack_format": 61, "description": ""}}')
+            sources = {'a': "dp.tags.block.x = {'values': []}\n"
+                            "dp['tags/item', 'minecraft:logs'] = {'values': ['a']}\n",
+                       'b': 'print("b ran")\n/function count:\n    /say ${len(dp.query("tags/block", "*:*"))}\n',
+                       'c': "dp.tags.block.y = {'values': []}\n/function ok:\n    /say ${dp['tags/block', 'a:x']['values']}\n",
+                       'd': "dp['tags/item', 'minecraft:logs'] = {'values': ['d']}\n"}
+            for name, source in sources.items():
+                (temp / f'input/data/{name}/source').mkdir(parents=True)
+                (temp / f'input/data/{name}/source/main.dps').write_text(source)
+            options = dict(input=str(temp / 'input'), verbose=False, source=False, no_cache=True)
+            with contextlib.redirect_stdout(io.StringIO()):
+                compile(output=str(temp / 'serial'), **options)
+            # in a new process, to see what the workers print too
+            output = subprocess.run([sys.executable, parent_dir / 'packscript.py', 'compile', '-i', temp / 'input',
+                                     '-o', temp / 'parallel', '--no-cache', '-j', '2'],
+                                    capture_output=True, text=True, check=True).stdout
+            self.deep_compare_dirs(temp / 'serial', temp / 'parallel')
+            # b runs again, but what its worker printed is left out
+            self.assertEqual(output.count('b ran'), 1)
+            self.assertEqual((temp / 'parallel/data/b/function/count.mcfunction').read_text().splitlines()[1:],
+                             ['say 1'])
+            self.assertEqual((temp / 'parallel/data/c/function/ok.mcfunction').read_text().splitlines()[1:],
+                             ['say []'])
+            # like in a serial build, the last namespace to make a resource wins
+            self.assertEqual(json.loads((temp / 'parallel/data/minecraft/tags/item/logs.json').read_text()),
+                             {'values': ['d']})
+
+    def test_fps_jobs(self):
+        """ .fps files run in worker processes give the same output, and clashing names are reported """
+        with tempfile.TemporaryDirectory() as temp:
+            temp = Path(temp)
+            (temp / 'input').mkdir()
+            for i in range(4):
+                (temp / f'input/f{i}.fps').write_text(f'/say f{i}\n/function :\n    /say anon {i}\n'
+                                                      f'/function gen_{i}:\n    /say gen {i}\n')
+            # adds to a function of an earlier file, which a worker can't see
+            (temp / 'input/g.fps').write_text('with __function__("minecraft:gen_0"):\n    /say more\n')
+            options = dict(input=str(temp / 'input'), verbose=False, source=False, no_cache=True)
+            with contextlib.redirect_stdout(io.StringIO()):
+                compile(output=str(temp / 'serial'), **options)
+                compile(output=str(temp / 'parallel'), jobs=2, **options)
+                self.deep_compare_dirs(temp / 'serial', temp / 'parallel')
+                compile(output=str(temp / 'streamed'), jobs=2, stream=True, **options)
+                self.deep_compare_dirs(temp / 'serial', temp / 'streamed')
+                self.assertEqual((temp / 'parallel/gen_0.mcfunction').read_text().splitlines()[1:],
+                                 ['say gen 0', 'say more'])
+                self.assertEqual((temp / 'parallel/anon_function_3.mcfunction').read_text().splitlines()[1:],
+                                 ['say anon 3'])
+                (temp / 'input/g.fps').write_text('/function gen_1:\n    /say again\n')
+                with self.assertRaisesRegex(ValueError, "'minecraft:gen_1' \\(generated by f1.fps and g.fps\\)"):
+                    compile(output=str(temp / 'parallel'), jobs=2, **options)
+                (temp / 'input/g.fps').write_text('/function f1:\n    /say f1\n')
+                with self.assertRaisesRegex(ValueError, 'both be written to f1.mcfunction'):
+                    compile(output=str(temp / 'parallel'), jobs=2, **options)
+
+
+class TestZipOutput(PackComparison):
+    def test_zip(self):
+        """ Zip outputs have the same contents as directory outputs, and are reproducible """
+        with tempfile.TemporaryDirectory() as temp:
+            temp = Path(temp)
+            case = 'tests/data/overlay'
+            options = dict(input=f'{case}/input_pack', verbose=False, source=False, no_cache=True)
+            compile(output=str(temp / 'pack.zip'), **options)
+            first = (temp / 'pack.zip').read_bytes()
+            compile(output=str(temp / 'pack.zip'), **options)
+            self.assertEqual((temp / 'pack.zip').read_bytes(), first)
+            with zipfile.ZipFile(temp / 'pack.zip') as archive:
+                archive.extractall(temp / 'extracted')
+            self.deep_compare_dirs(temp / 'extracted', f'{case}/output_pack')
+            self.assertEqual([f.name for f in temp.iterdir() if f.is_file()], ['pack.zip'])
+
+
 if __name__ == '__main__':
     os.chdir(os.path.dirname(sys.argv[0]))
     unittest.main()